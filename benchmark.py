@@ -0,0 +1,680 @@
+"""
+Offline benchmark of the ingestion, briefing and tag browsing paths.
+
+Replays synthetic channel and group traffic through the real handlers in bot.py, with a
+deterministic fake Gemini model and an in-memory stand-in for MongoDB, so no Telegram,
+Gemini or Atlas access is needed:
+
+    python benchmark.py --messages 5000 --chats 8 --llm-latency 0.3
+
+Reports messages/sec, p50/p95/p99 handler latency and Gemini calls per request for each
+phase. Pass --mongo-uri mongodb://localhost:27017 to run against a local mongod instead
+(the --mongo-db database is dropped first), and --json to keep the results for comparison
+between runs.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+from dotenv import load_dotenv
+from telegram import Update
+
+load_dotenv()
+
+from repository import MESSAGE_FIELDS, PROMPT_FIELDS, PAGE_FIELDS
+from tag_index import normalize_tag
+from update_processor import ChatOrderedUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+TOPICS = ["Exams", "Assignments", "Lectures", "Events", "Housing", "Sports", "Jobs", "Clubs",
+          "Library", "Scholarships", "Transport", "Food"]
+WORDS = ("deadline room moved tomorrow please remember bring slides quiz week registration free "
+         "pizza tickets open meeting friday notes tutorial cancelled updated form link portal").split()
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """
+    Deterministic stand-in for genai.GenerativeModel.
+
+    Answers tagging prompts with a tag derived from each message's text and everything else
+    with a short summary, after sleeping `latency` seconds like a network round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    @staticmethod
+    def tag_for(text):
+        return TOPICS[zlib.crc32(text.encode()) % len(TOPICS)]
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if "Return ONLY a JSON array" in prompt:
+            entries = []
+            for line in prompt.splitlines():
+                number, _, message = line.strip().partition(". ")
+                if number.isdigit() and message.startswith('"'):
+                    entries.append({"id": int(number), "tag": self.tag_for(json.loads(message))})
+            return FakeResponse(json.dumps(entries))
+
+        if "Text message:" in prompt:
+            message = prompt.split("Text message:", 1)[1].split("Return ONLY", 1)[0].strip()
+            return FakeResponse(self.tag_for(message))
+
+        return FakeResponse(f"Summary {zlib.crc32(prompt.encode()):08x} of {prompt.count(chr(10)) + 1} lines")
+
+
+def hashed_embedding(texts, dim=64):
+    """Stand-in for the spaCy tag embedder: one pseudo-random vector per normalized tag."""
+    vectors = [np.random.default_rng(zlib.crc32(normalize_tag(text).lower().encode())).standard_normal(dim)
+               for text in texts]
+    return np.array(vectors, dtype=np.float32).reshape(len(vectors), dim)
+
+
+def _naive_utc(value):
+    """Stores datetimes the way PyMongo returns them: naive UTC."""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _project(doc, fields):
+    projected = {key: doc[key] for key, include in fields.items() if include and key in doc}
+    if fields.get("_id", 1) and "_id" in doc:
+        projected["_id"] = doc["_id"]
+    return projected
+
+
+def _in_window(date, since, until, inclusive=True):
+    return (date >= since if inclusive else date > since) and (until is None or date < until)
+
+
+class MemoryCursor:
+    """Async cursor over a precomputed result list, paying one round trip on the first fetch."""
+
+    def __init__(self, docs, latency=0.0):
+        self._docs = iter(docs)
+        self._latency = latency
+        self._started = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._started:
+            self._started = True
+            if self._latency:
+                await asyncio.sleep(self._latency)
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        return [doc async for doc in self]
+
+    async def close(self):
+        self._docs = iter(())
+
+
+class MemoryRepository:
+    """
+    In-memory stand-in for repository.MessageRepository, implementing the queries the
+    handlers run with the same arguments and result shapes.
+
+    Args:
+        latency (float): Seconds every call waits, simulating a database round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._messages = {}  # _id -> document
+        self._summaries = {}  # (chat_id, bucket_start) -> document
+        self._chats = {}  # chat id -> registry document
+        self._tag_stats = {}  # (chat_id, tag, day) -> [count, last_seen]
+        self._embeddings = {}  # message _id -> embedding document
+        self._search_backfill_mark = None
+
+    async def _round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _find(self, predicate, fields, limit=None, oldest_first=False):
+        docs = sorted((doc for doc in self._messages.values() if predicate(doc)),
+                      key=lambda doc: doc["date"], reverse=not oldest_first)
+        if limit:
+            docs = docs[:limit]
+        return [_project(doc, fields) for doc in docs]
+
+    async def connect(self):
+        pass
+
+    async def ping(self):
+        await self._round_trip()
+
+    async def close(self):
+        pass
+
+    async def ensure_indexes(self):
+        pass
+
+    async def explain_queries(self, chat_id, tag, since):
+        return []
+
+    async def all_chats(self):
+        await self._round_trip()
+        return [{"_id": chat_id, **doc} for chat_id, doc in self._chats.items()]
+
+    async def save_chat(self, chat_id, fields):
+        await self._round_trip()
+        self._chats.setdefault(chat_id, {}).update(fields)
+
+    async def backfill_chat_id(self, chat_name, chat_id):
+        await self._round_trip()
+        updated = 0
+        for doc in self._messages.values():
+            if doc["chat_name"] == chat_name and "chat_id" not in doc:
+                doc["chat_id"] = chat_id
+                updated += 1
+        return updated
+
+    async def insert_many(self, docs, ordered=False):
+        await self._round_trip()
+        for doc in docs:
+            # Re-inserting an _id is a duplicate key error in MongoDB, which the write buffer ignores
+            self._messages.setdefault(doc["_id"], {key: _naive_utc(value) for key, value in doc.items()})
+
+    async def set_tag(self, doc_id, tag):
+        await self._round_trip()
+        if doc_id in self._messages:
+            self._messages[doc_id]["tag"] = tag
+
+    async def find_tags_by_hashes(self, content_hashes, exclude_tag=None):
+        await self._round_trip()
+        content_hashes = set(content_hashes)
+        tags = {}
+        for doc in self._messages.values():
+            if doc.get("text_hash") in content_hashes and doc.get("tag") not in (None, exclude_tag):
+                tags.setdefault(doc["text_hash"], doc["tag"])
+        return tags
+
+    async def recent_by_chat(self, chat_id, limit=100):
+        await self._round_trip()
+        return self._find(lambda doc: doc.get("chat_id") == chat_id, MESSAGE_FIELDS, limit)
+
+    async def latest_tagged_message(self):
+        await self._round_trip()
+        docs = self._find(lambda doc: "tag" in doc, MESSAGE_FIELDS, 1)
+        return docs[0] if docs else None
+
+    async def newest_message_id(self, chat_id):
+        await self._round_trip()
+        docs = self._find(lambda doc: doc.get("chat_id") == chat_id, {"_id": 1}, 1)
+        return docs[0]["_id"] if docs else None
+
+    async def by_time_window(self, chat_id, since, until=None):
+        await self._round_trip()
+        return self._find(lambda doc: doc.get("chat_id") == chat_id and _in_window(doc["date"], since, until),
+                          MESSAGE_FIELDS)
+
+    def stream_recent_by_chat(self, chat_id, limit=100):
+        return MemoryCursor(self._find(lambda doc: doc.get("chat_id") == chat_id, PROMPT_FIELDS, limit), self.latency)
+
+    def stream_time_window(self, chat_id, since, until=None, inclusive=True, oldest_first=False):
+        docs = self._find(lambda doc: doc.get("chat_id") == chat_id and _in_window(doc["date"], since, until, inclusive),
+                          PROMPT_FIELDS, oldest_first=oldest_first)
+        return MemoryCursor(docs, self.latency)
+
+    async def tag_page(self, tag, chat_ids, before=None, after=None, limit=10):
+        await self._round_trip()
+        chat_ids = set(chat_ids)
+        docs = sorted((doc for doc in self._messages.values()
+                       if doc.get("tag") == tag and doc.get("chat_id") in chat_ids),
+                      key=lambda doc: (doc["date"], doc["_id"]), reverse=True)
+        if before is not None:
+            docs = [doc for doc in docs if (doc["date"], doc["_id"]) < before]
+        elif after is not None:
+            docs = [doc for doc in reversed(docs) if (doc["date"], doc["_id"]) > after]
+        page = [_project(doc, PAGE_FIELDS) for doc in docs[:limit]]
+        if after is not None:
+            page.reverse()
+        return page, len(docs) > limit
+
+    async def distinct_tags(self, chat_ids=None):
+        await self._round_trip()
+        chat_ids = None if chat_ids is None else set(chat_ids)
+        return sorted({doc["tag"] for doc in self._messages.values()
+                       if doc.get("tag") is not None and (chat_ids is None or doc.get("chat_id") in chat_ids)})
+
+    async def tag_counts(self, exclude=()):
+        await self._round_trip()
+        counts = {}
+        for doc in self._messages.values():
+            if doc.get("tag") is not None and doc["tag"] not in exclude:
+                counts[doc["tag"]] = counts.get(doc["tag"], 0) + 1
+        return sorted(counts.items(), key=lambda item: -item[1])
+
+    def stream_texts_by_tag(self, tag, limit):
+        return MemoryCursor(self._find(lambda doc: doc.get("tag") == tag, PROMPT_FIELDS, limit), self.latency)
+
+    async def bucket_activity(self, chat_id, since, until=None, bucket_minutes=60):
+        await self._round_trip()
+        epoch = datetime(1970, 1, 1)
+        buckets = {}
+        for doc in self._messages.values():
+            if doc.get("chat_id") != chat_id or not _in_window(doc["date"], since, until):
+                continue
+            minutes = int((doc["date"] - epoch).total_seconds() // 60)
+            start = epoch + timedelta(minutes=minutes - minutes % bucket_minutes)
+            bucket = buckets.setdefault(start, {"start": start, "count": 0, "last": doc["date"]})
+            bucket["count"] += 1
+            bucket["last"] = max(bucket["last"], doc["date"])
+        return [buckets[start] for start in sorted(buckets)]
+
+    async def bucket_summaries(self, chat_id, since, until=None):
+        await self._round_trip()
+        return {start: dict(doc) for (chat, start), doc in self._summaries.items()
+                if chat == chat_id and _in_window(start, since, until)}
+
+    async def save_bucket_summary(self, chat_id, start, summary, message_count, last_message_date):
+        await self._round_trip()
+        doc = {
+            "chat_id": chat_id,
+            "bucket_start": start,
+            "summary": summary,
+            "message_count": message_count,
+            "last_message_date": last_message_date,
+        }
+        self._summaries[(chat_id, start)] = doc
+        return dict(doc)
+
+
+    async def add_tag_stats(self, increments):
+        await self._round_trip()
+        for chat_id, tag, day, count, last_seen in increments:
+            entry = self._tag_stats.setdefault((chat_id, tag, day), [0, last_seen])
+            entry[0] += count
+            entry[1] = max(entry[1], last_seen)
+
+    async def top_tags(self, chat_ids, since, limit):
+        await self._round_trip()
+        chat_ids = set(chat_ids)
+        ranking = {}
+        for (chat_id, tag, day), (count, last_seen) in self._tag_stats.items():
+            if chat_id in chat_ids and day >= since:
+                total, latest = ranking.get(tag, (0, last_seen))
+                ranking[tag] = (total + count, max(latest, last_seen))
+        ranked = sorted(ranking.items(), key=lambda item: item[1], reverse=True)
+        return [(tag, count, last_seen) for tag, (count, last_seen) in ranked[:limit]]
+
+    async def text_search(self, query, chat_ids, limit):
+        await self._round_trip()
+        terms = set(query.lower().split())
+        chat_ids = set(chat_ids)
+        scored = []
+        for doc in self._messages.values():
+            if doc.get("chat_id") in chat_ids:
+                score = sum(word in terms for word in doc["text"].lower().split())
+                if score:
+                    scored.append((score, doc["_id"]))
+        scored.sort(reverse=True)
+        return [doc_id for _, doc_id in scored[:limit]]
+
+    async def messages_by_ids(self, ids):
+        await self._round_trip()
+        return {doc_id: _project(self._messages[doc_id], PAGE_FIELDS) for doc_id in ids if doc_id in self._messages}
+
+    async def messages_before(self, before, limit, after=None):
+        await self._round_trip()
+        docs = sorted((doc for doc in self._messages.values()
+                       if doc["_id"] < before and (after is None or doc["_id"] > after)),
+                      key=lambda doc: doc["_id"], reverse=True)
+        return [_project(doc, {"chat_id": 1, "text": 1}) for doc in docs[:limit]]
+
+    async def search_backfill_mark(self):
+        return self._search_backfill_mark
+
+    async def save_search_backfill_mark(self, before):
+        self._search_backfill_mark = before
+
+    async def save_embeddings(self, entries):
+        await self._round_trip()
+        for doc_id, chat_id, vector in entries:
+            self._embeddings[doc_id] = {"_id": doc_id, "chat_id": chat_id, "vector": vector}
+
+    def stream_embeddings(self):
+        return MemoryCursor(list(self._embeddings.values()), self.latency)
+
+    async def tag_stats_built(self):
+        return True
+
+    async def rebuild_tag_stats(self):
+        pass
+
+
+class FakeBot:
+    """Accepts the Bot API calls the handlers make and counts them instead of sending anything."""
+
+    username = "benchmark_bot"
+    defaults = None
+
+    def __init__(self):
+        self.calls = 0
+
+    async def _call(self, *args, **kwargs):
+        self.calls += 1
+        return True
+
+    async def send_message(self, *args, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(message_id=1000 + self.calls)
+
+    answer_callback_query = edit_message_text = _call
+
+
+class FakeContext:
+    """The parts of CallbackContext the handlers use."""
+
+    def __init__(self, bot, user_data=None):
+        self.bot = bot
+        self.user_data = user_data if user_data is not None else {}
+        self.bot_data = {}
+        self.args = []
+
+
+def make_chats(count):
+    """Alternates channels and supergroups, returning Telegram chat dicts."""
+    chats = []
+    for i in range(count):
+        if i % 2:
+            chats.append({"id": -1002000000000 - i, "type": "supergroup", "title": f"Group {i}"})
+        else:
+            chats.append({"id": -1001000000000 - i, "type": "channel", "title": f"Channel {i}"})
+    return chats
+
+
+def selection(chat):
+    """The value /showall stores in user_data when a chat is ticked."""
+    return chat["id"]
+
+
+def make_traffic(chats, count, hours, duplicate_rate, seed):
+    """
+    Builds channel posts and group messages spread over the last `hours`, oldest first.
+
+    A `duplicate_rate` share of the texts repeats an earlier one, like forwarded announcements.
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    texts, updates = [], []
+    for i in range(count):
+        if texts and rng.random() < duplicate_rate:
+            text = rng.choice(texts)
+        else:
+            text = f"{rng.choice(TOPICS)}: " + " ".join(rng.choices(WORDS, k=rng.randint(6, 30)))
+            texts.append(text)
+
+        chat = rng.choice(chats)
+        date = int((now - timedelta(hours=hours) * (1 - i / count)).timestamp())
+        message = {"message_id": i + 1, "date": date, "chat": chat, "text": text}
+        if chat["type"] == "channel":
+            message["sender_chat"] = chat
+            updates.append({"update_id": i + 1, "channel_post": message})
+        else:
+            message["from"] = {"id": 1000 + rng.randrange(200), "is_bot": False, "first_name": "Student"}
+            updates.append({"update_id": i + 1, "message": message})
+    return updates
+
+
+def make_callback(update_id, user, data, message_id=1):
+    """Builds a callback query update for a button pressed on a message in the user's private chat."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "benchmark",
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user["id"], "type": "private", "first_name": user["first_name"]},
+                "text": "benchmark",
+            },
+        },
+    }
+
+
+def make_command(update_id, user, text):
+    """Builds a command message the user sends in their private chat."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+class ErrorCounter(logging.Handler):
+    """Counts ERROR log records, which is how the handlers report failures they swallow."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+async def run_phase(name, handler, updates, context, model, errors, concurrency):
+    """
+    Runs `handler` for every update through the production update processor.
+
+    Returns:
+        dict: Throughput, latency percentiles (ms) and Gemini calls for the phase.
+    """
+    processor = ChatOrderedUpdateProcessor(concurrency)
+    latencies = []
+    calls_before, errors_before = model.calls, errors.count
+
+    async def timed(update):
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+        except Exception:
+            logger.exception("%s handler failed", name)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(processor.process_update(update, timed(update)) for update in updates))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "phase": name,
+        "requests": len(updates),
+        "elapsed_s": elapsed,
+        "per_second": len(updates) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "llm_calls": model.calls - calls_before,
+        "llm_per_request": (model.calls - calls_before) / len(updates) if updates else 0.0,
+        "errors": errors.count - errors_before,
+    }
+
+
+def load_bot(args):
+    """Imports bot.py wired to the fake model and the in-memory (or local) repository."""
+    # The fake model has no quota, so only the scheduler's concurrency limits it
+    os.environ["LLM_REQUESTS_PER_MINUTE"] = str(args.requests_per_minute)
+    os.environ["LLM_TOKENS_PER_MINUTE"] = str(args.tokens_per_minute)
+    # The fake model and hashed embeddings have nothing to warm up
+    os.environ["STARTUP_WARMUP"] = "0"
+
+    import repository
+
+    if args.mongo_uri:
+        real_repository = repository.MessageRepository
+        repository.MessageRepository = lambda uri, **options: real_repository(
+            args.mongo_uri, db_name=args.mongo_db, **options)
+    else:
+        repository.MessageRepository = lambda uri, **options: MemoryRepository(args.db_latency)
+
+    import bot
+
+    bot.model = FakeModel(args.llm_latency)
+    bot.tag_index.embed = hashed_embedding
+    bot.search_index.embed = hashed_embedding
+    return bot
+
+
+async def benchmark(args):
+    bot = load_bot(args)
+    model = bot.model
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    if args.mongo_uri:
+        await bot.repo.connect()
+        await bot.repo.client.drop_database(args.mongo_db)
+    await bot.on_startup(None)
+    await asyncio.gather(*bot.startup_tasks)
+    # Load the prompt tokenizer up front so its one-off download is not timed
+    await asyncio.to_thread(bot.token_counter.load)
+
+    fake_bot = FakeBot()
+    chats = make_chats(args.chats)
+    user = {"id": 42, "is_bot": False, "first_name": "Reader"}
+    user_data = {user["id"]: {selection(chat) for chat in chats}}
+    context = FakeContext(fake_bot, user_data)
+    next_id = args.messages + 1
+
+    def callbacks(data, message_ids=None):
+        nonlocal next_id
+        updates = []
+        for i, value in enumerate(data):
+            message_id = message_ids[i] if message_ids else 1
+            updates.append(Update.de_json(make_callback(next_id, user, value, message_id), fake_bot))
+            next_id += 1
+        return updates
+
+    results = []
+    try:
+        traffic = [Update.de_json(update, fake_bot)
+                   for update in make_traffic(chats, args.messages, args.hours, args.duplicate_rate, args.seed)]
+        ingest = await run_phase("ingest", bot.store_channel_message, traffic, context, model, errors,
+                                 args.concurrency)
+
+        # Tagging and the final inserts happen after the handlers return; wait for them too
+        started = time.perf_counter()
+        await bot.tagging_queue.stop(timeout=3600)
+        await bot.write_buffer.flush()
+        await bot.tag_stats.flush()
+        await bot.search_index.join()
+        await bot.tagging_queue.start()
+        ingest["drain_s"] = time.perf_counter() - started
+        ingest["llm_calls"] = model.calls
+        ingest["llm_per_request"] = model.calls / args.messages
+        results.append(ingest)
+
+        for option in ("100", "24h"):
+            data = [f"briefing_{option}_{selection(chat)}" for chat in chats]
+            results.append(await run_phase(f"briefing {option} cold", bot.fetch_briefing, callbacks(data),
+                                           context, model, errors, args.concurrency))
+            results.append(await run_phase(f"briefing {option} cached", bot.fetch_briefing,
+                                           callbacks(data * args.repeats), context, model, errors, args.concurrency))
+
+        tags = await bot.repo.distinct_tags()
+        results.append(await run_phase("tag browsing", bot.show_messages_for_tag,
+                                       callbacks([f"tag_{tag}" for tag in tags] * args.repeats),
+                                       context, model, errors, args.concurrency))
+
+        # Page through the tag lists opened above, each Older press editing its message in place
+        pages = [message_id for message_id in context.user_data.get("tag_pages", {}) for _ in range(args.repeats)]
+        results.append(await run_phase("tag paging", bot.turn_tag_page,
+                                       callbacks(["tagpage_older"] * len(pages), pages),
+                                       context, model, errors, args.concurrency))
+
+        context.args = ["deadline", "tomorrow"]
+        commands = [Update.de_json(make_command(next_id + i, user, "/search " + " ".join(context.args)), fake_bot)
+                    for i in range(len(TOPICS) * args.repeats)]
+        next_id += len(commands)
+        results.append(await run_phase("search", bot.search, commands, context, model, errors, args.concurrency))
+        pages = [message_id for message_id in context.user_data.get("search_pages", {}) for _ in range(args.repeats)]
+        results.append(await run_phase("search paging", bot.turn_search_page,
+                                       callbacks(["searchpage_next"] * len(pages), pages),
+                                       context, model, errors, args.concurrency))
+    finally:
+        await bot.on_shutdown(None)
+        logging.getLogger().removeHandler(errors)
+
+    return results
+
+
+def report(results):
+    print(f"{'phase':<22}{'requests':>9}{'per sec':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'llm calls':>11}{'llm/req':>9}{'errors':>8}")
+    for result in results:
+        print(f"{result['phase']:<22}{result['requests']:>9}{result['per_second']:>10.1f}{result['p50_ms']:>9.2f}"
+              f"{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['llm_calls']:>11}"
+              f"{result['llm_per_request']:>9.3f}{result['errors']:>8}")
+        if "drain_s" in result:
+            print(f"{'':<22}tagging and writes drained {result['drain_s']:.2f}s after the last handler returned")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description="Benchmark the bot's handlers against fake Telegram, Gemini and MongoDB.")
+    parser.add_argument("--messages", type=int, default=2000, help="synthetic messages to ingest")
+    parser.add_argument("--chats", type=int, default=8, help="channels and groups the traffic is spread over")
+    parser.add_argument("--hours", type=float, default=6, help="time span the messages are spread over")
+    parser.add_argument("--duplicate-rate", type=float, default=0.2, help="share of repeated message texts")
+    parser.add_argument("--repeats", type=int, default=3, help="repeated briefing and tag requests per chat/tag")
+    parser.add_argument("--concurrency", type=int, default=64, help="updates processed at once")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake Gemini call")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds per in-memory repository call")
+    parser.add_argument("--requests-per-minute", type=float, default=1e6, help="LLM scheduler request quota")
+    parser.add_argument("--tokens-per-minute", type=float, default=1e9, help="LLM scheduler token quota")
+    parser.add_argument("--mongo-uri", help="use a local mongod instead of the in-memory repository")
+    parser.add_argument("--mongo-db", default="benchmark", help="database used (and dropped) with --mongo-uri")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
@@ -1,77 +1,123 @@
+import asyncio
+import functools
+import json
 import logging
 import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+
+# Load environment variables from .env file, before the modules below read their settings
+load_dotenv()
+
+from services import STARTUP_WARMUP, LazyGenerativeModel, StartupProfile, run_checks
+
+# Startup profile clock, started before the heavy imports
+startup = StartupProfile()
+
 from telegram import Chat, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram import Chat, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     ChatMemberHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters
 )
 
-from pymongo import MongoClient
-import google.generativeai as genai
-
-# Load environment variables from .env file
-load_dotenv()
+from briefing_cache import BriefingCache
+from chat_registry import CHANNEL, GROUP_TYPES, ChatRegistry
+from classifier import LocalTagClassifier
+from digests import DIGEST_TIMEZONE, DigestScheduler, parse_delivery_time
+from llm import BACKGROUND, INTERACTIVE, CircuitOpenError, LLMScheduler
+from metrics import METRICS_PORT, LoopLagMonitor, instrument_handler, metrics, metrics_server
+from prompt_builder import collect_recent, token_counter
+from repository import MessageRepository, mongo_uri
+from retention import MESSAGE_RETENTION_DAYS, RetentionJob
+from search_index import SearchIndexer
+from summaries import SummaryEngine
+
+from tag_cache import TagCache, text_hash
+from tag_index import TagIndex
+from tag_stats import TAG_STATS_DAYS, TagStats
+from tagging import FALLBACK_TAG, TaggingQueue
+from update_processor import ChatOrderedUpdateProcessor
+from webhook import serve_webhook
+from write_buffer import WriteBuffer
+
+startup.mark("imports")
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-MONGOOSE_KEY = os.getenv("MONGOOSE_KEY")
 GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY")
+# "polling" or "webhook", see webhook.py for the webhook settings
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Telegram user IDs allowed to run the diagnostics commands
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+# Messages per tag browsing page, and the characters shown of each, to stay within one Telegram message
+TAG_PAGE_SIZE = int(os.getenv("TAG_PAGE_SIZE", "10"))
+TAG_PAGE_TEXT_CHARS = int(os.getenv("TAG_PAGE_TEXT_CHARS", "250"))
+# Tag browsing and search messages per user whose page buttons keep working
+TAG_PAGES_KEPT = int(os.getenv("TAG_PAGES_KEPT", "20"))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
 
-# Initialize Gemini
-genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel('gemini-pro')
+# Gemini client, imported and configured on first use
+model = LazyGenerativeModel('gemini-pro', GOOGLE_API_KEY)
 
 
-uri = "mongodb+srv://admin:" + MONGOOSE_KEY + "@messages.5xaf5.mongodb.net/?retryWrites=true&w=majority&appName=messages"
+# Async access to the Messages collection. The client is created by `repo.connect()` in on_startup.
+repo = MessageRepository(mongo_uri())
 
-# Create a new client and connect to the server
-client = MongoClient(uri)
-# Send a ping to confirm a successful connection
-try:
-    client.admin.command('ping')
-    print("Pinged your deployment. You successfully connected to MongoDB!")
-except Exception as e:
-    print(e)
 
+# Every Gemini call goes through the scheduler: rate limits, priorities, retries, circuit breaker
+llm = LLMScheduler(lambda prompt: model.generate_content(prompt).text, token_counter.count)
 
-db = client["DB"]  # or pick any DB name
-collection = db["Messages"]
+
+async def generate_text(prompt, priority=INTERACTIVE):
+    """Runs a Gemini prompt through the scheduler and returns the response text."""
+    return (await llm.generate(prompt, priority=priority)).strip()
+
+
+summary_engine = SummaryEngine(repo, generate_text, functools.partial(generate_text, priority=BACKGROUND))
+briefing_cache = BriefingCache(repo.newest_message_id)
+# Chats the bot is in, by Telegram chat ID; selections in user_data hold these IDs
+chat_registry = ChatRegistry(repo)
+# Per-chat, per-day tag counters behind /tags
+tag_stats = TagStats(repo)
 
 
 #  Set up logging
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+@instrument_handler
 async def help(update, context):
     chat_id = update.message.chat_id
 
     await context.bot.send_message(chat_id, "Help!")
 
 
+@instrument_handler
 async def tags(update, context):
     chat_id = update.message.chat_id
     await context.bot.send_message(chat_id, "tags!")
 
 
+@instrument_handler
 async def briefing(update, context):
     chat_id = update.message.chat_id
     selected_channels = context.user_data.get(chat_id, set())
-    print(selected_channels)
     if not selected_channels:
         await context.bot.send_message(chat_id, "No channels or groups selected. Use /showall to select them.")
         return
 
     # Provide options for summarizing selected groups/channels
     keyboard = [
-        [InlineKeyboardButton(f"Summarize Last 24 Hours - {channel}", callback_data=f"briefing_24h_{channel}")]
+        [InlineKeyboardButton(f"Summarize Last 24 Hours - {chat_registry.title(channel)}", callback_data=f"briefing_24h_{channel}")]
         for channel in selected_channels
     ] + [
-        [InlineKeyboardButton(f"Summarize Last 100 Messages - {channel}", callback_data=f"briefing_100_{channel}")]
+        [InlineKeyboardButton(f"Summarize Last 100 Messages - {chat_registry.title(channel)}", callback_data=f"briefing_100_{channel}")]
         for channel in selected_channels
     ]
 
@@ -83,56 +129,197 @@ async def briefing(update, context):
         reply_markup=reply_markup
     )
 
-async def fetch_briefing(update, context):
-    query = update.callback_query
-    data = query.data
-    # print(data)
-    _, option, channel_name = data.split("_", 2)
-    print("Channel Name", channel_name)
-    _, channel_name = channel_name.split("_", 1)
-
-    from datetime import datetime, timedelta
-    time_limit = datetime.now() - timedelta(hours=24)
+async def build_briefing(chat_id, option):
+    """
+    Summarizes a chat for a briefing option.
 
+    Returns:
+        str | None: The summary, or None if there are no messages to summarize.
+    """
     if option == "24h":
-        query_filter = {"chat_name": channel_name, "date": {"$gte": time_limit}}
-        result = collection.find(query_filter).sort("date", -1)
-    elif option == "100":
-        query_filter = {"chat_name": channel_name}
-
-        result = collection.find(query_filter).sort("date", -1).limit(100)
-    else:
-        await query.answer("Invalid option.")
-        return
+        # Merge the cached hourly summaries instead of re-reading the whole day
+        return await summary_engine.briefing(chat_id, hours=24) or None
 
-    messages = [doc['text'] for doc in result if 'text' in doc]
+    # Stream the newest messages, skipping duplicates and stopping at the token budget
+    messages = await collect_recent(repo.stream_recent_by_chat(chat_id, limit=100))
 
     if not messages:
-        await query.answer("No messages found to summarize.")
-        return
+        return None
 
     # Prepare the prompt for Gemini
     combined_messages = "\n".join(messages)
     prompt = f"Summarize the following messages into a concise summary highlighting key points:\n\n{combined_messages}"
 
+    # Generate the summary using Gemini
+    return await generate_text(prompt)
+
+
+async def digest_summary(chat_id):
+    # Prepared ahead of the delivery, so nobody is waiting on these Gemini calls
+    return await summary_engine.briefing(chat_id, hours=24, background=True) or None
+
+
+# Daily digests, summarized in the hour before delivery and pushed on time
+digests = DigestScheduler(repo, digest_summary)
+
+
+async def send_markdown(send, text):
+    """
+    Sends Markdown text, or the same text as plain text if Telegram cannot parse it.
+
+    Args:
+        send (callable): Coroutine function taking (text, **kwargs), e.g. a partial of `bot.send_message`.
+        text (str): Markdown text, which may contain Gemini output with stray `*` or `_`.
+    """
     try:
-        # Generate the summary using Gemini
-        summary_response = model.generate_content(prompt)
-        summary = summary_response.text.strip()
-        
+        return await send(text, parse_mode='Markdown')
+    except BadRequest as e:
+        logger.warning("Sending as plain text, Telegram could not parse the Markdown: %s", e)
+        return await send(text)
+
+
+async def send_digest(bot, user_id, summaries):
+    """Sends a prepared digest, one message per ~4000 characters."""
+    if not summaries:
+        await bot.send_message(user_id, "\U0001F4C5 Your daily digest: no messages in your selected chats in the last 24 hours.")
+        return
+
+    # A summary Telegram cannot parse only turns its own message into plain text
+    send = functools.partial(bot.send_message, user_id)
+    parts = [f"\U0001F4DD *{escape_markdown(chat_registry.title(chat_id))}:*\n{summary}\n\n" for chat_id, summary in summaries]
+    text = "\U0001F4C5 *Your daily digest*\n\n"
+    for part in parts:
+        if len(text) + len(part) > 4000 and text:
+            await send_markdown(send, text)
+            text = ""
+        text += part[:4000]
+    if text:
+        await send_markdown(send, text)
+
+
+@instrument_handler
+async def digest(update, context):
+    """Subscribes to a daily digest of the selected chats: /digest HH:MM, /digest off, or /digest to see it."""
+    chat_id = update.message.chat_id
+
+    if not context.args:
+        subscription = digests.subscription(chat_id)
+        if subscription is None:
+            await update.message.reply_text(
+                f"Get a daily digest of your selected chats with /digest HH:MM, e.g. /digest 07:30 ({DIGEST_TIMEZONE})."
+            )
+        else:
+            await update.message.reply_text(
+                f"Your digest of {len(subscription['chat_ids'])} chats arrives daily at {subscription['time']} "
+                f"({DIGEST_TIMEZONE}). Stop it with /digest off."
+            )
+        return
+
+    if context.args[0].lower() == "off":
+        stopped = await digests.unsubscribe(chat_id)
+        await update.message.reply_text("Your daily digest is stopped." if stopped else "You have no daily digest.")
+        return
+
+    delivery_time = parse_delivery_time(context.args[0])
+    if delivery_time is None:
+        await update.message.reply_text("Please give the time as HH:MM, e.g. /digest 07:30")
+        return
+
+    selected_chats = context.user_data.get(chat_id, set())
+    if not selected_chats:
+        await update.message.reply_text("Select the groups and channels for your digest with /showall first.")
+        return
+
+    await digests.subscribe(chat_id, delivery_time, selected_chats)
+    await update.message.reply_text(
+        f"✅ Your digest of {len(selected_chats)} chats will arrive daily at {delivery_time.strftime('%H:%M')} ({DIGEST_TIMEZONE})."
+    )
+
+
+@instrument_handler
+async def history(update, context):
+    """Shows the archived summaries of the selected chats for a day: /history YYYY-MM-DD."""
+    chat_id = update.message.chat_id
+    selected_chats = context.user_data.get(chat_id, set())
+    if not selected_chats:
+        await update.message.reply_text("Please select some groups or channels first using /showall.")
+        return
+
+    try:
+        day = datetime.strptime(context.args[0], "%Y-%m-%d") if context.args else None
+    except ValueError:
+        day = None
+    if day is None:
+        await update.message.reply_text("Please give the day as YYYY-MM-DD, e.g. /history 2024-01-31")
+        return
+
+    days = await repo.archived_days(selected_chats, day, day + timedelta(days=1))
+    if not days:
+        if not retention.enabled:
+            await update.message.reply_text("Messages are kept in full, use /tags or /search to browse them.")
+        else:
+            await update.message.reply_text(
+                f"Nothing archived for {day.date()}. Days are archived once they are {MESSAGE_RETENTION_DAYS} days old."
+            )
+        return
+
+    text = f"\U0001F5C4 *Archive of {day.date()}*\n\n"
+    for doc in days:
+        top_tags = sorted(doc.get("tags", {}).items(), key=lambda item: item[1], reverse=True)[:5]
+        part = (
+            f"\U0001F4DD *{escape_markdown(chat_registry.title(doc['chat_id'], doc.get('chat_name') or 'Unknown'))}* "
+            f"({doc['message_count']} messages)\n"
+            + (f"Tags: {escape_markdown(', '.join(f'{tag} ({count})' for tag, count in top_tags))}\n" if top_tags else "")
+            + f"{doc.get('summary') or 'No summary was archived.'}\n\n"
+        )
+        if len(text) + len(part) > 4000:
+            await update.message.reply_text(text, parse_mode='Markdown')
+            text = ""
+        text += part[:4000]
+    if text:
+        await update.message.reply_text(text, parse_mode='Markdown')
+
+
+@instrument_handler
+async def fetch_briefing(update, context):
+    query = update.callback_query
+    data = query.data
+    _, option, chat_id = data.split("_", 2)
+
+    if option not in ("24h", "100") or not chat_id.lstrip("-").isdigit():
+        await query.answer("Invalid option.")
+        return
+    chat_id = int(chat_id)
+
+    try:
+        # Identical briefings requested before any new message arrived are served from the cache
+        summary = await briefing_cache.get_or_create(
+            chat_id, option, functools.partial(build_briefing, chat_id, option)
+        )
+
+        if summary is None:
+            await query.answer("No messages found to summarize.")
+            return
+
         if not summary:
             summary = "I couldn't generate a summary for these messages."
-        
+
         # Send the summary back to the user
-        await context.bot.send_message(query.message.chat_id, f"\U0001F4DD *Summary:*\n{summary}", parse_mode='Markdown')
+        await send_markdown(
+            functools.partial(context.bot.send_message, query.message.chat_id),
+            f"\U0001F4DD *Summary of {escape_markdown(chat_registry.title(chat_id))}:*\n{summary}",
+        )
+    except CircuitOpenError:
+        await context.bot.send_message(query.message.chat_id, "Summaries are temporarily unavailable, please try again in a minute.")
     except Exception as e:
-        print(f"Error during summarization: {e}")
+        logger.error("Error during summarization: %s", e)
         await context.bot.send_message(query.message.chat_id, "An error occurred while generating the summary.")
 
     await query.answer("Summary generated.")
 
 
 
+@instrument_handler
 async def start(update, context):
     chat_id = update.message.chat_id
     bot_description = (
@@ -146,7 +333,10 @@ async def start(update, context):
         "*Available Commands:*\n"
         "\U0001F4AC /help \- Get help on how to use the bot.\n"
         "\U0001F4CA /tags \- View all message categories (tags).\n"
+        "\U0001F50E /search \- Search the messages of your selected channels.\n"
         "\U0001F4DD /briefing \- Get a summary of recent discussions.\n"
+        "\U0001F4C5 /digest \- Get a daily digest of your selected channels at a set time.\n"
+        "\U0001F5C4 /history \- Read the archived summaries of a past day.\n"
         "\U0001F4E2 /showall \- Show the channels the bot is in.\n"
         "\U0001F4E5 /selected \- View your selected channels for updates.\n"
         "\n*In essence*, I'm your one-stop Telegram agent to free you from endless chats and confusion!\n"
@@ -196,6 +386,7 @@ def extract_status_change(chat_member_update):
     return was_member, is_member
 
 
+@instrument_handler
 async def track_chats(update, context):
     """Tracks the chats the bot is in."""
     result = extract_status_change(update.my_chat_member)
@@ -210,73 +401,62 @@ async def track_chats(update, context):
     chat = update.effective_chat
     if chat.type == Chat.PRIVATE:
         if not was_member and is_member:
-            # This may not be really needed in practice because most clients will automatically
-            # send a /start command after the user unblocks the bot, and start_private_chat()
-            # will add the user to "user_ids".
-            # We're including this here for the sake of the example.
             logger.info("%s unblocked the bot", cause_name)
-            context.bot_data.setdefault("user_ids", set()).add(chat.id)
         elif was_member and not is_member:
             logger.info("%s blocked the bot", cause_name)
-            context.bot_data.setdefault("user_ids", set()).discard(chat.id)
     elif chat.type in [Chat.GROUP, Chat.SUPERGROUP]:
         if not was_member and is_member:
             logger.info("%s added the bot to the group %s", cause_name, chat.title)
-            context.bot_data.setdefault("group_ids", set()).add(chat.id)
         elif was_member and not is_member:
             logger.info("%s removed the bot from the group %s", cause_name, chat.title)
-            context.bot_data.setdefault("group_ids", set()).discard(chat.id)
     elif not was_member and is_member:
         logger.info("%s added the bot to the channel %s", cause_name, chat.title)
-        context.bot_data.setdefault("channel_ids", set()).add(chat.id)
-        context.bot_data.setdefault("channel_names", set()).add(chat.title)
     elif was_member and not is_member:
         logger.info("%s removed the bot from the channel %s", cause_name, chat.title)
-        context.bot_data.setdefault("channel_ids", set()).discard(chat.id)
-        
+
+    # Persist the membership, so the chat is still known after a restart
+    if was_member != is_member:
+        await chat_registry.set_membership(chat, is_member)
+
+
+@instrument_handler
 async def show_channels(update, context):
-    """Shows which chats the bot is in, grouped by user, group, and channel using only IDs."""
-    user_ids = list(context.bot_data.setdefault("user_ids", set()))
-    group_ids = list(context.bot_data.setdefault("group_ids", set()))
-    group_names = list(context.bot_data.setdefault("group_names", set()))
-    group_names = list(context.bot_data.setdefault("group_names", set()))
-    channel_ids = list(context.bot_data.setdefault("channel_ids", set()))
-    channel_names = list(context.bot_data.setdefault("channel_names", set()))
-    channel_names = list(context.bot_data.setdefault("channel_names", set()))
+    """Shows which chats the bot is in, with a button per group and channel to select it."""
+    users = chat_registry.chats(types=(Chat.PRIVATE,))
+    groups = chat_registry.chats(types=GROUP_TYPES)
+    channels = chat_registry.chats(types=(CHANNEL,))
 
     text = (
-        f"@{context.bot.username} is currently in a conversation with the following IDs:\n\n"
-        f"\U0001F464 *Users:* {', '.join(map(str, user_ids)) or 'None'}\n"
-        f"\U0001F465 *Groups:* {', '.join(map(str, group_names)) or 'None'}\n"
-        f"\U0001F4E2 *Channels:* {', '.join(map(str, channel_names)) or 'None'}\n"
+        f"@{context.bot.username} is currently in a conversation with the following chats:\n\n"
+        f"\U0001F464 *Users:* {', '.join(str(user_id) for user_id, _ in users) or 'None'}\n"
+        f"\U0001F465 *Groups:* {', '.join(group['title'] for _, group in groups) or 'None'}\n"
+        f"\U0001F4E2 *Channels:* {', '.join(channel['title'] for _, channel in channels) or 'None'}\n"
     )
-    
-    chat_id = update.message.chat_id
+
+    chat_id = update.effective_chat.id
     selected_chats = context.user_data.get(chat_id, set())
 
-    if not group_names and not channel_names:
+    if not groups and not channels:
         await context.bot.send_message(chat_id, "No groups or channels available.")
         return
 
-    # Create separate sections for groups and channels using IDs only
+    # Create separate sections for groups and channels, selecting chats by ID
     keyboard = []
-    print("Group IDs", group_ids)
-    if group_ids:
+    if groups:
         keyboard.append([InlineKeyboardButton("\U0001F465 Groups", callback_data="groups_header")])
         keyboard.extend(
             [
-                [InlineKeyboardButton(f"{'✅' if str(group) in selected_chats else '➖'} Group {group}", callback_data=f"toggle_group_{group}")]
-                for group in group_names
+                [InlineKeyboardButton(f"{'✅' if group_id in selected_chats else '➖'} Group {group['title']}", callback_data=f"toggle_{group_id}")]
+                for group_id, group in groups
             ]
         )
-    
-    if channel_ids:
+
+    if channels:
         keyboard.append([InlineKeyboardButton("\U0001F4E2 Channels", callback_data="channels_header")])
         keyboard.extend(
             [
-                [InlineKeyboardButton(f"{'✅' if str(channel) in selected_chats else '➖'} Channel {channel}", callback_data=f"toggle_channel_{channel}")]
-
-                for channel in channel_names
+                [InlineKeyboardButton(f"{'✅' if channel_id in selected_chats else '➖'} Channel {channel['title']}", callback_data=f"toggle_{channel_id}")]
+                for channel_id, channel in channels
             ]
         )
 
@@ -284,6 +464,11 @@ async def show_channels(update, context):
     keyboard.append([InlineKeyboardButton("✅ Submit", callback_data="submit_selection")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
+    if update.callback_query:
+        # A selection was toggled, update the buttons in place
+        await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+        return
+
     await context.bot.send_message(
         chat_id,
         text,
@@ -293,8 +478,8 @@ async def show_channels(update, context):
 
 
 
+@instrument_handler
 async def button_handler(update, context):
-    print("hi bro what it up")
     """Handles button clicks for selecting multiple channels."""
     query = update.callback_query
     chat_id = query.message.chat_id
@@ -303,10 +488,14 @@ async def button_handler(update, context):
     action, value = query.data.split("_", 1)
 
     if action == "toggle":
-        if value in user_selection:
-            user_selection.remove(value)
+        if not value.lstrip("-").isdigit():
+            await query.answer("Unknown chat.")
+            return
+        selected_chat = int(value)
+        if selected_chat in user_selection:
+            user_selection.remove(selected_chat)
         else:
-            user_selection.add(value)
+            user_selection.add(selected_chat)
 
         # Update the buttons dynamically
         await show_channels(update, context)
@@ -315,10 +504,11 @@ async def button_handler(update, context):
         if not user_selection:
             await query.edit_message_text("No channels selected!")
         else:
-            selected_list = "\n".join(user_selection)
+            selected_list = "\n".join(chat_registry.title(selected_chat) for selected_chat in user_selection)
             await query.edit_message_text(f"✅ Selected Channels:\n{selected_list}")
 
 
+@instrument_handler
 async def selected_channels(update, context):
     chat_id = update.message.chat_id
     selected_channels = context.user_data.get(chat_id, set())
@@ -327,11 +517,30 @@ async def selected_channels(update, context):
         await context.bot.send_message(chat_id, "Woops, no channels selected.")
         return
 
-    await context.bot.send_message(chat_id, " ".join([s for s in selected_channels]))
+    await context.bot.send_message(chat_id, "\n".join(chat_registry.title(channel) for channel in selected_channels))
+
+
+tag_index = TagIndex()
+# Keyword and semantic index behind /search, embedding new messages in the background
+# with the same spaCy vectors as the tag vocabulary, so the model is loaded once
+search_index = SearchIndexer(repo, tag_index.embed)
 
 
-previous_tags = [] 
+async def stored_chat_ids():
+    # Read from MongoDB, so compaction never waits for the chat registry to load
+    return [chat["_id"] for chat in await repo.all_chats()]
 
+
+# Rolls raw messages past the retention period into the Archive and lets them expire
+retention = RetentionJob(repo, stored_chat_ids, functools.partial(summary_engine.summarize_window, background=True),
+                         on_expired=search_index.vectors.discard)
+
+
+tag_cache = TagCache(backing=functools.partial(repo.find_tags_by_hashes, exclude_tag=FALLBACK_TAG))
+write_buffer = WriteBuffer(repo.insert_many)
+
+
+@instrument_handler
 async def store_channel_message(update, context):
     """
     Stores new messages from channels and groups in MongoDB.
@@ -350,53 +559,72 @@ async def store_channel_message(update, context):
         else:
             return  # Ignore other types of messages
 
+        # Registers new chats and picks up renamed ones
+        await chat_registry.observe(update.effective_chat)
+
         chat_name = update.effective_chat.title
         chat_id = update.effective_chat.id  # Store the chat ID
         text = post.text or post.caption or ""
         date = post.date
 
-        # Tag the message
-        tag = tag_message(text, previous_tags)
-
-        # Build the document for MongoDB
+        # Build the document for MongoDB. Unless the same text was tagged before,
+        # the tag is filled in later by the tagging workers.
         doc = {
             "chat_name": chat_name,
             "chat_id": chat_id,  # New field: chat ID
             "chat_type": chat_type,
             "sender": sender,
             "text": text,
+            "text_hash": text_hash(text),
             "date": date,
-            "tag": tag
         }
 
-        # Update tags if it's new
-        if tag not in previous_tags:
-            previous_tags.append(tag)
-
-        # Insert the document into the MongoDB collection
-        result = collection.insert_one(doc)
+        # Memory only; copies tagged before this process started are found by the tagging workers
+        tag = tag_cache.lookup(text)
+        if tag is not None:
+            doc["tag"] = tag
+
+        # Queue the document for the next bulk insert into the MongoDB collection
+        doc_id = await write_buffer.add(doc)
+        summary_engine.note_message(chat_id, date)
+        search_index.submit(doc_id, chat_id, text)
+        if tag is not None:
+            tag_stats.record(chat_id, tag, date)
+        else:
+            tag_stats.expect(doc_id, chat_id, date)
 
         logger.info(
-            "Inserted new message from %s (ID: %s) into MongoDB with _id=%s",
-            chat_name, chat_id, result.inserted_id
+            "Buffered new message from %s (ID: %s) for MongoDB with _id=%s",
+            chat_name, chat_id, doc_id
         )
 
+        if tag is None:
+            await tagging_queue.submit(doc_id, text)
+
+
+async def save_tag(doc_id, text, tag):
+    """Writes a tag produced by the tagging workers back to its message."""
+    if not await write_buffer.patch(doc_id, {"tag": tag}):
+        await repo.set_tag(doc_id, tag)
+    tag_stats.tagged(doc_id, tag)
 
+    if tag != FALLBACK_TAG:
+        tag_cache.put(text, tag)
 
-def tag_message(message, previous_tags=None):
+
+async def tag_message(message, tag_index=None):
     """
     Tags a text message with a relevant topic using Gemini.
 
     Args:
         message (str): The text message to tag.
-        previous_tags (list[str], optional): A list of previously used tags. Defaults to None.
+        tag_index (TagIndex, optional): Vocabulary of previously used tags. A similar known
+            tag is reused instead of the fresh one. Defaults to None.
 
     Returns:
         str: The chosen tag, or "unknown" if no topic is clear.
     """
 
-    final = ""
-
     prompt_1 = f"""
     You are a helpful assistant for tagging text messages. Students in a university are busy and need information at a glance.
     Given the following text message, generate the BEST topic tag that would match the content of the message.
@@ -406,29 +634,129 @@ def tag_message(message, previous_tags=None):
     Return ONLY a single topic, do not add any other text.
     """
 
-    first_response = model.generate_content(prompt_1).text.strip()
+    first_response = await generate_text(prompt_1, priority=BACKGROUND)
+
+    # Merge with a similar previously generated tag locally, no second prompt needed
+    if tag_index is not None:
+        return await asyncio.to_thread(tag_index.reconcile, first_response) or "unknown"
+    return first_response or "unknown"
 
 
-    # If the first response is not clear, ask for more information
-    if previous_tags:
-        prompt_2 = f"""
-        If the tag "{first_response}" is similar to any of the following previously generated tags: {', '.join(previous_tags) if previous_tags else ""}, use the previous tag that is most similar to the content of the message. Otherwise, keep {first_response}. 
-        Return ONLY the final single topic, do not add any other text. 
-        """
+async def tag_messages_batch(messages, tag_index=None):
+    """
+    Tags several text messages with a single Gemini call.
 
+    Args:
+        messages (list[str]): The text messages to tag.
+        tag_index (TagIndex, optional): Vocabulary of previously used tags. Defaults to None.
 
-        second_response = model.generate_content(prompt_2).text.strip()
-        final = second_response
-    else:
-        final = first_response
+    Returns:
+        list[str | None]: One tag per message, None where the response could not be parsed.
+    """
+
+    numbered = "\n".join(f"{i}. {json.dumps(message)}" for i, message in enumerate(messages))
+    previous_tags = tag_index.tags if tag_index is not None else []
 
+    prompt = f"""
+    You are a helpful assistant for tagging text messages. Students in a university are busy and need information at a glance.
+    For each of the numbered text messages below, generate the BEST topic tag that would match its content.
+    Reuse one of these existing tags whenever a message fits it: {', '.join(previous_tags) if previous_tags else "none yet"}
+
+    Text messages:
+    {numbered}
+
+    Return ONLY a JSON array of {len(messages)} objects of the form {{"id": <message number>, "tag": "<single topic>"}}, do not add any other text.
+    """
+
+    response = await generate_text(prompt, priority=BACKGROUND)
+    tags = parse_batch_tags(response, len(messages))
+    if tag_index is not None:
+        tags = await asyncio.to_thread(tag_index.reconcile_many, tags)
+    return tags
+
+
+def parse_batch_tags(response, count):
+    """Parses the JSON array returned for a batch prompt into a list of `count` tags (None if missing)."""
+    tags = [None] * count
+
+    start, end = response.find("["), response.rfind("]")
+    if start == -1 or end < start:
+        return tags
     try:
-        print(final)
-        return final
-    except Exception as e:
-       print(f"An error occurred: {e}")
-       return "unknown"
+        entries = json.loads(response[start:end + 1])
+    except ValueError:
+        return tags
+
+    for position, entry in enumerate(entries):
+        if isinstance(entry, dict):
+            index, tag = entry.get("id"), entry.get("tag")
+        else:
+            index, tag = position, entry
+        if isinstance(index, int) and 0 <= index < count and isinstance(tag, str) and tag.strip():
+            tags[index] = tag.strip()
+    return tags
+
+
+# Tagged locally when the distilled classifier is confident, by Gemini otherwise
+tag_classifier = LocalTagClassifier()
+
+tagging_queue = TaggingQueue(
+    functools.partial(tag_message, tag_index=tag_index),
+    save_tag,
+    batch_fn=functools.partial(tag_messages_batch, tag_index=tag_index),
+    local_fn=tag_classifier.classify,
+    cached_fn=tag_cache.lookup_stored,
+)
 
+metrics.gauge("tagging_queue_depth", tagging_queue.depth, "Messages waiting to be tagged")
+metrics.gauge("write_buffer_pending", lambda: write_buffer.stats()["pending"], "Messages waiting for the next bulk insert")
+metrics.gauge("search_index_depth", search_index.depth, "Messages waiting to be embedded for search")
+metrics.gauge("search_index_vectors", lambda: len(search_index.vectors), "Messages searchable by meaning")
+metrics.gauge("digest_subscriptions", lambda: len(digests), "Users subscribed to a daily digest")
+metrics.gauge("retention_archived_days", lambda: retention.stats()["archived_days"], "Chat days archived and set to expire")
+metrics.gauge("tag_stats_pending", lambda: tag_stats.stats()["pending"], "Tag counters waiting for the next flush")
+loop_lag = LoopLagMonitor()
+# Prometheus endpoint, only when METRICS_PORT is set
+metrics_http = metrics_server() if METRICS_PORT else None
+
+startup.mark("services")
+
+
+@instrument_handler
+async def show_queue(update, context):
+    """Shows how many messages are waiting to be tagged."""
+    stats = tagging_queue.stats()
+    await update.message.reply_text(
+        f"Tagging queue: {stats['depth']}/{stats['maxsize']} pending, {stats['workers']} workers\n"
+        f"Processed: {stats['processed']}, failed: {stats['failed']}, dropped: {stats['dropped']}, "
+        f"producers blocked: {stats['blocked']}\n"
+        f"Batches: {stats['batches']}, per-message fallbacks: {stats['batch_fallbacks']}\n"
+        f"Local classifier: {stats['local']} tagged, {stats['escalated']} escalated to Gemini"
+    )
+
+    scheduler = llm.stats()
+    await update.message.reply_text(
+        f"Gemini scheduler: {scheduler['queued']} queued, circuit {scheduler['circuit']}\n"
+        f"Requests: {scheduler['requests']}, succeeded: {scheduler['succeeded']}, retries: {scheduler['retries']}, "
+        f"failed: {scheduler['failed']}, rejected: {scheduler['rejected']}"
+    )
+
+    buffer = write_buffer.stats()
+    await update.message.reply_text(
+        f"Write buffer: {buffer['pending']}/{buffer['maxsize']} pending\n"
+        f"Flushes: {buffer['flushes']}, written: {buffer['written']}, retries: {buffer['retries']}, "
+        f"failed: {buffer['failed']}"
+    )
+
+    cache = tag_cache.stats()
+    await update.message.reply_text(
+        f"Tag cache: {cache['size']}/{cache['maxsize']} entries\n"
+        f"Hits: {cache['hits']} (near-duplicate: {cache['near_hits']}), stored: {cache['backing_hits']}, "
+        f"misses: {cache['misses']}, evictions: {cache['evictions']}"
+    )
+
+
+@instrument_handler
 async def show_tags(update, context):
     """Fetch all tags from the user's selected groups and channels, and display them as buttons."""
     chat_id = update.message.chat_id
@@ -440,26 +768,76 @@ async def show_tags(update, context):
         await update.message.reply_text("You have not selected any groups or channels to track tags.")
         return
 
-    # Segregate into groups and channels
-    selected_groups = [chat.split("_", 1)[1] for chat in selected_chats if chat.startswith("group_")]
-    selected_channels = [chat.split("_", 1)[1] for chat in selected_chats if chat.startswith("channel_")]
 
-    # Fetch unique tags for the selected groups and channels
-    tags = collection.distinct("tag", {"chat_name": {"$in": selected_groups + selected_channels}})
+    # Rank the tags of the selected groups and channels from the precomputed counters
+    tags = await tag_stats.top(selected_chats)
     if not tags:
-        await update.message.reply_text("No tags found for the selected groups or channels.")
+        await update.message.reply_text(f"No tagged messages in the selected groups or channels in the last {TAG_STATS_DAYS} days.")
         return
 
-    # Create inline buttons for each tag
-    keyboard = [[InlineKeyboardButton(tag, callback_data=f"tag_{tag}")] for tag in tags]
+    # Create inline buttons for each tag, busiest first
+    keyboard = [[InlineKeyboardButton(f"{tag} ({count})", callback_data=f"tag_{tag}")] for tag, count in tags]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text("Select a tag to view related messages:", reply_markup=reply_markup)
+    await update.message.reply_text(f"Select a tag to view related messages (messages in the last {TAG_STATS_DAYS} days):",
+                                    reply_markup=reply_markup)
+
+
+
+def format_message(msg):
+    """Formats a stored message for a page of tag browsing or search results, in Markdown."""
+    # Group or channel name, as currently titled
+    chat_title = chat_registry.title(msg.get("chat_id"), msg.get("chat_name", "Unknown"))
+    group_or_channel = f"📢 *{escape_markdown(chat_title)}*"
+    sender = f"👤 {escape_markdown(msg.get('sender', 'Unknown'))}"  # Sender's name
+    text = msg.get("text") or "No text available"
+    if len(text) > TAG_PAGE_TEXT_CHARS:
+        text = text[:TAG_PAGE_TEXT_CHARS] + "…"
+    date = f"📅 {msg['date'].strftime('%Y-%m-%d %H:%M:%S')}" if "date" in msg else ""
+
+    return f"{group_or_channel} | {sender}\n📝 {escape_markdown(text)}\n{date}\n\n"
+
 
+def remember_page(context, kind, message_id, state):
+    """Keeps the state behind a paginated message's buttons, for the most recent TAG_PAGES_KEPT messages."""
+    pages = context.user_data.setdefault(kind, {})
+    pages.pop(message_id, None)
+    pages[message_id] = state
+    while len(pages) > TAG_PAGES_KEPT:
+        pages.pop(next(iter(pages)))
 
 
+def render_tag_page(tag, messages, has_newer, has_older):
+    """
+    Formats a page of tagged messages.
+
+    Returns:
+        tuple[str, InlineKeyboardMarkup | None]: The Markdown text and the Newer/Older buttons.
+    """
+    response = f"Messages for tag: *{escape_markdown(tag)}*\n\n"
+    response += "".join(format_message(msg) for msg in messages)
+
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("⬅️ Newer", callback_data="tagpage_newer"))
+    if has_older:
+        buttons.append(InlineKeyboardButton("Older ➡️", callback_data="tagpage_older"))
+    return response, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def remember_tag_page(context, message_id, tag, chat_ids, messages):
+    """Keeps the keyset cursors of the page a message shows, for its Newer/Older buttons."""
+    remember_page(context, "tag_pages", message_id, {
+        "tag": tag,
+        "chat_ids": chat_ids,
+        "newest": (messages[0]["date"], messages[0]["_id"]),
+        "oldest": (messages[-1]["date"], messages[-1]["_id"]),
+    })
+
+
+@instrument_handler
 async def show_messages_for_tag(update, context):
-    """Fetch and display messages that match the selected tag."""
+    """Shows the newest page of messages that match the selected tag."""
     query = update.callback_query
     await query.answer()
 
@@ -473,54 +851,303 @@ async def show_messages_for_tag(update, context):
         await query.message.reply_text("No groups or channels selected to fetch messages.")
         return
 
-    # Segregate into groups and channels
-    selected_groups = [chat.split("_", 1)[1] for chat in selected_chats if chat.startswith("group_")]
-    selected_channels = [chat.split("_", 1)[1] for chat in selected_chats if chat.startswith("channel_")]
+    # Fetch the first page from MongoDB for the selected tag
+    chat_ids = list(selected_chats)
+    messages, has_older = await repo.tag_page(tag, chat_ids, limit=TAG_PAGE_SIZE)
 
-    # Fetch messages from MongoDB for the selected tag
-    messages = (
-        collection.find({"tag": tag, "chat_name": {"$in": selected_groups + selected_channels}})
-        .sort("date", -1)
-        .limit(50)  # Limit to 50 messages
-    )
+    if not messages:
+        await query.message.reply_text(f"No messages found for tag: {tag}.")
+        return
 
-    message_list = list(messages)
+    text, reply_markup = render_tag_page(tag, messages, False, has_older)
+    sent = await query.message.reply_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+    remember_tag_page(context, sent.message_id, tag, chat_ids, messages)
 
-    if not message_list:
-        await query.message.reply_text(f"No messages found for tag: {tag}.")
+
+@instrument_handler
+async def turn_tag_page(update, context):
+    """Edits a tag browsing message in place to show the next older or newer page."""
+    query = update.callback_query
+    direction = query.data.split("_", 1)[1]
+    message_id = query.message.message_id
+
+    page = context.user_data.get("tag_pages", {}).get(message_id)
+    if page is None:
+        await query.answer("This list has expired, pick the tag again from /tags.")
+        return
+
+    if direction == "older":
+        messages, has_older = await repo.tag_page(page["tag"], page["chat_ids"], before=page["oldest"],
+                                                  limit=TAG_PAGE_SIZE)
+        has_newer = True
+    else:
+        messages, has_newer = await repo.tag_page(page["tag"], page["chat_ids"], after=page["newest"],
+                                                  limit=TAG_PAGE_SIZE)
+        has_older = True
+
+    if not messages:
+        await query.answer(f"No {direction} messages.")
+        return
+    await query.answer()
+
+    text, reply_markup = render_tag_page(page["tag"], messages, has_newer, has_older)
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+    remember_tag_page(context, message_id, page["tag"], page["chat_ids"], messages)
+
+
+
+
+async def render_search_page(search_query, results, offset):
+    """
+    Formats one page of ranked search results, fetching only the messages on it.
+
+    Returns:
+        tuple[str, InlineKeyboardMarkup | None]: The Markdown text and the Previous/Next buttons.
+    """
+    page_ids = results[offset:offset + SEARCH_PAGE_SIZE]
+    messages = await repo.messages_by_ids(page_ids)
+
+    response = (f"Results {offset + 1}-{offset + len(page_ids)} of {len(results)} "
+                f"for: *{escape_markdown(search_query)}*\n\n")
+    # Keep the ranking; messages deleted since the search are skipped
+    response += "".join(format_message(messages[doc_id]) for doc_id in page_ids if doc_id in messages)
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data="searchpage_previous"))
+    if offset + SEARCH_PAGE_SIZE < len(results):
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data="searchpage_next"))
+    return response, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@instrument_handler
+async def search(update, context):
+    """Searches the messages of the selected groups and channels by keywords and meaning."""
+    chat_id = update.message.chat_id
+    selected_chats = context.user_data.get(chat_id, set())
+
+    if not selected_chats:
+        await update.message.reply_text("You have not selected any groups or channels to search.")
+        return
+
+    search_query = " ".join(context.args).strip()
+    if not search_query:
+        await update.message.reply_text("Usage: /search <words to look for>")
+        return
+
+    results = await search_index.search(search_query, list(selected_chats))
+    if not results:
+        await update.message.reply_text(f"No messages found for: {search_query}")
+        return
+
+    text, reply_markup = await render_search_page(search_query, results, 0)
+    sent = await update.message.reply_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+    remember_page(context, "search_pages", sent.message_id, {"query": search_query, "results": results, "offset": 0})
+
+
+@instrument_handler
+async def turn_search_page(update, context):
+    """Edits a search results message in place to show the next or previous page."""
+    query = update.callback_query
+    message_id = query.message.message_id
+
+    page = context.user_data.get("search_pages", {}).get(message_id)
+    if page is None:
+        await query.answer("These results have expired, run /search again.")
+        return
+    await query.answer()
+
+    step = SEARCH_PAGE_SIZE if query.data == "searchpage_next" else -SEARCH_PAGE_SIZE
+    offset = min(max(0, page["offset"] + step), max(0, len(page["results"]) - 1))
+    text, reply_markup = await render_search_page(page["query"], page["results"], offset)
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+    remember_page(context, "search_pages", message_id, {**page, "offset": offset})
+
+
+def is_admin(update):
+    return update.effective_user is not None and update.effective_user.id in ADMIN_USER_IDS
+
+
+@instrument_handler
+async def explain_queries(update, context):
+    """Admin only: explains every handler query and reports whether it uses an index."""
+    if not is_admin(update):
+        await update.message.reply_text("This command is only available to admins.")
+        return
+
+    sample = await repo.latest_tagged_message()
+    if sample is None:
+        await update.message.reply_text("No tagged messages stored yet, nothing to explain.")
+        return
+    if context.args and context.args[0].lstrip("-").isdigit():
+        chat_id = int(context.args[0])
+    else:
+        chat_id = sample.get("chat_id")
+
+    plans = await repo.explain_queries(chat_id, sample["tag"], datetime.now() - timedelta(hours=24))
+
+    lines = [f"Query plans for chat {chat_registry.title(chat_id, chat_id)} and tag {sample['tag']}:"]
+    for plan in plans:
+        verdict = "covered" if plan["covered"] else "COLLSCAN" if plan["collection_scan"] else "indexed"
+        if plan["in_memory_sort"]:
+            verdict += ", in-memory sort"
+        lines.append(
+            f"\n{plan['name']}: {verdict}\n"
+            f"  {' <- '.join(plan['stages'])} via {', '.join(plan['indexes']) or 'no index'}\n"
+            f"  keys examined {plan['keys_examined']}, docs examined {plan['docs_examined']}, returned {plan['returned']}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+
+@instrument_handler
+async def show_stats(update, context):
+    """Admin only: latency percentiles of handlers, Gemini and MongoDB, event loop lag and queue depths."""
+    if not is_admin(update):
+        await update.message.reply_text("This command is only available to admins.")
         return
 
-    # Format and display the messages
-    response = f"Messages for tag: **{tag}**\n\n"
-    for msg in message_list:
-        group_or_channel = f"📢 *{msg.get('chat_name', 'Unknown')}*"  # Group or channel name
-        sender = f"👤 {msg.get('sender', 'Unknown')}"  # Sender's name
-        text = f"📝 {msg.get('text', 'No text available')}"  # Message text
-        date = f"📅 {msg.get('date', '').strftime('%Y-%m-%d %H:%M:%S')}" if 'date' in msg else ""
+    text = "\n".join(metrics.summary()) or "No metrics recorded yet."
+    for offset in range(0, len(text), 4000):
+        await update.message.reply_text(text[offset:offset + 4000])
+
+
+async def check_mongo():
+    await repo.connect()
+    await repo.ping()
+    logger.info("Pinged your deployment. You successfully connected to MongoDB!")
+    await repo.ensure_indexes()
+    if not await repo.tag_stats_built():
+        # Counting the stored history can outlast the check timeout, so it runs on its own
+        startup_tasks.append(asyncio.create_task(rebuild_tag_stats(), name="tag-stats-rebuild"))
+
+
+async def rebuild_tag_stats():
+    # Until this completes, /tags only counts messages tagged since the first deploy with tag statistics
+    try:
+        await repo.rebuild_tag_stats()
+        logger.info("Built tag statistics from the stored messages")
+    except Exception as e:
+        logger.error("Could not build tag statistics, retrying on the next start: %s", e)
+
+
+async def load_tag_vocabulary():
+    # Seed the tag vocabulary with the tags already stored, so merging survives restarts
+    known_tags = await repo.distinct_tags()
+    await asyncio.to_thread(tag_index.add_many, known_tags)
+    logger.info("Loaded %d known tags", len(tag_index))
+
+
+async def load_chat_registry():
+    # Restore the chats the bot was added to before this run
+    count = await chat_registry.load()
+    logger.info("Loaded %d registered chats", count)
+
+
+def startup_checks(bot=None):
+    """Health checks and warm-ups that run in the background once the bot is taking updates."""
+    checks = {"mongodb": check_mongo, "chat registry": load_chat_registry, "tag vocabulary": load_tag_vocabulary}
+    if bot is not None:
+        # Delivers through this bot; the scheduler loads the subscriptions itself
+        checks["digests"] = functools.partial(digests.start, functools.partial(send_digest, bot))
+    if token_counter.name:
+        # Prompts are budgeted by an estimate until the tokenizer is loaded
+        checks["prompt tokenizer"] = functools.partial(asyncio.to_thread, token_counter.load)
+    if STARTUP_WARMUP:
+        checks.update({
+            "gemini client": functools.partial(asyncio.to_thread, model.load),
+            "tag embeddings": functools.partial(asyncio.to_thread, tag_index.embed, ["warm up"]),
+            "tag classifier": functools.partial(tag_classifier.classify, ["warm up"]),
+        })
+    return checks
 
-        # Append each message to the response
-        response += f"{group_or_channel} | {sender}\n{text}\n{date}\n\n"
 
-        # Handle Telegram's message length limit
-        if len(response) > 3800:
-            await query.message.reply_text(response[:4000], parse_mode="Markdown")
-            response = ""  # Reset response to handle overflow
+# Loads that only work once the mongodb check has connected and created the indexes
+STARTUP_CHECK_ORDER = {"chat registry": "mongodb", "tag vocabulary": "mongodb"}
 
-    if response:  # Send any remaining messages
-        await query.message.reply_text(response[:4000], parse_mode="Markdown")
+startup_tasks = []
 
 
+async def note_first_update(update, context):
+    startup.first_update()
+
+
+async def on_startup(application):
+    startup.mark("application initialized")
+
+    try:
+        # Only resolves the deployment's hosts, in a thread; the first queries open the connections
+        await repo.connect()
+    except Exception as e:
+        # Queries raise ConnectionFailure until the mongodb startup check manages to connect
+        logger.error("Could not create the MongoDB client: %s", e)
+    startup.mark("mongodb client")
+
+    await llm.start()
+    await write_buffer.start()
+    await tag_stats.start()
+    await search_index.start()
+    tag_classifier.start()
+    await tagging_queue.start()
+    await summary_engine.start()
+    await retention.start()
+    await loop_lag.start()
+    if metrics_http is not None:
+        await metrics_http.start()
+
+    # Nothing above waits on a server; checks and model loading finish after polling starts
+    bot = application.bot if application is not None else None
+    startup_tasks.append(asyncio.create_task(run_checks(startup_checks(bot), startup, after=STARTUP_CHECK_ORDER), name="startup-checks"))
+    startup.ready()
+
+
+async def on_shutdown(application):
+    for task in startup_tasks:
+        task.cancel()
+    await asyncio.gather(*startup_tasks, return_exceptions=True)
+    if metrics_http is not None:
+        await metrics_http.stop()
+    await loop_lag.stop()
+    await digests.stop()
+    await retention.stop()
+    await search_index.stop()
+    await summary_engine.stop()
+    # Let pending tags land in the buffer before the final flush
+    await tagging_queue.stop()
+    tag_classifier.stop()
+    await llm.stop()
+    await write_buffer.stop()
+    await tag_stats.stop()
+    await repo.close()
 
 
 # Add these handlers to the bot
 
 if __name__ == "__main__":
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        # Different chats and interactive commands run in parallel, each chat's messages stay in order
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_MODE == "webhook":
+        # Updates arrive through our own webhook server instead of the polling updater
+        builder = builder.updater(None)
+    application = builder.build()
     application.add_handler(CommandHandler("help", help))
     application.add_handler(CommandHandler("tags", show_tags))
     application.add_handler(CommandHandler("tags", show_tags))
     application.add_handler(CommandHandler("briefing", briefing))
+    application.add_handler(CommandHandler("search", search))
+    application.add_handler(CommandHandler("digest", digest))
+    application.add_handler(CommandHandler("history", history))
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("queue", show_queue))
+    application.add_handler(CommandHandler("explain", explain_queries))
+    application.add_handler(CommandHandler("stats", show_stats))
+    # Only records the time to the first update for the startup profile
+    application.add_handler(TypeHandler(Update, note_first_update), group=-1)
 
     # Keep track of which chats the bot is in
     application.add_handler(ChatMemberHandler(track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
@@ -528,6 +1155,8 @@ if __name__ == "__main__":
     application.add_handler(CommandHandler("selected", selected_channels))
     application.add_handler(CallbackQueryHandler(fetch_briefing, pattern="^briefing_"))
     application.add_handler(CallbackQueryHandler(show_messages_for_tag, pattern="^tag_"))
+    application.add_handler(CallbackQueryHandler(turn_tag_page, pattern="^tagpage_"))
+    application.add_handler(CallbackQueryHandler(turn_search_page, pattern="^searchpage_"))
     application.add_handler(CallbackQueryHandler(button_handler))
 
     application.add_handler(CommandHandler("tags", show_tags))
@@ -539,4 +1168,7 @@ if __name__ == "__main__":
     # General message handler without any filters
     application.add_handler(MessageHandler(filters.ALL, store_channel_message))
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        asyncio.run(serve_webhook(application, allowed_updates=Update.ALL_TYPES))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,94 @@
+"""
+Briefing result cache.
+
+Briefings are keyed on (chat, option, newest stored message), so identical requests are
+served instantly and a new message in the chat automatically makes the old entry
+unreachable. Concurrent identical requests share a single generation.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+BRIEFING_CACHE_SIZE = int(os.getenv("BRIEFING_CACHE_SIZE", "256"))
+# Time-window briefings also change as old messages fall out of the window
+BRIEFING_CACHE_TTL = float(os.getenv("BRIEFING_CACHE_TTL", "600"))
+
+
+class BriefingCache:
+    """
+    LRU + TTL cache of generated briefings with in-flight request coalescing.
+
+    Args:
+        newest_marker (callable): Coroutine function taking a chat and returning something that
+            changes whenever a message is added to it, e.g. the newest message's _id.
+        maxsize (int): Maximum number of cached briefings.
+        ttl (float): Seconds a briefing stays valid.
+    """
+
+    def __init__(self, newest_marker, maxsize=BRIEFING_CACHE_SIZE, ttl=BRIEFING_CACHE_TTL):
+        self.newest_marker = newest_marker
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # key -> (briefing, expires_at)
+        self._inflight = {}  # key -> future of the briefing being generated
+        self._counters = {"hits": 0, "coalesced": 0, "misses": 0}
+
+    async def get_or_create(self, chat, option, generate):
+        """
+        Returns the cached briefing for (chat, option), generating it if needed.
+
+        Args:
+            chat (str): The chat being summarized.
+            option (str): The briefing option, e.g. "24h" or "100".
+            generate (callable): Coroutine function producing the briefing. Empty results and
+                errors are not cached; errors propagate to every waiting caller.
+        """
+        key = (chat, option, await self.newest_marker(chat))
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return entry[0]
+
+        if key in self._inflight:
+            self._counters["coalesced"] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self._counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            briefing = await generate()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(briefing)
+            if briefing:
+                self._store(key, briefing)
+            return briefing
+        finally:
+            del self._inflight[key]
+
+    def _store(self, key, briefing):
+        # Entries for an older newest message of the same chat can never be hit again
+        for stale in [other for other in self._entries if other[:2] == key[:2]]:
+            del self._entries[stale]
+
+        self._entries[key] = (briefing, time.monotonic() + self.ttl)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"size": len(self._entries), "inflight": len(self._inflight), **self._counters}
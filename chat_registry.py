@@ -0,0 +1,108 @@
+"""
+Registry of the chats the bot is in.
+
+Chat membership and titles are persisted in the Chats collection and mirrored in an
+in-memory index keyed by Telegram chat ID, so handlers resolve a selection to its title
+and type without a query and every message query can filter on the indexed chat_id.
+The index is loaded at startup and kept current from my_chat_member updates and from the
+titles seen on incoming messages, so a renamed chat keeps its history.
+"""
+import logging
+
+from summaries import utcnow
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "channel"
+GROUP_TYPES = ("group", "supergroup")
+
+
+def chat_title(chat):
+    """Returns a display title for a telegram.Chat, including private chats."""
+    return chat.title or chat.full_name or chat.username or str(chat.id)
+
+
+class ChatRegistry:
+    """
+    In-memory index of registered chats, written through to MongoDB.
+
+    Args:
+        repo (MessageRepository): Storage for the Chats collection.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._chats = {}  # chat id -> {"title", "type", "is_member", "updated_at"}
+
+    def __len__(self):
+        return len(self._chats)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chats
+
+    async def load(self):
+        """
+        Loads every registered chat into the index and backfills chat_id on messages stored
+        before it was recorded.
+
+        Returns:
+            int: The number of registered chats.
+        """
+        chats = {doc.pop("_id"): doc for doc in await self.repo.all_chats()}
+        # Registrations that arrived while we were loading are newer than the stored ones
+        chats.update(self._chats)
+        self._chats = chats
+
+        for chat_id, chat in chats.items():
+            if chat["type"] == CHANNEL or chat["type"] in GROUP_TYPES:
+                updated = await self.repo.backfill_chat_id(chat["title"], chat_id)
+                if updated:
+                    logger.info("Backfilled chat_id on %d messages of %s", updated, chat["title"])
+        return len(chats)
+
+    def get(self, chat_id):
+        """Returns the metadata of a chat, or None if it is not registered."""
+        return self._chats.get(chat_id)
+
+    def title(self, chat_id, default="Unknown"):
+        chat = self._chats.get(chat_id)
+        return chat["title"] if chat else default
+
+    def chats(self, types=None, members_only=True):
+        """
+        Lists registered chats.
+
+        Args:
+            types (tuple[str], optional): Chat types to include, e.g. GROUP_TYPES. Defaults to all.
+            members_only (bool): Leave out chats the bot was removed from.
+
+        Returns:
+            list[tuple[int, dict]]: (chat id, metadata) pairs, sorted by title.
+        """
+        return sorted(
+            ((chat_id, chat) for chat_id, chat in self._chats.items()
+             if (types is None or chat["type"] in types) and (chat["is_member"] or not members_only)),
+            key=lambda item: item[1]["title"].lower(),
+        )
+
+    async def set_membership(self, chat, is_member):
+        """Registers that the bot joined or left a chat."""
+        await self._save(chat.id, {"title": chat_title(chat), "type": chat.type, "is_member": is_member})
+
+    async def observe(self, chat):
+        """
+        Registers the chat of an incoming message, or updates its title if it was renamed.
+        Costs one dict lookup for a known chat with an unchanged title.
+        """
+        known = self._chats.get(chat.id)
+        title = chat_title(chat)
+        if known is not None and known["title"] == title and known["is_member"]:
+            return
+        if known is not None and known["title"] != title:
+            logger.info("Chat %s renamed from %s to %s", chat.id, known["title"], title)
+        await self._save(chat.id, {"title": title, "type": chat.type, "is_member": True})
+
+    async def _save(self, chat_id, fields):
+        fields["updated_at"] = utcnow()
+        self._chats[chat_id] = {**self._chats.get(chat_id, {}), **fields}
+        await self.repo.save_chat(chat_id, fields)
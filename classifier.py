@@ -0,0 +1,204 @@
+"""
+Local tag classifier distilled from the tags Gemini already produced.
+
+Train it from the stored (text, tag) pairs with
+
+    python classifier.py --output models/tag_classifier
+
+and point TAG_CLASSIFIER_PATH at the output directory. At runtime the spaCy textcat model
+runs in a process pool; only messages it is unsure about still go to Gemini.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+TAG_CLASSIFIER_PATH = os.getenv("TAG_CLASSIFIER_PATH", "")
+TAG_CLASSIFIER_WORKERS = int(os.getenv("TAG_CLASSIFIER_WORKERS", "2"))
+# Predictions below this probability are escalated to Gemini
+TAG_CLASSIFIER_THRESHOLD = float(os.getenv("TAG_CLASSIFIER_THRESHOLD", "0.8"))
+
+METRICS_FILE = "tag_classifier.json"
+
+# Loaded once per worker process by _load_worker
+_worker_nlp = None
+
+
+def _load_worker(model_dir):
+    global _worker_nlp
+    import spacy
+
+    _worker_nlp = spacy.load(model_dir)
+
+
+def _predict(texts):
+    """Runs in a worker process. Returns the best (tag, probability) for each text."""
+    predictions = []
+    for doc in _worker_nlp.pipe(texts):
+        tag, score = max(doc.cats.items(), key=lambda item: item[1]) if doc.cats else (None, 0.0)
+        predictions.append((tag, float(score)))
+    return predictions
+
+
+class LocalTagClassifier:
+    """
+    Serves a trained textcat model from a pool of worker processes.
+
+    Args:
+        model_dir (str): Directory written by `train`.
+        workers (int): Number of worker processes.
+        threshold (float): Minimum probability for a prediction to be trusted.
+    """
+
+    def __init__(self, model_dir=TAG_CLASSIFIER_PATH, workers=TAG_CLASSIFIER_WORKERS,
+                 threshold=TAG_CLASSIFIER_THRESHOLD):
+        self.model_dir = model_dir
+        self.workers = workers
+        self.threshold = threshold
+        self._pool = None
+
+    @property
+    def available(self):
+        """Whether a trained model exists at `model_dir`."""
+        return bool(self.model_dir) and os.path.isfile(os.path.join(self.model_dir, "meta.json"))
+
+    def start(self):
+        if self._pool is None and self.available:
+            # spawn keeps the workers clear of the event loop's threads and sockets
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_worker,
+                initargs=(self.model_dir,),
+            )
+            logger.info("Started %d tag classifier workers for %s", self.workers, self.model_dir)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def classify(self, texts):
+        """
+        Predicts tags for a batch of texts.
+
+        Returns:
+            list[tuple[str | None, float]]: (tag, probability) per text. The tag is None when
+                the probability is below the threshold or no model is loaded.
+        """
+        if self._pool is None:
+            return [(None, 0.0)] * len(texts)
+        loop = asyncio.get_running_loop()
+        predictions = await loop.run_in_executor(self._pool, _predict, list(texts))
+        return [(tag if score >= self.threshold else None, score) for tag, score in predictions]
+
+
+async def load_examples(repo, min_per_tag, max_per_tag, exclude=()):
+    """Reads deduplicated (text, tag) pairs for every tag with at least `min_per_tag` examples."""
+    from tag_cache import text_hash
+
+    examples = []
+    for tag, count in await repo.tag_counts(exclude=exclude):
+        if count < min_per_tag:
+            continue
+        seen = set()
+        async for doc in repo.stream_texts_by_tag(tag, limit=max_per_tag):
+            text = (doc.get("text") or "").strip()
+            if text and text_hash(text) not in seen:
+                seen.add(text_hash(text))
+                examples.append((text, tag))
+    return examples
+
+
+def train(examples, output_dir, epochs=10, dev_fraction=0.1, seed=0):
+    """
+    Trains an exclusive textcat pipeline and saves it with its dev-set metrics.
+
+    Args:
+        examples (list[tuple[str, str]]): (text, tag) pairs.
+        output_dir (str): Where to save the model.
+        epochs (int): Passes over the training data.
+        dev_fraction (float): Share of examples held out for evaluation.
+
+    Returns:
+        dict: Labels and dev-set accuracy.
+    """
+    import spacy
+    from spacy.training import Example
+    from spacy.util import minibatch
+    from thinc.api import compounding
+
+    random.seed(seed)
+    labels = sorted({tag for _, tag in examples})
+    if len(labels) < 2:
+        raise ValueError("Need at least two tags with enough examples to train a classifier")
+
+    nlp = spacy.blank("en")
+    textcat = nlp.add_pipe("textcat")
+    for label in labels:
+        textcat.add_label(label)
+
+    data = [
+        Example.from_dict(nlp.make_doc(text), {"cats": {label: float(label == tag) for label in labels}})
+        for text, tag in examples
+    ]
+    random.shuffle(data)
+    split = max(1, int(len(data) * dev_fraction))
+    dev, train_data = data[:split], data[split:]
+
+    optimizer = nlp.initialize(lambda: train_data)
+    for epoch in range(epochs):
+        random.shuffle(train_data)
+        losses = {}
+        for batch in minibatch(train_data, size=compounding(4.0, 32.0, 1.001)):
+            nlp.update(batch, sgd=optimizer, drop=0.2, losses=losses)
+        logger.info("Epoch %d: loss %.4f", epoch + 1, losses.get("textcat", 0.0))
+
+    correct = 0
+    for example, doc in zip(dev, nlp.pipe(example.reference.text for example in dev)):
+        expected = max(example.reference.cats.items(), key=lambda item: item[1])[0]
+        correct += max(doc.cats.items(), key=lambda item: item[1])[0] == expected
+    metrics = {"labels": labels, "train_examples": len(train_data), "dev_examples": len(dev),
+               "dev_accuracy": correct / len(dev)}
+
+    nlp.to_disk(output_dir)
+    with open(os.path.join(output_dir, METRICS_FILE), "w") as f:
+        json.dump(metrics, f, indent=2)
+    return metrics
+
+
+async def main(args):
+    from repository import MessageRepository, mongo_uri
+    from tagging import FALLBACK_TAG
+
+    repo = MessageRepository(mongo_uri())
+    try:
+        await repo.connect()
+        examples = await load_examples(repo, args.min_per_tag, args.max_per_tag, exclude=[FALLBACK_TAG])
+    finally:
+        await repo.close()
+
+    logger.info("Training on %d examples", len(examples))
+    metrics = await asyncio.to_thread(train, examples, args.output, args.epochs)
+    logger.info("Saved classifier to %s: %d tags, dev accuracy %.3f",
+                args.output, len(metrics["labels"]), metrics["dev_accuracy"])
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Train the local tag classifier from stored Gemini tags.")
+    parser.add_argument("--output", default=os.getenv("TAG_CLASSIFIER_PATH") or "models/tag_classifier")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--min-per-tag", type=int, default=20, help="skip tags with fewer examples")
+    parser.add_argument("--max-per-tag", type=int, default=2000, help="newest examples used per tag")
+    asyncio.run(main(parser.parse_args()))
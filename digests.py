@@ -0,0 +1,268 @@
+"""
+Scheduled digests.
+
+Users opt in to a daily delivery time with /digest. In the DIGEST_LEAD_MINUTES before a
+delivery the scheduler summarizes every chat its subscribers selected, each chat at its own
+point in that window so the work is spread out, and at background priority so it never
+delays an on-demand briefing. A chat's summary is computed once and shared by every
+subscriber due in the same window. At delivery time the digest is assembled from the ready
+summaries and sent straight away. Subscriptions are stored in the DigestSubscriptions
+collection.
+"""
+import asyncio
+import logging
+import os
+import zlib
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# Time zone of the delivery times users enter
+DIGEST_TIMEZONE = os.getenv("DIGEST_TIMEZONE", "UTC")
+# How long before a delivery its summaries may be prepared
+DIGEST_LEAD_MINUTES = int(os.getenv("DIGEST_LEAD_MINUTES", "60"))
+# Chats summarized at the same time while preparing digests
+DIGEST_WORKERS = int(os.getenv("DIGEST_WORKERS", "2"))
+# Longest the scheduler sleeps between checks, in seconds
+DIGEST_TICK = float(os.getenv("DIGEST_TICK", "30"))
+# Seconds before a chat whose summary failed is tried again
+DIGEST_RETRY_DELAY = 300
+
+
+def parse_delivery_time(text):
+    """Parses "HH:MM" into a time, or returns None."""
+    try:
+        return datetime.strptime(text.strip(), "%H:%M").time()
+    except ValueError:
+        return None
+
+
+class DigestScheduler:
+    """
+    Prepares and delivers the daily digests of all subscribers.
+
+    Args:
+        repo (MessageRepository): Storage for the subscriptions.
+        summarize (callable): Coroutine function taking a chat ID and returning its summary,
+            or None when there is nothing to summarize.
+        lead_minutes (int): Window before a delivery in which its summaries are prepared.
+        timezone (str): IANA time zone of the delivery times.
+        workers (int): Maximum number of chats summarized at once.
+    """
+
+    def __init__(self, repo, summarize, lead_minutes=DIGEST_LEAD_MINUTES, timezone=DIGEST_TIMEZONE,
+                 workers=DIGEST_WORKERS, tick=DIGEST_TICK):
+        self.repo = repo
+        self.summarize = summarize
+        self.lead = timedelta(minutes=lead_minutes)
+        self.tz = ZoneInfo(timezone)
+        self.tick = tick
+
+        self._subscriptions = {}  # user chat id -> {"time": "HH:MM", "chat_ids": [...], "last_delivered": "YYYY-MM-DD"}
+        self._ready = {}  # chat id -> (prepared at, summary or None)
+        self._preparing = {}  # chat id -> task computing its summary
+        self._failed = {}  # chat id -> when its summary last failed
+        self._delivering = {}  # user chat id -> task sending their digest
+        self._workers = asyncio.Semaphore(workers)
+        self._deliver = None
+        self._loaded = False
+        self._task = None
+        self._counters = {"prepared": 0, "shared": 0, "prepared_late": 0, "delivered": 0, "failed": 0}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    async def start(self, deliver):
+        """
+        Starts the scheduler, which first loads the subscriptions, retrying until it can.
+
+        Args:
+            deliver (callable): Coroutine function taking (user chat id, [(chat id, summary)])
+                that sends a digest.
+        """
+        self._deliver = deliver
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="digests")
+
+    async def stop(self):
+        """Stops the scheduler and cancels the summaries and deliveries in progress."""
+        tasks = [*self._preparing.values(), *self._delivering.values()]
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def subscription(self, user_id):
+        return self._subscriptions.get(user_id)
+
+    async def subscribe(self, user_id, delivery_time, chat_ids):
+        """Subscribes a user, or updates their delivery time and chats. The first digest is the next one due."""
+        now = datetime.now(self.tz)
+        today = datetime.combine(now.date(), delivery_time, self.tz)
+        subscription = {
+            "time": delivery_time.strftime("%H:%M"),
+            "chat_ids": sorted(chat_ids),
+            # A time already passed today starts tomorrow instead of delivering right away
+            "last_delivered": now.date().isoformat() if today <= now else None,
+        }
+        self._subscriptions[user_id] = subscription
+        await self.repo.save_digest_subscription(user_id, subscription)
+        self._wake()
+
+    async def unsubscribe(self, user_id):
+        """Cancels a subscription. Returns whether there was one."""
+        if self._subscriptions.pop(user_id, None) is None:
+            return False
+        await self.repo.delete_digest_subscription(user_id)
+        return True
+
+    def next_delivery(self, subscription, now):
+        """Returns the next delivery of a subscription; it is due when not after `now`."""
+        delivery = datetime.combine(now.date(), time.fromisoformat(subscription["time"]), self.tz)
+        if subscription.get("last_delivered") == now.date().isoformat():
+            delivery += timedelta(days=1)
+        return delivery
+
+    def _wake(self):
+        # Re-plan right away, e.g. for a new subscription whose window has already started
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            self._task = asyncio.create_task(self._run(), name="digests")
+
+    async def _load(self):
+        delay = 1
+        while True:
+            try:
+                docs = await self.repo.all_digest_subscriptions()
+                break
+            except Exception as e:
+                logger.warning("Could not load digest subscriptions, retrying in %ds: %s", delay, e)
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, 60)
+        for doc in docs:
+            # Subscriptions made in the meantime are newer than the stored ones
+            self._subscriptions.setdefault(doc.pop("_id"), doc)
+        self._loaded = True
+        logger.info("Loaded %d digest subscriptions", len(self._subscriptions))
+
+    async def _run(self):
+        if not self._loaded:
+            await self._load()
+        while True:
+            try:
+                wait = self._schedule(datetime.now(self.tz))
+            except Exception:
+                logger.exception("Digest scheduling failed")
+                wait = self.tick
+            await asyncio.sleep(wait)
+
+    def _schedule(self, now):
+        """
+        Starts the preparations and deliveries that are due.
+
+        Returns:
+            float: Seconds until the next preparation or delivery is due, at most the tick.
+        """
+        next_event = now + timedelta(seconds=self.tick)
+        earliest = {}  # chat id -> earliest delivery in the lead window needing it
+
+        for user_id, subscription in self._subscriptions.items():
+            delivery = self.next_delivery(subscription, now)
+            if delivery <= now:
+                if user_id not in self._delivering:
+                    self._delivering[user_id] = asyncio.create_task(
+                        self._deliver_digest(user_id, subscription, delivery), name=f"digest-delivery-{user_id}")
+                continue
+            next_event = min(next_event, delivery)
+            if delivery - now <= self.lead:
+                for chat_id in subscription["chat_ids"]:
+                    earliest[chat_id] = min(earliest.get(chat_id, delivery), delivery)
+
+        for chat_id, delivery in earliest.items():
+            if self._fresh(chat_id, delivery) or chat_id in self._preparing:
+                continue
+            failed = self._failed.get(chat_id)
+            if failed is not None and (now - failed).total_seconds() < DIGEST_RETRY_DELAY:
+                continue
+            prepare_at = delivery - self.lead + self._offset(chat_id)
+            if prepare_at <= now:
+                self._prepare(chat_id)
+            else:
+                next_event = min(next_event, prepare_at)
+
+        # Summaries from the previous day are never shared again
+        for chat_id in [chat_id for chat_id, (prepared, _) in self._ready.items() if now - prepared > timedelta(days=1)]:
+            del self._ready[chat_id]
+        return max(0.0, (next_event - now).total_seconds())
+
+    def _offset(self, chat_id):
+        # A stable point in the first 90% of the window, different for every chat
+        return self.lead * 0.9 * (zlib.crc32(str(chat_id).encode()) / 2 ** 32)
+
+    def _fresh(self, chat_id, delivery):
+        ready = self._ready.get(chat_id)
+        return ready is not None and ready[0] >= delivery - self.lead
+
+    def _prepare(self, chat_id):
+        task = asyncio.create_task(self._summarize(chat_id), name=f"digest-{chat_id}")
+        self._preparing[chat_id] = task
+        return task
+
+    async def _summarize(self, chat_id):
+        try:
+            async with self._workers:
+                summary = await self.summarize(chat_id)
+            self._ready[chat_id] = (datetime.now(self.tz), summary)
+            self._failed.pop(chat_id, None)
+            self._counters["prepared"] += 1
+            return summary
+        except Exception as e:
+            # The chat is left out of the digests, other chats still go out
+            self._failed[chat_id] = datetime.now(self.tz)
+            logger.warning("Could not prepare the digest summary of chat %s: %s", chat_id, e)
+            return None
+        finally:
+            self._preparing.pop(chat_id, None)
+
+    async def _summary_for(self, chat_id, delivery):
+        if self._fresh(chat_id, delivery):
+            self._counters["shared"] += 1
+            return self._ready[chat_id][1]
+        task = self._preparing.get(chat_id)
+        if task is None:
+            # Not prepared in time, e.g. right after a restart
+            self._counters["prepared_late"] += 1
+            task = self._prepare(chat_id)
+        return await asyncio.shield(task)
+
+    async def _deliver_digest(self, user_id, subscription, delivery):
+        try:
+            summaries = await asyncio.gather(*(self._summary_for(chat_id, delivery)
+                                               for chat_id in subscription["chat_ids"]))
+            await self._deliver(user_id, [(chat_id, summary) for chat_id, summary
+                                          in zip(subscription["chat_ids"], summaries) if summary])
+            self._counters["delivered"] += 1
+        except asyncio.CancelledError:
+            # Shutting down: left unmarked, so the digest goes out after the restart
+            self._delivering.pop(user_id, None)
+            raise
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.error("Could not deliver the digest of %s: %s", user_id, e)
+
+        # Marked either way, so a failing delivery is not retried every tick
+        subscription["last_delivered"] = delivery.date().isoformat()
+        self._delivering.pop(user_id, None)
+        if self._subscriptions.get(user_id) is subscription:
+            try:
+                await self.repo.save_digest_subscription(user_id, subscription)
+            except Exception as e:
+                logger.warning("Could not store the delivery of %s's digest: %s", user_id, e)
+
+    def stats(self):
+        """Returns the number of subscriptions, prepared summaries and counters as a dict."""
+        return {"subscriptions": len(self._subscriptions), "ready": len(self._ready),
+                "preparing": len(self._preparing), "delivering": len(self._delivering), **self._counters}
@@ -0,0 +1,92 @@
+"""
+Minimal asyncio HTTP server.
+
+Just enough HTTP/1.1 to receive Telegram webhook POSTs and serve plain-text endpoints,
+without pulling a web framework into the bot.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPServer:
+    """
+    Serves registered routes on a host and port.
+
+    Handlers are coroutine functions taking (headers, body) and returning
+    (status, content_type, body_bytes). Header names are lowercased.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._routes = {}
+        self._server = None
+
+    def route(self, method, path, handler):
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Listening on http://%s:%d (%s)", self.host, self.port,
+                    ", ".join(f"{method} {path}" for method, path in self._routes))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            status, content_type, body = await self._respond(reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            status, content_type, body = 400, "text/plain", b"bad request"
+        except Exception:
+            logger.exception("HTTP handler failed")
+            status, content_type, body = 500, "text/plain", b"internal error"
+
+        try:
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise ValueError("malformed request line")
+        method, target, _ = request_line
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", "0"))
+        if length > MAX_BODY_SIZE:
+            return 413, "text/plain", b"payload too large"
+        body = await reader.readexactly(length) if length else b""
+
+        path = target.split("?", 1)[0]
+        handler = self._routes.get((method.upper(), path))
+        if handler is None:
+            if any(route_path == path for _, route_path in self._routes):
+                return 405, "text/plain", b"method not allowed"
+            return 404, "text/plain", b"not found"
+        return await handler(headers, body)
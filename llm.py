@@ -0,0 +1,255 @@
+"""
+Central scheduler for Gemini requests.
+
+Every prompt goes through one LLMScheduler, which keeps us under the per-minute request
+and token quotas, serves interactive briefings before background tagging, retries
+transient errors with jittered exponential backoff, and stops calling the API for a
+while (circuit breaker) once it keeps failing, so callers can degrade instead of hang.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "60"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "120000"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+# Consecutive failures that open the circuit, and seconds before a trial request is let through
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# HTTP status codes of errors worth retrying: rate limits, timeouts and server errors
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+
+def is_retryable(error):
+    """Whether a Gemini client error is transient, going by its HTTP status code."""
+    code = getattr(error, "code", None)
+    code = getattr(code, "value", code)  # google.api_core uses enums for some codes
+    return code in RETRYABLE_CODES or isinstance(error, (TimeoutError, ConnectionError))
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute, holding at most `capacity`."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount=1):
+        """Waits until `amount` units are available and takes them."""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self._level < amount:
+                await asyncio.sleep((amount - self._level) / self.rate)
+                self._refill()
+            self._level -= amount
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures, then lets one trial call through after `cooldown`."""
+
+    def __init__(self, threshold=LLM_BREAKER_THRESHOLD, cooldown=LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Gemini circuit closed again")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_running or self.failures >= self.threshold:
+            if self.opened_at is None or self._trial_running:
+                logger.warning("Gemini circuit opened after %d failures, pausing for %.0fs", self.failures, self.cooldown)
+            self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class _Job:
+    __slots__ = ("prompt", "priority", "tokens", "future", "attempt", "queued_at")
+
+    def __init__(self, prompt, priority, tokens, future):
+        self.prompt = prompt
+        self.priority = priority
+        self.tokens = tokens
+        self.future = future
+        self.attempt = 0
+        self.queued_at = time.perf_counter()
+
+
+class LLMScheduler:
+    """
+    Priority queue of prompts served by a few dispatchers under shared rate limits.
+
+    Args:
+        call (callable): Blocking function taking a prompt and returning the response text,
+            run in a worker thread.
+        count_tokens (callable): Estimates the tokens of a prompt.
+    """
+
+    def __init__(self, call, count_tokens, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=LLM_TOKENS_PER_MINUTE, concurrency=LLM_CONCURRENCY,
+                 max_retries=LLM_MAX_RETRIES, breaker=None):
+        self.call = call
+        self.count_tokens = count_tokens
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._queue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._dispatchers = []
+        self._counters = {"requests": 0, "succeeded": 0, "retries": 0, "failed": 0, "rejected": 0}
+
+        self._wait_seconds = {
+            priority: metrics.histogram("llm_queue_wait_seconds", "Time a Gemini request waited for a dispatcher",
+                                        priority=name)
+            for priority, name in ((INTERACTIVE, "interactive"), (BACKGROUND, "background"))
+        }
+        self._call_seconds = {
+            outcome: metrics.histogram("llm_call_seconds", "Gemini generate_content latency", outcome=outcome)
+            for outcome in ("ok", "error")
+        }
+        metrics.gauge("llm_queue_depth", self._queue.qsize, "Gemini requests waiting for a dispatcher")
+
+    async def start(self):
+        if not self._dispatchers:
+            self._dispatchers = [asyncio.create_task(self._dispatch(), name=f"llm-{i}") for i in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+
+        while not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            if not job.future.done():
+                job.future.cancel()
+
+    async def generate(self, prompt, priority=INTERACTIVE):
+        """
+        Queues a prompt and waits for the response text.
+
+        Args:
+            prompt (str): The prompt.
+            priority (int): INTERACTIVE requests are served before BACKGROUND ones.
+
+        Raises:
+            CircuitOpenError: If Gemini is failing and the circuit breaker is open.
+        """
+        if self.breaker.state == "open":
+            self._counters["rejected"] += 1
+            raise CircuitOpenError("Gemini is unavailable, try again later")
+
+        self._counters["requests"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(_Job(prompt, priority, self.count_tokens(prompt), future))
+        return await future
+
+    def _enqueue(self, job):
+        job.queued_at = time.perf_counter()
+        self._queue.put_nowait((job.priority, next(self._sequence), job))
+
+    async def _dispatch(self):
+        while True:
+            # Take a request slot first, so the job picked afterwards is the most urgent one
+            await self._requests.acquire()
+            _, _, job = await self._queue.get()
+            if job.future.done():
+                continue
+
+            if not self.breaker.allow():
+                self._counters["rejected"] += 1
+                job.future.set_exception(CircuitOpenError("Gemini is unavailable, try again later"))
+                continue
+
+            await self._tokens.acquire(job.tokens)
+            started = time.perf_counter()
+            self._wait_seconds[job.priority].observe(started - job.queued_at)
+            try:
+                text = await asyncio.to_thread(self.call, job.prompt)
+            except Exception as e:
+                self._call_seconds["error"].observe(time.perf_counter() - started)
+                self._failed(job, e)
+            else:
+                self._call_seconds["ok"].observe(time.perf_counter() - started)
+                self.breaker.record_success()
+                self._counters["succeeded"] += 1
+                if not job.future.done():
+                    job.future.set_result(text)
+
+    def _failed(self, job, error):
+        retryable = is_retryable(error)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            # The API answered, it just rejected this prompt
+            self.breaker.record_success()
+
+        if retryable and job.attempt < self.max_retries and not job.future.done():
+            job.attempt += 1
+            self._counters["retries"] += 1
+            delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** job.attempt) * random.uniform(0.5, 1.5)
+            logger.warning("Gemini request failed (%s), retry %d in %.1fs", error, job.attempt, delay)
+            asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+            return
+
+        self._counters["failed"] += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def stats(self):
+        """Returns queue depth, breaker state and counters as a dict."""
+        return {"queued": self._queue.qsize(), "circuit": self.breaker.state, **self._counters}
@@ -0,0 +1,229 @@
+"""
+In-process metrics.
+
+Latency histograms, counters and gauges for the hot paths: every update handler, every
+Gemini call, every MongoDB command and the event loop itself. Recording a value is a
+bisect and two increments, so instrumentation stays on in production. The data is shown
+by the admin-only /stats command and, when METRICS_PORT is set, served in the Prometheus
+text format at http://METRICS_LISTEN:METRICS_PORT/metrics.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import time
+
+from http_server import HTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+# 0 disables the HTTP endpoint; /stats works either way
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# How often the event loop lag is sampled, in seconds
+METRICS_LAG_INTERVAL = float(os.getenv("METRICS_LAG_INTERVAL", "0.5"))
+
+# Upper bounds in seconds, from a cached lookup up to a slow Gemini call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Cumulative-bucket histogram. Record from the event loop thread only."""
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating inside its bucket, like Prometheus' histogram_quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Metrics:
+    """
+    Registry of labelled metric families.
+
+    Series are created on first use and cached, so hot paths can keep a reference to the
+    Histogram or Counter they record into.
+    """
+
+    def __init__(self, prefix="telegram_bot_"):
+        self.prefix = prefix
+        self._families = {}  # name -> {"type", "help", "series": {labels: metric}}
+
+    def _series(self, kind, name, help, labels, factory):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = {"type": kind, "help": help, "series": {}}
+        key = tuple(sorted(labels.items()))
+        metric = family["series"].get(key)
+        if metric is None:
+            metric = family["series"][key] = factory()
+        return metric
+
+    def histogram(self, name, help="", **labels):
+        return self._series("histogram", name, help, labels, Histogram)
+
+    def counter(self, name, help="", **labels):
+        return self._series("counter", name, help, labels, Counter)
+
+    def gauge(self, name, read, help="", **labels):
+        """Registers a callable read whenever the metrics are reported, e.g. a queue's depth."""
+        self._series("gauge", name, help, labels, lambda: read)
+
+    def prometheus(self):
+        """Renders every family in the Prometheus text exposition format."""
+        lines = []
+        for name, family in self._families.items():
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {family['help']}")
+            lines.append(f"# TYPE {full_name} {family['type']}")
+            for key, metric in family["series"].items():
+                if family["type"] == "histogram":
+                    cumulative = 0
+                    for bound, bucket_count in zip((*metric.buckets, "+Inf"), metric.counts):
+                        cumulative += bucket_count
+                        lines.append(f"{full_name}_bucket{_labels(key, le=bound)} {cumulative}")
+                    lines.append(f"{full_name}_sum{_labels(key)} {metric.sum}")
+                    lines.append(f"{full_name}_count{_labels(key)} {metric.count}")
+                elif family["type"] == "counter":
+                    lines.append(f"{full_name}_total{_labels(key)} {metric.value}")
+                else:
+                    lines.append(f"{full_name}{_labels(key)} {_read(metric)}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Condenses every family into human-readable lines for /stats.
+
+        Returns:
+            list[str]: One line per series, histograms as count and p50/p95/p99 in ms.
+        """
+        lines = []
+        for name, family in self._families.items():
+            lines.append(f"{name}:")
+            for key, metric in sorted(family["series"].items()):
+                label = ", ".join(value for _, value in key) or "all"
+                if family["type"] == "histogram":
+                    lines.append(
+                        f"  {label}: {metric.count} calls, p50 {metric.quantile(0.5) * 1000:.1f}ms, "
+                        f"p95 {metric.quantile(0.95) * 1000:.1f}ms, p99 {metric.quantile(0.99) * 1000:.1f}ms"
+                    )
+                elif family["type"] == "counter":
+                    lines.append(f"  {label}: {metric.value}")
+                else:
+                    lines.append(f"  {label}: {_read(metric)}")
+        return lines
+
+
+def _labels(key, **extra):
+    pairs = [*key, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _read(read):
+    try:
+        return read()
+    except Exception as e:
+        logger.warning("Could not read gauge: %s", e)
+        return float("nan")
+
+
+metrics = Metrics()
+
+
+def instrument_handler(handler):
+    """Records the latency and failures of an update handler, labelled with its name."""
+    latency = metrics.histogram("handler_seconds", "Update handler latency", handler=handler.__name__)
+    errors = metrics.counter("handler_errors", "Update handlers that raised", handler=handler.__name__)
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task, i.e. how long callbacks block it."""
+
+    def __init__(self, interval=METRICS_LAG_INTERVAL):
+        self.interval = interval
+        self.last = 0.0
+        self._histogram = metrics.histogram("event_loop_lag_seconds", "Delay of the event loop waking up a timer")
+        metrics.gauge("event_loop_lag_last_seconds", lambda: self.last, "Most recent event loop lag sample")
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sample(), name="loop-lag")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - started - self.interval)
+            self._histogram.observe(self.last)
+
+
+def metrics_server(host=METRICS_LISTEN, port=METRICS_PORT):
+    """Returns an HTTPServer serving GET /metrics in the Prometheus format."""
+    async def scrape(headers, body):
+        return 200, PROMETHEUS_CONTENT_TYPE, metrics.prometheus().encode()
+
+    server = HTTPServer(host, port)
+    server.route("GET", "/metrics", scrape)
+    return server
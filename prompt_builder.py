@@ -0,0 +1,155 @@
+"""
+Token-budgeted prompt assembly.
+
+Messages are streamed straight from a MongoDB cursor and counted with a real tokenizer,
+so briefing prompts stay under a configurable token budget without ever holding a whole
+channel's history in memory. Duplicate texts (forwards, repeated bot posts) are skipped.
+"""
+import logging
+import os
+import threading
+
+from tag_cache import text_hash
+
+logger = logging.getLogger(__name__)
+
+# Path to a tokenizer.json, or a Hugging Face hub name to download, used to measure prompt
+# size. Unset, tokens are estimated from the text length.
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "")
+# Maximum number of message tokens per prompt (the instructions come on top)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "30000"))
+
+CHARS_PER_TOKEN = 4  # rough estimate until, or unless, the tokenizer is loaded
+
+
+class TokenCounter:
+    """
+    Counts tokens with a `tokenizers` tokenizer, or estimates them.
+
+    Counting never loads anything: it estimates from the length until `load` has finished
+    in a thread, so a slow download never blocks the event loop.
+    """
+
+    def __init__(self, name=PROMPT_TOKENIZER):
+        self.name = name
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        """The loaded tokenizer, or None while counts are estimated."""
+        return self._tokenizer
+
+    def load(self):
+        """Loads the tokenizer. Blocking, may download; run it in a thread."""
+        if not self.name:
+            return
+        with self._lock:
+            if self._tokenizer is not None:
+                return
+            try:
+                from tokenizers import Tokenizer
+
+                if os.path.isfile(self.name):
+                    self._tokenizer = Tokenizer.from_file(self.name)
+                else:
+                    self._tokenizer = Tokenizer.from_pretrained(self.name)
+                logger.info("Loaded tokenizer %s for prompt budgets", self.name)
+            except Exception as e:
+                logger.warning("Could not load tokenizer %s, estimating tokens from length: %s", self.name, e)
+
+    def count(self, text):
+        tokenizer = self._tokenizer
+        if tokenizer is None:
+            return len(text) // CHARS_PER_TOKEN + 1
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def truncate(self, text, max_tokens):
+        """Cuts the text down to at most `max_tokens` tokens."""
+        tokenizer = self._tokenizer
+        if tokenizer is None:
+            return text[:max_tokens * CHARS_PER_TOKEN]
+        offsets = tokenizer.encode(text, add_special_tokens=False).offsets
+        if len(offsets) <= max_tokens:
+            return text
+        return text[:offsets[max_tokens - 1][1]]
+
+
+token_counter = TokenCounter()
+
+
+async def _texts(cursor, dedup):
+    """Yields (text, tokens) for each distinct non-empty text of a message cursor."""
+    seen = set()
+    async for doc in cursor:
+        text = (doc.get("text") or "").strip()
+        if not text:
+            continue
+        if dedup:
+            key = text_hash(text)
+            if key in seen:
+                continue
+            seen.add(key)
+        yield text, token_counter.count(text) + 1  # +1 for the separating newline
+
+
+async def collect_recent(cursor, budget=PROMPT_TOKEN_BUDGET, dedup=True):
+    """
+    Collects the newest messages that fit in the token budget.
+
+    Args:
+        cursor: Async cursor of message documents, newest first.
+        budget (int): Maximum number of tokens.
+        dedup (bool): Whether to skip texts identical to an already included one.
+
+    Returns:
+        list[str]: The included texts, oldest first.
+    """
+    texts, used = [], 0
+    try:
+        async for text, tokens in _texts(cursor, dedup):
+            if used + tokens > budget:
+                if not texts:
+                    texts.append(token_counter.truncate(text, budget))
+                break
+            texts.append(text)
+            used += tokens
+    finally:
+        await _close(cursor)
+
+    texts.reverse()
+    return texts
+
+
+async def iter_chunks(cursor, budget=PROMPT_TOKEN_BUDGET, dedup=True):
+    """
+    Splits a message stream into consecutive chunks that each fit in the token budget.
+
+    Args:
+        cursor: Async cursor of message documents, in the order to keep.
+        budget (int): Maximum number of tokens per chunk.
+        dedup (bool): Whether to skip texts identical to an earlier one.
+
+    Yields:
+        list[str]: The texts of one chunk.
+    """
+    chunk, used = [], 0
+    try:
+        async for text, tokens in _texts(cursor, dedup):
+            if tokens > budget:
+                text, tokens = token_counter.truncate(text, budget - 1), budget
+            if chunk and used + tokens > budget:
+                yield chunk
+                chunk, used = [], 0
+            chunk.append(text)
+            used += tokens
+        if chunk:
+            yield chunk
+    finally:
+        await _close(cursor)
+
+
+async def _close(cursor):
+    close = getattr(cursor, "close", None)
+    if close is not None:
+        await close()
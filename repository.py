@@ -0,0 +1,716 @@
+"""
+Async MongoDB access layer.
+
+Every query the handlers run lives here as a method on MessageRepository, backed by
+PyMongo's native asyncio client, so a slow Atlas query only suspends the handler
+that is waiting for it instead of the whole event loop.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, AsyncMongoClient, DESCENDING, TEXT, IndexModel, UpdateOne, monitoring
+from pymongo.errors import ConnectionFailure
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "DB")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "2"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000"))
+# Documents per round trip when streaming messages into a prompt
+MONGO_STREAM_BATCH_SIZE = int(os.getenv("MONGO_STREAM_BATCH_SIZE", "200"))
+# Stemming and stop words of the keyword search index. Changing it requires dropping text_search first.
+MONGO_TEXT_LANGUAGE = os.getenv("MONGO_TEXT_LANGUAGE", "english")
+
+# Fields the handlers actually display or summarize
+MESSAGE_FIELDS = {"chat_id": 1, "chat_name": 1, "sender": 1, "text": 1, "date": 1, "tag": 1}
+# Fields a page of browsed or searched messages displays; date and _id also form the tag page cursor
+PAGE_FIELDS = {"chat_id": 1, "chat_name": 1, "sender": 1, "text": 1, "date": 1}
+# Fields needed to put a message into a prompt
+PROMPT_FIELDS = {"_id": 0, "text": 1}
+
+# Compound indexes matching the hot queries: equality fields first, then the date sort.
+MESSAGE_INDEXES = [
+    IndexModel([("chat_id", ASCENDING), ("date", DESCENDING)], name="chat_id_date"),
+    # Only used to backfill chat_id on messages stored before it was recorded
+    IndexModel([("chat_name", ASCENDING), ("date", DESCENDING)], name="chat_name_date"),
+    # _id breaks ties between equal dates, so a tag page is a single index range in either direction
+    IndexModel([("tag", ASCENDING), ("chat_id", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)],
+               name="tag_chat_id_date_id"),
+    IndexModel([("text_hash", ASCENDING)], name="text_hash"),
+    # Keyword search; the override field name keeps a message field called "language" from changing it
+    IndexModel([("text", TEXT)], name="text_search", default_language=MONGO_TEXT_LANGUAGE,
+               language_override="text_search_language"),
+    # Deletes archived messages once their expire_at has passed; unset on messages not archived yet
+    IndexModel([("expire_at", ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0),
+]
+
+TAG_STATS_INDEXES = [
+    IndexModel([("chat_id", ASCENDING), ("tag", ASCENDING), ("day", ASCENDING)], name="chat_id_tag_day", unique=True),
+    # Serves the ranking, which reads a range of days for a few chats
+    IndexModel([("chat_id", ASCENDING), ("day", DESCENDING)], name="chat_id_day"),
+]
+
+# Superseded by tag_chat_id_date_id
+LEGACY_MESSAGE_INDEXES = ["tag_chat_id_date"]
+# Summaries used to be keyed by chat title; this unique index would reject the id-keyed documents
+LEGACY_SUMMARY_INDEX = "chat_name_1_bucket_start_1"
+
+
+def mongo_uri():
+    """Returns MONGO_URI if set, otherwise the Atlas deployment URI built from MONGOOSE_KEY."""
+    uri = os.getenv("MONGO_URI")
+    if uri:
+        return uri
+    return "mongodb+srv://admin:" + os.getenv("MONGOOSE_KEY", "") + "@messages.5xaf5.mongodb.net/?retryWrites=true&w=majority&appName=messages"
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Records the server round trip of every MongoDB command (find, getMore, insert, distinct, ...)."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event, "ok")
+
+    def failed(self, event):
+        self._observe(event, "error")
+
+    def _observe(self, event, outcome):
+        metrics.histogram("mongo_command_seconds", "MongoDB command round trip",
+                          command=event.command_name, outcome=outcome).observe(event.duration_micros / 1e6)
+
+
+class MessageRepository:
+    """
+    Typed queries over the Messages, Summaries, Chats, TagStats, Embeddings,
+    DigestSubscriptions, Archive and Migrations collections.
+
+    Nothing touches the network until `connect` is awaited. Until then every query raises
+    ConnectionFailure, like during an outage.
+
+    Args:
+        uri (str): MongoDB connection string.
+        db_name (str): Database holding the Messages collection.
+        **client_options: Extra AsyncMongoClient options, overriding the pool defaults.
+    """
+
+    def __init__(self, uri, db_name=MONGO_DB_NAME, **client_options):
+        self.uri = uri
+        self.db_name = db_name
+        self.options = {
+            "maxPoolSize": MONGO_MAX_POOL_SIZE,
+            "minPoolSize": MONGO_MIN_POOL_SIZE,
+            "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+            "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            "event_listeners": [CommandTimer()],
+            **client_options,
+        }
+        self._client = None
+        self._connect_lock = asyncio.Lock()
+
+    async def connect(self):
+        """
+        Creates the client, if not done yet. Safe to call repeatedly.
+
+        The client is built in a thread because resolving a mongodb+srv:// URI is a blocking
+        DNS lookup, which raises ConfigurationError when it fails.
+        """
+        async with self._connect_lock:
+            if self._client is None:
+                self._client = await asyncio.to_thread(AsyncMongoClient, self.uri, **self.options)
+        return self._client
+
+    @property
+    def client(self):
+        if self._client is None:
+            raise ConnectionFailure("Not connected to MongoDB yet")
+        return self._client
+
+    @property
+    def db(self):
+        return self.client[self.db_name]
+
+    @property
+    def messages(self):
+        return self.db["Messages"]
+
+    @property
+    def summaries(self):
+        return self.db["Summaries"]
+
+    @property
+    def chats(self):
+        return self.db["Chats"]
+
+    @property
+    def tag_stats(self):
+        return self.db["TagStats"]
+
+    @property
+    def embeddings(self):
+        return self.db["Embeddings"]
+
+    @property
+    def digest_subscriptions(self):
+        return self.db["DigestSubscriptions"]
+
+    @property
+    def archive(self):
+        return self.db["Archive"]
+
+    @property
+    def migrations(self):
+        return self.db["Migrations"]
+
+    async def ping(self):
+        """Raises if the deployment cannot be reached."""
+        await self.client.admin.command("ping")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    # Writes
+
+    async def insert_many(self, docs, ordered=False):
+        """Inserts a batch of message documents."""
+        return await self.messages.insert_many(docs, ordered=ordered)
+
+    async def set_tag(self, doc_id, tag):
+        """Sets the tag of a stored message."""
+        await self.messages.update_one({"_id": doc_id}, {"$set": {"tag": tag}})
+
+    async def backfill_chat_id(self, chat_name, chat_id):
+        """
+        Sets chat_id on older messages of a chat that were stored with only its title.
+
+        Returns:
+            int: The number of updated messages.
+        """
+        result = await self.messages.update_many({"chat_name": chat_name, "chat_id": {"$exists": False}},
+                                                 {"$set": {"chat_id": chat_id}})
+        return result.modified_count
+
+    # Reads
+
+    async def find_tags_by_hashes(self, content_hashes, exclude_tag=None):
+        """
+        Returns the tags of stored messages with the given text hashes, in one query.
+
+        Args:
+            content_hashes (list[str]): Hashes of normalized message texts.
+            exclude_tag (str, optional): Tag to ignore, e.g. the fallback tag.
+
+        Returns:
+            dict[str, str]: A stored tag per hash that has a tagged copy.
+        """
+        excluded = [None] if exclude_tag is None else [None, exclude_tag]
+        pipeline = [
+            {"$match": {"text_hash": {"$in": list(content_hashes)}, "tag": {"$nin": excluded}}},
+            {"$group": {"_id": "$text_hash", "tag": {"$first": "$tag"}}},
+        ]
+        cursor = await self.messages.aggregate(pipeline)
+        return {doc["_id"]: doc["tag"] async for doc in cursor}
+
+    async def recent_by_chat(self, chat_id, limit=100):
+        """
+        Returns the newest messages of a chat.
+
+        Args:
+            chat_id (int): Telegram ID of the group or channel.
+            limit (int): Maximum number of messages.
+
+        Returns:
+            list[dict]: Messages, newest first.
+        """
+        return await self._recent_by_chat(chat_id, limit).to_list()
+
+    async def latest_tagged_message(self):
+        """Returns the newest message that has a tag, or None."""
+        return await self.messages.find_one({"tag": {"$exists": True}}, MESSAGE_FIELDS, sort=[("date", DESCENDING)])
+
+    async def newest_message_id(self, chat_id):
+        """Returns the _id of the newest stored message of a chat, or None."""
+        doc = await self.messages.find_one({"chat_id": chat_id}, {"_id": 1}, sort=[("date", DESCENDING)])
+        return doc["_id"] if doc else None
+
+    def _recent_by_chat(self, chat_id, limit):
+        return self.messages.find({"chat_id": chat_id}, MESSAGE_FIELDS).sort("date", DESCENDING).limit(limit)
+
+    async def by_time_window(self, chat_id, since, until=None):
+        """
+        Returns the messages of a chat sent in [since, until).
+
+        Args:
+            chat_id (int): Telegram ID of the group or channel.
+            since (datetime): Start of the window.
+            until (datetime, optional): End of the window. Defaults to now.
+
+        Returns:
+            list[dict]: Messages, newest first.
+        """
+        return await self._by_time_window(chat_id, since, until).to_list()
+
+    def _by_time_window(self, chat_id, since, until=None):
+        date_filter = {"$gte": since}
+        if until is not None:
+            date_filter["$lt"] = until
+        return self.messages.find({"chat_id": chat_id, "date": date_filter}, MESSAGE_FIELDS).sort("date", DESCENDING)
+
+    def stream_recent_by_chat(self, chat_id, limit=100):
+        """Returns an async cursor over the texts of a chat's newest messages, newest first."""
+        return (
+            self.messages.find({"chat_id": chat_id}, PROMPT_FIELDS)
+            .sort("date", DESCENDING)
+            .limit(limit)
+            .batch_size(MONGO_STREAM_BATCH_SIZE)
+        )
+
+    def stream_time_window(self, chat_id, since, until=None, inclusive=True, oldest_first=False):
+        """Returns an async cursor over the texts of a chat's messages in a time window, newest first by default."""
+        date_filter = {"$gte" if inclusive else "$gt": since}
+        if until is not None:
+            date_filter["$lt"] = until
+        return (
+            self.messages.find({"chat_id": chat_id, "date": date_filter}, PROMPT_FIELDS)
+            .sort("date", ASCENDING if oldest_first else DESCENDING)
+            .batch_size(MONGO_STREAM_BATCH_SIZE)
+        )
+
+    async def tag_page(self, tag, chat_ids, before=None, after=None, limit=10):
+        """
+        Returns one page of the messages with a tag in any of the given chats, paginated by
+        keyset on (date, _id) instead of skip, so every page is one indexed range query.
+
+        Args:
+            tag (str): The tag to browse.
+            chat_ids (list[int]): IDs of the groups and channels to search.
+            before (tuple, optional): (date, _id) of the oldest message on the current page,
+                to get the page of older messages.
+            after (tuple, optional): (date, _id) of the newest message on the current page,
+                to get the page of newer messages.
+            limit (int): Messages per page.
+
+        Returns:
+            tuple[list[dict], bool]: Messages, newest first, and whether more messages follow
+                in the direction of the page (older by default, newer with `after`).
+        """
+        docs = await self._tag_page(tag, chat_ids, before, after, limit + 1).to_list()
+        more = len(docs) > limit
+        docs = docs[:limit]
+        if after is not None:
+            docs.reverse()
+        return docs, more
+
+    def _tag_page(self, tag, chat_ids, before, after, limit):
+        query = {"tag": tag, "chat_id": {"$in": list(chat_ids)}}
+        order = DESCENDING
+        if before is not None:
+            date, doc_id = before
+            # The date bound narrows the index range, _id only decides among equal dates
+            query["date"] = {"$lte": date}
+            query["$or"] = [{"date": {"$lt": date}}, {"_id": {"$lt": doc_id}}]
+        elif after is not None:
+            date, doc_id = after
+            query["date"] = {"$gte": date}
+            query["$or"] = [{"date": {"$gt": date}}, {"_id": {"$gt": doc_id}}]
+            order = ASCENDING
+        return self.messages.find(query, PAGE_FIELDS).sort([("date", order), ("_id", order)]).limit(limit)
+
+    async def distinct_tags(self, chat_ids=None):
+        """
+        Returns the distinct tags, optionally restricted to some chats.
+
+        Args:
+            chat_ids (list[int], optional): IDs of the groups and channels. Defaults to all chats.
+
+        Returns:
+            list[str]: The distinct tags.
+        """
+        return [tag for tag in await self.messages.distinct("tag", self._tags_filter(chat_ids)) if tag is not None]
+
+    async def tag_counts(self, exclude=()):
+        """
+        Counts the stored messages per tag.
+
+        Args:
+            exclude (list[str]): Tags to leave out, e.g. the fallback tag.
+
+        Returns:
+            list[tuple[str, int]]: (tag, count) pairs, most used first.
+        """
+        pipeline = [
+            {"$match": {"tag": {"$exists": True, "$nin": [None, *exclude]}}},
+            {"$group": {"_id": "$tag", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+        ]
+        cursor = await self.messages.aggregate(pipeline)
+        return [(doc["_id"], doc["count"]) async for doc in cursor]
+
+    def stream_texts_by_tag(self, tag, limit):
+        """Returns an async cursor over the texts of the newest messages with a tag."""
+        return (
+            self.messages.find({"tag": tag}, PROMPT_FIELDS)
+            .sort("date", DESCENDING)
+            .limit(limit)
+            .batch_size(MONGO_STREAM_BATCH_SIZE)
+        )
+
+    def _tags_filter(self, chat_ids):
+        return {} if chat_ids is None else {"chat_id": {"$in": list(chat_ids)}}
+
+    # Bucket summaries
+
+    async def bucket_activity(self, chat_id, since, until=None, bucket_minutes=60):
+        """
+        Counts a chat's messages per time bucket. Only reads the {chat_id, date} index.
+
+        Returns:
+            list[dict]: {"start", "count", "last"} per non-empty bucket, oldest first.
+        """
+        date_filter = {"$gte": since}
+        if until is not None:
+            date_filter["$lt"] = until
+        pipeline = [
+            {"$match": {"chat_id": chat_id, "date": date_filter}},
+            {"$project": {"_id": 0, "date": 1}},
+            {"$group": {
+                "_id": {"$dateTrunc": {"date": "$date", "unit": "minute", "binSize": bucket_minutes}},
+                "count": {"$sum": 1},
+                "last": {"$max": "$date"},
+            }},
+            {"$sort": {"_id": 1}},
+        ]
+        cursor = await self.messages.aggregate(pipeline)
+        return [{"start": doc["_id"], "count": doc["count"], "last": doc["last"]} async for doc in cursor]
+
+    async def bucket_summaries(self, chat_id, since, until=None):
+        """
+        Returns the stored bucket summaries of a chat starting in [since, until).
+
+        Returns:
+            dict[datetime, dict]: Summary documents keyed by bucket start.
+        """
+        start_filter = {"$gte": since}
+        if until is not None:
+            start_filter["$lt"] = until
+        cursor = self.summaries.find({"chat_id": chat_id, "bucket_start": start_filter})
+        return {doc["bucket_start"]: doc async for doc in cursor}
+
+    async def save_bucket_summary(self, chat_id, start, summary, message_count, last_message_date):
+        """Stores the summary of a bucket and returns the stored document."""
+        doc = {
+            "chat_id": chat_id,
+            "bucket_start": start,
+            "summary": summary,
+            "message_count": message_count,
+            "last_message_date": last_message_date,
+        }
+        await self.summaries.replace_one({"chat_id": chat_id, "bucket_start": start}, doc, upsert=True)
+        return doc
+
+    # Chats
+
+    async def all_chats(self):
+        """Returns every registered chat document. The _id is the Telegram chat ID."""
+        return await self.chats.find({}).to_list()
+
+    async def save_chat(self, chat_id, fields):
+        """Creates or updates a registered chat."""
+        await self.chats.update_one({"_id": chat_id}, {"$set": fields}, upsert=True)
+
+    # Retention
+
+    async def oldest_unarchived_date(self, chat_id, before):
+        """Returns the date of a chat's oldest message before `before` that has not been archived, or None."""
+        doc = await self.messages.find_one({"chat_id": chat_id, "date": {"$lt": before}, "expire_at": {"$exists": False}},
+                                           {"_id": 0, "date": 1}, sort=[("date", ASCENDING)])
+        return doc["date"] if doc else None
+
+    async def day_activity(self, chat_id, since, until):
+        """
+        Counts a chat's messages in [since, until) per tag.
+
+        Returns:
+            dict | None: {"chat_name", "message_count", "first", "last", "tags": {tag: count}},
+                or None if there are no messages.
+        """
+        pipeline = [
+            {"$match": {"chat_id": chat_id, "date": {"$gte": since, "$lt": until}}},
+            {"$group": {
+                "_id": "$tag",
+                "count": {"$sum": 1},
+                "first": {"$min": "$date"},
+                "last": {"$max": "$date"},
+                "chat_name": {"$last": "$chat_name"},
+            }},
+        ]
+        cursor = await self.messages.aggregate(pipeline)
+        groups = await cursor.to_list()
+        if not groups:
+            return None
+        return {
+            "chat_name": next((group["chat_name"] for group in groups if group.get("chat_name")), None),
+            "message_count": sum(group["count"] for group in groups),
+            "first": min(group["first"] for group in groups),
+            "last": max(group["last"] for group in groups),
+            # Tags are field names here; MongoDB allows dots and dollars in them since 5.0
+            "tags": {group["_id"]: group["count"] for group in groups if group["_id"] is not None},
+        }
+
+    async def save_archive_day(self, chat_id, day, fields):
+        """Creates or replaces the archive document of a chat's day."""
+        await self.archive.replace_one({"chat_id": chat_id, "day": day}, {"chat_id": chat_id, "day": day, **fields},
+                                       upsert=True)
+
+    async def archived_days(self, chat_ids, since, until):
+        """Returns the archive documents of some chats for days in [since, until), oldest first."""
+        cursor = self.archive.find({"chat_id": {"$in": list(chat_ids)}, "day": {"$gte": since, "$lt": until}},
+                                   {"_id": 0}).sort("day", ASCENDING)
+        return await cursor.to_list()
+
+    async def expire_window(self, chat_id, since, until, expire_at):
+        """
+        Marks a chat's messages in [since, until), their embeddings and the window's bucket
+        summaries for deletion by the TTL indexes.
+
+        Returns:
+            list[ObjectId]: The _ids of the messages marked.
+        """
+        doc_ids = await self.messages.distinct(
+            "_id", {"chat_id": chat_id, "date": {"$gte": since, "$lt": until}, "expire_at": {"$exists": False}}
+        )
+        if doc_ids:
+            await self.messages.update_many({"_id": {"$in": doc_ids}}, {"$set": {"expire_at": expire_at}})
+            await self.embeddings.update_many({"_id": {"$in": doc_ids}}, {"$set": {"expire_at": expire_at}})
+        await self.summaries.update_many({"chat_id": chat_id, "bucket_start": {"$gte": since, "$lt": until}},
+                                         {"$set": {"expire_at": expire_at}})
+        return doc_ids
+
+    # Digests
+
+    async def all_digest_subscriptions(self):
+        """Returns every digest subscription. The _id is the subscriber's chat ID."""
+        return await self.digest_subscriptions.find({}).to_list()
+
+    async def save_digest_subscription(self, user_id, subscription):
+        await self.digest_subscriptions.replace_one({"_id": user_id}, subscription, upsert=True)
+
+    async def delete_digest_subscription(self, user_id):
+        await self.digest_subscriptions.delete_one({"_id": user_id})
+
+    # Search
+
+    async def text_search(self, query, chat_ids, limit):
+        """
+        Ranks the messages of some chats by text index relevance to a keyword query.
+
+        Returns:
+            list[ObjectId]: Message _ids, most relevant first.
+        """
+        cursor = (
+            self.messages.find({"$text": {"$search": query}, "chat_id": {"$in": list(chat_ids)}},
+                               {"_id": 1, "score": {"$meta": "textScore"}})
+            .sort([("score", {"$meta": "textScore"})])
+            .limit(limit)
+        )
+        return [doc["_id"] async for doc in cursor]
+
+    async def messages_by_ids(self, ids):
+        """Returns the displayed fields of some messages, keyed by _id."""
+        cursor = self.messages.find({"_id": {"$in": list(ids)}}, PAGE_FIELDS)
+        return {doc["_id"]: doc async for doc in cursor}
+
+    async def messages_before(self, before, limit, after=None):
+        """
+        Returns the chat_id and text of the messages stored just before an _id, newest first.
+        Skips archived ones, and with `after` those stored before that _id.
+        """
+        id_range = {"$lt": before} if after is None else {"$lt": before, "$gt": after}
+        cursor = self.messages.find({"_id": id_range, "expire_at": {"$exists": False}},
+                                    {"chat_id": 1, "text": 1}).sort("_id", DESCENDING).limit(limit)
+        return await cursor.to_list()
+
+    async def search_backfill_mark(self):
+        """Returns the _id before which every message has been through the search backfill, or None."""
+        doc = await self.migrations.find_one({"_id": "search_backfill"})
+        return doc["before"] if doc else None
+
+    async def save_search_backfill_mark(self, before):
+        await self.migrations.update_one({"_id": "search_backfill"}, {"$set": {"before": before}}, upsert=True)
+
+    async def save_embeddings(self, entries):
+        """
+        Stores message embeddings.
+
+        Args:
+            entries (list[tuple]): (message _id, chat_id, float32 vector bytes) tuples.
+        """
+        await self.embeddings.bulk_write(
+            [UpdateOne({"_id": doc_id}, {"$set": {"chat_id": chat_id, "vector": vector}}, upsert=True)
+             for doc_id, chat_id, vector in entries],
+            ordered=False,
+        )
+
+    def stream_embeddings(self):
+        """Returns an async cursor over the stored embeddings of messages that are not archived."""
+        return self.embeddings.find({"expire_at": {"$exists": False}}).batch_size(5000)
+
+    # Tag statistics
+
+    async def add_tag_stats(self, increments):
+        """
+        Adds message counts to the per-chat, per-day tag counters in one bulk write.
+
+        Args:
+            increments (list[tuple]): (chat_id, tag, day, count, last_seen) tuples.
+        """
+        await self.tag_stats.bulk_write(
+            [
+                UpdateOne({"chat_id": chat_id, "tag": tag, "day": day},
+                          {"$inc": {"count": count}, "$max": {"last_seen": last_seen}}, upsert=True)
+                for chat_id, tag, day, count, last_seen in increments
+            ],
+            ordered=False,
+        )
+
+    async def top_tags(self, chat_ids, since, limit):
+        """
+        Ranks tags by their message count in some chats since a day. Reads only TagStats.
+
+        Returns:
+            list[tuple[str, int, datetime]]: (tag, count, last_seen), most used first.
+        """
+        pipeline = [
+            {"$match": {"chat_id": {"$in": list(chat_ids)}, "day": {"$gte": since}}},
+            {"$group": {"_id": "$tag", "count": {"$sum": "$count"}, "last_seen": {"$max": "$last_seen"}}},
+            {"$sort": {"count": -1, "last_seen": -1}},
+            {"$limit": limit},
+        ]
+        cursor = await self.tag_stats.aggregate(pipeline)
+        return [(doc["_id"], doc["count"], doc["last_seen"]) async for doc in cursor]
+
+    async def tag_stats_built(self):
+        """Returns whether `rebuild_tag_stats` has ever run to completion."""
+        return await self.migrations.find_one({"_id": "tag_stats"}, {"_id": 1}) is not None
+
+    async def rebuild_tag_stats(self):
+        """Recomputes every tag counter from the stored messages. Needs the TagStats indexes."""
+        pipeline = [
+            {"$match": {"tag": {"$exists": True, "$ne": None}, "chat_id": {"$exists": True}}},
+            {"$group": {
+                "_id": {"chat_id": "$chat_id", "tag": "$tag", "day": {"$dateTrunc": {"date": "$date", "unit": "day"}}},
+                "count": {"$sum": 1},
+                "last_seen": {"$max": "$date"},
+            }},
+            {"$project": {"_id": 0, "chat_id": "$_id.chat_id", "tag": "$_id.tag", "day": "$_id.day",
+                          "count": 1, "last_seen": 1}},
+            {"$merge": {"into": self.tag_stats.name, "on": ["chat_id", "tag", "day"],
+                        "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ]
+        cursor = await self.messages.aggregate(pipeline)
+        await cursor.close()
+        # Live counters may already exist, so only this marker says the history was counted
+        await self.migrations.update_one({"_id": "tag_stats"}, {"$set": {"completed_at": datetime.now(timezone.utc)}},
+                                         upsert=True)
+
+    # Indexes
+
+    async def ensure_indexes(self):
+        """Creates the indexes the queries above rely on. Safe to call on every startup."""
+        existing = await self.messages.index_information()
+        for name in LEGACY_MESSAGE_INDEXES:
+            if name in existing:
+                await self.messages.drop_index(name)
+        names = await self.messages.create_indexes(MESSAGE_INDEXES)
+        logger.info("Ensured indexes on Messages: %s", ", ".join(names))
+        if LEGACY_SUMMARY_INDEX in await self.summaries.index_information():
+            await self.summaries.drop_index(LEGACY_SUMMARY_INDEX)
+        await self.summaries.create_index([("chat_id", ASCENDING), ("bucket_start", ASCENDING)], unique=True)
+        await self.tag_stats.create_indexes(TAG_STATS_INDEXES)
+        await self.summaries.create_index([("expire_at", ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0)
+        await self.embeddings.create_index([("expire_at", ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0)
+        await self.archive.create_index([("chat_id", ASCENDING), ("day", ASCENDING)], name="chat_id_day", unique=True)
+
+    async def explain_queries(self, chat_id, tag, since):
+        """
+        Explains each handler query against sample values.
+
+        Args:
+            chat_id (int): A chat to run the per-chat queries for.
+            tag (str): A tag to run the tag query for.
+            since (datetime): Start of the time window query.
+
+        Returns:
+            list[dict]: One plan summary per query, see `summarize_plan`.
+        """
+        cursors = {
+            "briefing 24h (by_time_window)": self._by_time_window(chat_id, since),
+            "briefing 100 (recent_by_chat)": self._recent_by_chat(chat_id, 100),
+            "tag browsing (tag_page)": self._tag_page(tag, [chat_id], None, None, 10),
+        }
+        plans = []
+        for name, cursor in cursors.items():
+            plans.append(summarize_plan(name, await cursor.explain()))
+
+        distinct = await self.db.command({
+            "explain": {"distinct": self.messages.name, "key": "tag", "query": self._tags_filter([chat_id])},
+            "verbosity": "executionStats",
+        })
+        plans.append(summarize_plan("tag list (distinct_tags)", distinct))
+        return plans
+
+
+def _plan_stages(plan):
+    """Flattens a (possibly nested) winning plan into its list of stage names, outermost first."""
+    if not plan:
+        return []
+    plan = plan.get("queryPlan", plan)
+    stages = [plan.get("stage", "?")]
+    children = plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else [])
+    for child in children:
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+def summarize_plan(name, explanation):
+    """
+    Condenses an explain() result into the facts that matter for a handler query.
+
+    Returns:
+        dict: name, stages, index names used, whether it scans the collection or sorts in
+            memory, whether it is covered (no documents fetched) and the examined counts.
+    """
+    planner = explanation.get("queryPlanner", {})
+    stats = explanation.get("executionStats", {})
+    stages = _plan_stages(planner.get("winningPlan", {}))
+
+    def index_names(plan):
+        plan = plan.get("queryPlan", plan)
+        names = [plan["indexName"]] if "indexName" in plan else []
+        for child in plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else []):
+            names.extend(index_names(child))
+        return names
+
+    uses_index = any(stage in ("IXSCAN", "DISTINCT_SCAN", "COUNT_SCAN", "EXPRESS_IXSCAN") for stage in stages)
+    return {
+        "name": name,
+        "stages": stages,
+        "indexes": index_names(planner.get("winningPlan", {})),
+        "collection_scan": "COLLSCAN" in stages,
+        "in_memory_sort": "SORT" in stages,
+        "covered": uses_index and "FETCH" not in stages and stats.get("totalDocsExamined", 0) == 0,
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "returned": stats.get("nReturned"),
+    }
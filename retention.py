@@ -0,0 +1,145 @@
+"""
+Retention of raw messages.
+
+Briefings, digests and /tags only look at recent days, so raw messages older than
+MESSAGE_RETENTION_DAYS are rolled up and then left to expire. Per chat and day, the
+compaction job stores one Archive document with the message count, the tag counts and a
+summary merged from the hourly bucket summaries. Then it sets `expire_at` on that day's
+messages, their search embeddings and bucket summaries, and MongoDB's TTL monitor deletes
+them once RETENTION_GRACE_HOURS have passed. Only days that have been archived ever expire, and the
+archive stays queryable with /history. Compaction is idempotent, so a day interrupted
+halfway is simply redone on the next run.
+"""
+import asyncio
+import logging
+import os
+from datetime import timedelta
+
+from summaries import utcnow
+from tag_stats import stats_day
+
+logger = logging.getLogger(__name__)
+
+# Raw messages older than this many days are archived and expire; 0 keeps them forever
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "0"))
+# How long archived messages stay in the hot collection before the TTL monitor removes them
+RETENTION_GRACE_HOURS = float(os.getenv("RETENTION_GRACE_HOURS", "24"))
+# Seconds between compaction runs
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "21600"))
+# Seconds between two archived days, so a large backlog never competes with live traffic
+RETENTION_PAUSE = float(os.getenv("RETENTION_PAUSE", "1"))
+
+
+class RetentionJob:
+    """
+    Periodically archives and expires the raw messages past the retention period.
+
+    Args:
+        repo (MessageRepository): Storage for messages, summaries and the archive.
+        chat_ids (callable): Coroutine function returning the IDs of the chats whose messages
+            are stored.
+        summarize (callable): Coroutine function taking (chat_id, since, until) and returning
+            a summary of that window, or "" when there is nothing to summarize.
+        days (int): Retention period in days. 0 disables the job.
+        grace_hours (float): Delay between archiving a day and its messages being deleted.
+        interval (float): Seconds between runs.
+        pause (float): Seconds between two archived days.
+        on_expired (callable, optional): Called with the _ids of the messages set to expire,
+            e.g. to drop them from an in-memory index.
+    """
+
+    def __init__(self, repo, chat_ids, summarize, days=MESSAGE_RETENTION_DAYS, grace_hours=RETENTION_GRACE_HOURS,
+                 interval=RETENTION_INTERVAL, pause=RETENTION_PAUSE, on_expired=None):
+        self.repo = repo
+        self.chat_ids = chat_ids
+        self.summarize = summarize
+        self.days = days
+        self.grace = timedelta(hours=grace_hours)
+        self.interval = interval
+        self.pause = pause
+        self.on_expired = on_expired
+
+        self._task = None
+        self._counters = {"runs": 0, "archived_days": 0, "expired_messages": 0, "failed_days": 0}
+
+    @property
+    def enabled(self):
+        return self.days > 0
+
+    async def start(self):
+        """Starts the periodic compaction, unless retention is disabled."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run_periodically(), name="retention")
+            logger.info("Archiving and expiring messages older than %d days", self.days)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run_periodically(self):
+        while True:
+            try:
+                await self.run()
+            except Exception:
+                logger.exception("Message compaction failed")
+            await asyncio.sleep(self.interval)
+
+    async def run(self):
+        """
+        Archives every chat's unarchived days before the cutoff, oldest first.
+
+        Returns:
+            int: The number of archived days.
+        """
+        self._counters["runs"] += 1
+        # Whole days only: the cutoff is midnight UTC, `days` days ago
+        cutoff = stats_day(utcnow()) - timedelta(days=self.days)
+        archived = 0
+        for chat_id in await self.chat_ids():
+            while True:
+                oldest = await self.repo.oldest_unarchived_date(chat_id, cutoff)
+                if oldest is None:
+                    break
+                day = stats_day(oldest)
+                try:
+                    expired = await self.compact_day(chat_id, day)
+                    archived += 1
+                except Exception as e:
+                    # Its messages keep no expire_at, so nothing is lost; the next run retries
+                    self._counters["failed_days"] += 1
+                    logger.warning("Could not archive %s of chat %s, retrying next run: %s", day.date(), chat_id, e)
+                    break
+                if not expired:
+                    break  # nothing left to mark, e.g. messages without a date in range
+                await asyncio.sleep(self.pause)
+
+        if archived:
+            logger.info("Archived %d chat days older than %s", archived, cutoff.date())
+        return archived
+
+    async def compact_day(self, chat_id, day):
+        """
+        Rolls one day of a chat up into the archive, then lets its raw messages expire.
+
+        Returns:
+            int: The number of messages marked to expire.
+        """
+        end = day + timedelta(days=1)
+        activity = await self.repo.day_activity(chat_id, day, end)
+        if activity is None:
+            return 0
+        summary = await self.summarize(chat_id, day, end)
+
+        await self.repo.save_archive_day(chat_id, day, {**activity, "summary": summary or None})
+        expired = await self.repo.expire_window(chat_id, day, end, utcnow() + self.grace)
+        self._counters["archived_days"] += 1
+        self._counters["expired_messages"] += len(expired)
+        if self.on_expired is not None and expired:
+            self.on_expired(expired)
+        return len(expired)
+
+    def stats(self):
+        """Returns the settings and counters as a dict."""
+        return {"retention_days": self.days, "running": self._task is not None, **self._counters}
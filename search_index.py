@@ -0,0 +1,351 @@
+"""
+Message search.
+
+/search combines two rankings over the selected chats' messages:
+
+- keywords, from a MongoDB text index on the message text, which MongoDB keeps up to date
+  on every insert;
+- meaning, from a local vector index: one normalized float32 embedding per message in a
+  NumPy matrix, searched with a single matrix-vector product.
+
+Embeddings are computed off the ingestion path. Handlers only enqueue the new message;
+SearchIndexer embeds batches in a thread, appends them to the matrix and persists them as
+compact float32 bytes in the Embeddings collection, from which the matrix is reloaded at
+startup. Messages stored before search existed are backfilled slowly in the background,
+and so, on every start, are those the live indexer missed since the last complete backfill.
+The two rankings are merged with reciprocal rank fusion.
+"""
+import asyncio
+import logging
+import os
+import threading
+
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from summaries import utcnow
+
+logger = logging.getLogger(__name__)
+
+SEARCH_QUEUE_SIZE = int(os.getenv("SEARCH_QUEUE_SIZE", "5000"))
+SEARCH_BATCH_SIZE = int(os.getenv("SEARCH_BATCH_SIZE", "64"))
+# Seconds between backfill batches, so older messages never compete with live traffic
+SEARCH_BACKFILL_PAUSE = float(os.getenv("SEARCH_BACKFILL_PAUSE", "0.5"))
+# Results taken from each ranking before they are merged
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "50"))
+# Semantic matches below this cosine similarity are left out
+SEARCH_MIN_SIMILARITY = float(os.getenv("SEARCH_MIN_SIMILARITY", "0.5"))
+
+# Reciprocal rank fusion constant; larger values flatten the advantage of the top ranks
+RRF_K = 60
+# Chat column of discarded rows; Telegram never uses 0 as a chat ID
+DISCARDED_CHAT = 0
+
+
+def fuse_rankings(*rankings):
+    """
+    Merges ranked lists of ids with reciprocal rank fusion.
+
+    Returns:
+        list: Every id, best first. Ids ranked well in several lists come out on top.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class VectorIndex:
+    """
+    Thread-safe, append-only matrix of normalized message embeddings.
+
+    Rows are kept in preallocated arrays that double when full, so appending a batch is a
+    copy into free rows and a search reads a consistent prefix without holding the lock.
+    """
+
+    def __init__(self):
+        self._ids = []
+        self._rows = {}  # _id -> row
+        self._matrix = None
+        self._chat_ids = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, doc_id):
+        return doc_id in self._rows
+
+    def add(self, ids, chat_ids, vectors):
+        """
+        Appends normalized embeddings.
+
+        Args:
+            ids (list[ObjectId]): Message _ids.
+            chat_ids (list[int]): Chat of each message, for filtering by selection.
+            vectors (np.ndarray): (n, dim) float32 matrix of unit vectors.
+        """
+        if not ids:
+            return
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((max(1024, len(ids)), vectors.shape[1]), dtype=np.float32)
+                self._chat_ids = np.zeros(len(self._matrix), dtype=np.int64)
+            elif vectors.shape[1] != self._matrix.shape[1]:
+                logger.warning("Skipping %d embeddings of dimension %d, the index holds %d",
+                               len(ids), vectors.shape[1], self._matrix.shape[1])
+                return
+
+            end = self._size + len(ids)
+            if end > len(self._matrix):
+                capacity = max(end, 2 * len(self._matrix))
+                matrix = np.zeros((capacity, self._matrix.shape[1]), dtype=np.float32)
+                matrix[:self._size] = self._matrix[:self._size]
+                chat_column = np.zeros(capacity, dtype=np.int64)
+                chat_column[:self._size] = self._chat_ids[:self._size]
+                self._matrix, self._chat_ids = matrix, chat_column
+
+            self._matrix[self._size:end] = vectors
+            self._chat_ids[self._size:end] = chat_ids
+            self._rows.update(zip(ids, range(self._size, end)))
+            self._ids.extend(ids)
+            self._size = end
+
+    def discard(self, ids):
+        """
+        Leaves messages out of future searches, e.g. once they are archived.
+
+        Rows are not reclaimed, their chat is only set to one no search selects.
+
+        Returns:
+            int: The number of rows discarded.
+        """
+        with self._lock:
+            rows = [row for row in (self._rows.pop(doc_id, None) for doc_id in ids) if row is not None]
+            if rows:
+                self._chat_ids[rows] = DISCARDED_CHAT
+        return len(rows)
+
+    def search(self, vector, chat_ids, limit, min_similarity=SEARCH_MIN_SIMILARITY):
+        """
+        Finds the messages of some chats closest to a unit vector. Blocking, run it in a thread.
+
+        Returns:
+            list[tuple[ObjectId, float]]: (_id, cosine similarity) pairs, most similar first.
+        """
+        with self._lock:
+            size, matrix, chat_column = self._size, self._matrix, self._chat_ids
+        if not size or vector.shape[0] != matrix.shape[1]:
+            return []
+
+        rows = np.flatnonzero(np.isin(chat_column[:size], list(chat_ids)))
+        if not rows.size:
+            return []
+        scores = matrix[rows] @ vector
+        top = min(limit, rows.size)
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(self._ids[rows[i]], float(scores[i])) for i in best if scores[i] >= min_similarity]
+
+
+class SearchIndexer:
+    """
+    Maintains the vector index incrementally and answers hybrid searches.
+
+    Args:
+        repo (MessageRepository): Storage for messages and their embeddings.
+        embed (callable): Takes a list of texts and returns a (n, dim) float matrix, e.g.
+            the SpacyEmbedder of the tag index.
+        maxsize (int): Messages that may wait for embedding. Further ones are not indexed.
+        batch_size (int): Messages embedded per call.
+        backfill_pause (float): Seconds between backfill batches.
+    """
+
+    def __init__(self, repo, embed, maxsize=SEARCH_QUEUE_SIZE, batch_size=SEARCH_BATCH_SIZE,
+                 backfill_pause=SEARCH_BACKFILL_PAUSE):
+        self.repo = repo
+        self.embed = embed
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.backfill_pause = backfill_pause
+        self.vectors = VectorIndex()
+
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._task = None
+        self._counters = {"enqueued": 0, "dropped": 0, "indexed": 0, "backfilled": 0, "empty": 0, "failed": 0,
+                          "semantic_failed": 0}
+
+    async def start(self):
+        """Loads the stored embeddings, then indexes new messages and backfills older ones, in the background."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="search-indexer")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def submit(self, doc_id, chat_id, text):
+        """Queues a new message for embedding. Never waits; drops the message when the queue is full."""
+        if not text:
+            return
+        try:
+            self._queue.put_nowait((doc_id, chat_id, text))
+            self._counters["enqueued"] += 1
+        except asyncio.QueueFull:
+            self._counters["dropped"] += 1
+
+    async def search(self, query, chat_ids, limit=SEARCH_CANDIDATES):
+        """
+        Ranks the messages of some chats against a query by keywords and by meaning.
+
+        Args:
+            query (str): The user's search text.
+            chat_ids (list[int]): IDs of the groups and channels to search.
+            limit (int): Candidates taken from each ranking.
+
+        Returns:
+            list[ObjectId]: Message _ids, best match first. Only keyword matches if embedding
+                the query fails.
+        """
+        keyword, semantic = await asyncio.gather(
+            self.repo.text_search(query, chat_ids, limit),
+            asyncio.to_thread(self._semantic_search, query, chat_ids, limit),
+        )
+        return fuse_rankings(keyword, [doc_id for doc_id, _ in semantic])
+
+    def _semantic_search(self, query, chat_ids, limit):
+        try:
+            vector = self._normalized([query])[0]
+            if not vector.any():
+                return []
+            return self.vectors.search(vector, chat_ids, limit)
+        except Exception as e:
+            # The keyword ranking alone still answers the search
+            self._counters["semantic_failed"] += 1
+            logger.warning("Semantic search failed, answering from keywords only: %s", e)
+            return []
+
+    def _normalized(self, texts):
+        vectors = np.asarray(self.embed(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    async def _run(self):
+        # Messages newer than this are indexed live; older ones by the backfill
+        boundary = ObjectId.from_datetime(utcnow())
+        try:
+            await self._load()
+        except PyMongoError as e:
+            logger.error("Could not load stored embeddings, search starts from an empty index: %s", e)
+
+        worker = asyncio.create_task(self._index_new(), name="search-indexer-live")
+        try:
+            try:
+                await self._backfill(boundary)
+            except PyMongoError as e:
+                logger.error("Search backfill stopped, older messages stay unsearchable by meaning: %s", e)
+            await worker
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+    async def _load(self):
+        ids, chat_ids, rows = [], [], []
+        async for doc in self.repo.stream_embeddings():
+            ids.append(doc["_id"])
+            chat_ids.append(doc["chat_id"])
+            rows.append(np.frombuffer(doc["vector"], dtype=np.float32))
+            if len(ids) >= 10000:
+                self.vectors.add(ids, chat_ids, np.vstack(rows))
+                ids, chat_ids, rows = [], [], []
+        if ids:
+            self.vectors.add(ids, chat_ids, np.vstack(rows))
+        logger.info("Loaded %d message embeddings for search", len(self.vectors))
+
+    async def _index_new(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                self._counters["indexed"] += await self._index(batch) or 0
+            except Exception:
+                self._counters["failed"] += len(batch)
+                logger.exception("Could not index %d messages for search", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _backfill(self, boundary):
+        """
+        Indexes the messages stored before `boundary` that have no embedding yet: older
+        messages on the first run, afterwards those dropped or failed since the last backfill.
+        """
+        # Every message before the mark went through a complete backfill already
+        mark = await self.repo.search_backfill_mark()
+        before, complete = boundary, True
+        while True:
+            docs = await self.repo.messages_before(before, self.batch_size, after=mark)
+            if not docs:
+                break
+            before = docs[-1]["_id"]
+            batch = [(doc["_id"], doc["chat_id"], doc["text"]) for doc in docs
+                     if doc.get("chat_id") is not None and doc.get("text") and doc["_id"] not in self.vectors]
+            if not batch:
+                continue
+            try:
+                indexed = await self._index(batch)
+            except Exception as e:
+                self._counters["failed"] += len(batch)
+                logger.warning("Search backfill batch failed, continuing: %s", e)
+                complete = False
+            else:
+                if indexed is None:
+                    logger.warning("No embedding model, stopping the search backfill until the next start")
+                    return
+                self._counters["backfilled"] += indexed
+            await asyncio.sleep(self.backfill_pause)
+
+        if complete:
+            await self.repo.save_search_backfill_mark(boundary)
+        logger.info("Search backfill finished, %d older messages indexed", self._counters["backfilled"])
+
+    async def _index(self, batch):
+        """Embeds a batch, appends it to the matrix and stores it. Returns the number indexed, None without a model."""
+        if not batch:
+            return 0
+        vectors = await asyncio.to_thread(self._normalized, [text for _, _, text in batch])
+        if not vectors.shape[1]:
+            # The embedder could not load its model
+            self._counters["empty"] += len(batch)
+            return None
+        # Texts without a single known word have no direction to search by
+        keep = np.flatnonzero(vectors.any(axis=1))
+        self._counters["empty"] += len(batch) - keep.size
+        if not keep.size:
+            return 0
+
+        ids = [batch[i][0] for i in keep]
+        chat_ids = [batch[i][1] for i in keep]
+        vectors = vectors[keep]
+        self.vectors.add(ids, chat_ids, vectors)
+        await self.repo.save_embeddings([(doc_id, chat_id, vector.tobytes())
+                                         for doc_id, chat_id, vector in zip(ids, chat_ids, vectors)])
+        return len(ids)
+
+    async def join(self):
+        """Waits until every queued message has been indexed."""
+        await self._queue.join()
+
+    def depth(self):
+        """Returns the number of messages waiting to be embedded."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Returns the index size, queue depth and counters as a dict."""
+        return {"vectors": len(self.vectors), "depth": self.depth(), "maxsize": self.maxsize, **self._counters}
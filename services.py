@@ -0,0 +1,164 @@
+"""
+Lazily initialized services and the startup profile.
+
+Nothing here touches the network or loads a model at import time: the Gemini client is
+imported and configured on its first call, health checks run concurrently in the
+background once the bot is already taking updates, and heavy models can be warmed up
+there too. StartupProfile records how long each startup phase took, so the time until the
+bot handles its first update can be kept under STARTUP_TARGET_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Warn when the bot takes longer than this to become ready after the process imports us
+STARTUP_TARGET_SECONDS = float(os.getenv("STARTUP_TARGET_SECONDS", "5"))
+# Seconds each background health check or warm-up may take before it is reported as failed
+STARTUP_CHECK_TIMEOUT = float(os.getenv("STARTUP_CHECK_TIMEOUT", "60"))
+# Attempts per background check; failures are retried after 1s, 2s, 4s, ... up to the max delay
+STARTUP_CHECK_ATTEMPTS = int(os.getenv("STARTUP_CHECK_ATTEMPTS", "8"))
+STARTUP_CHECK_MAX_DELAY = 60
+# Set to 0 to load the Gemini client, tokenizer and NLP models on first use instead
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+
+
+class LazyGenerativeModel:
+    """
+    Stand-in for genai.GenerativeModel that imports and configures the Gemini client on
+    first use, keeping the slow google.generativeai import out of startup.
+
+    Args:
+        model_name (str): Gemini model, e.g. "gemini-pro".
+        api_key (str): Gemini API key.
+    """
+
+    def __init__(self, model_name, api_key):
+        self.model_name = model_name
+        self.api_key = api_key
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Returns the underlying GenerativeModel, creating it if needed. Blocking."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    import google.generativeai as genai
+
+                    genai.configure(api_key=self.api_key)
+                    self._model = genai.GenerativeModel(self.model_name)
+                    logger.info("Initialized Gemini model %s", self.model_name)
+        return self._model
+
+    def generate_content(self, *args, **kwargs):
+        return self.load().generate_content(*args, **kwargs)
+
+
+class StartupProfile:
+    """
+    Timeline of startup phases, measured from the creation of the profile.
+
+    Phases are marked in order as startup progresses; background checks are recorded with
+    their own duration and outcome as they finish. Everything is also exported as the
+    `startup_seconds` gauge.
+    """
+
+    def __init__(self, target=STARTUP_TARGET_SECONDS):
+        self.target = target
+        self.started = time.perf_counter()
+        self._last = self.started
+        self._phases = []  # (name, seconds since the previous mark, seconds since start)
+        self._checks = []  # (name, seconds, outcome)
+        self._first_update = None
+
+    def mark(self, phase):
+        """Ends a phase that started at the previous mark."""
+        now = time.perf_counter()
+        entry = (phase, now - self._last, now - self.started)
+        self._phases.append(entry)
+        self._last = now
+        metrics.gauge("startup_seconds", lambda: entry[2], "Seconds from import to the end of a startup phase",
+                      phase=phase)
+        return entry[2]
+
+    def record(self, check, seconds, outcome):
+        self._checks.append((check, seconds, outcome))
+        metrics.gauge("startup_check_seconds", lambda: seconds, "Duration of a background startup check",
+                      check=check)
+
+    def ready(self):
+        """Marks the bot as ready for updates and logs the profile, warning when over target."""
+        total = self.mark("ready")
+        log = logger.warning if total > self.target else logger.info
+        log("Ready for updates %.2fs after start (target %.1fs)\n%s", total, self.target, "\n".join(self.report()))
+
+    def first_update(self):
+        """Records the arrival of the first update. Cheap to call for every update."""
+        if self._first_update is None:
+            self._first_update = self.mark("first update")
+            logger.info("First update handled %.2fs after start", self._first_update)
+
+    def report(self):
+        """
+        Formats the profile.
+
+        Returns:
+            list[str]: One line per phase and per finished background check.
+        """
+        lines = [f"  {name:<24}{duration * 1000:>9.0f}ms  (at {total:.2f}s)" for name, duration, total in self._phases]
+        lines += [f"  [bg] {name:<19}{seconds * 1000:>9.0f}ms  {outcome}" for name, seconds, outcome in self._checks]
+        return lines
+
+
+async def run_checks(checks, profile, timeout=STARTUP_CHECK_TIMEOUT, attempts=STARTUP_CHECK_ATTEMPTS, after=None):
+    """
+    Runs named health checks and warm-ups concurrently, each under a timeout per attempt.
+
+    A failed check is retried with exponential backoff, so a dependency that is briefly
+    unavailable at boot does not leave the bot half-initialized until the next restart.
+
+    Args:
+        checks (dict[str, callable]): Coroutine functions by name. Failures are logged and
+            recorded in the profile, never raised.
+        profile (StartupProfile): Where to record each check's duration and outcome.
+        timeout (float): Seconds each attempt may take.
+        attempts (int): Attempts per check before it is reported as failed.
+        after (dict[str, str], optional): Checks that must succeed before another one starts,
+            by the dependent check's name. A check whose dependency failed is skipped.
+    """
+    after = after or {}
+    succeeded = {name: asyncio.get_running_loop().create_future() for name in checks}
+
+    async def run(name, check):
+        dependency = after.get(name)
+        if dependency in succeeded and not await asyncio.shield(succeeded[dependency]):
+            profile.record(name, 0.0, f"skipped: {dependency} failed")
+            succeeded[name].set_result(False)
+            return
+
+        started = time.perf_counter()
+        for attempt in range(1, attempts + 1):
+            try:
+                await asyncio.wait_for(check(), timeout)
+                outcome = "ok" if attempt == 1 else f"ok after {attempt} attempts"
+                break
+            except asyncio.TimeoutError:
+                outcome = f"timed out after {timeout:.0f}s"
+            except Exception as e:
+                outcome = f"failed: {type(e).__name__}"
+                logger.warning("Startup check %s failed (attempt %d/%d): %s", name, attempt, attempts, e)
+            if attempt < attempts:
+                await asyncio.sleep(min(STARTUP_CHECK_MAX_DELAY, 2 ** (attempt - 1)))
+        else:
+            logger.error("Startup check %s gave up after %d attempts: %s", name, attempts, outcome)
+        profile.record(name, time.perf_counter() - started, outcome)
+        succeeded[name].set_result(outcome.startswith("ok"))
+
+    await asyncio.gather(*(run(name, check) for name, check in checks.items()))
+    logger.info("Background startup checks finished\n%s", "\n".join(profile.report()))
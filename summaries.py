@@ -0,0 +1,224 @@
+"""
+Incremental rolling summaries.
+
+Each chat's history is split into fixed time buckets (hourly by default) and every bucket
+keeps its own stored summary, updated with just the new messages as they arrive. A
+briefing then only has to merge the cached bucket summaries, map-reduce style, instead
+of re-summarizing every raw message in the window.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from prompt_builder import iter_chunks
+
+logger = logging.getLogger(__name__)
+
+# Must divide a day evenly so buckets line up with MongoDB's $dateTrunc bins
+SUMMARY_BUCKET_MINUTES = int(os.getenv("SUMMARY_BUCKET_MINUTES", "60"))
+# How often buckets that received messages are re-summarized in the background
+SUMMARY_REFRESH_INTERVAL = float(os.getenv("SUMMARY_REFRESH_INTERVAL", "600"))
+# How many summaries one merge call combines; longer windows are merged hierarchically
+SUMMARY_MERGE_FANOUT = int(os.getenv("SUMMARY_MERGE_FANOUT", "24"))
+
+BUCKET_PROMPT = "Summarize the following messages into a concise summary highlighting key points:\n\n{messages}"
+
+UPDATE_PROMPT = """Here is a summary of earlier messages in a chat, followed by newer messages from the same period.
+Rewrite the summary so it also covers the newer messages, staying concise and highlighting key points.
+Return ONLY the updated summary.
+
+Summary so far:
+{summary}
+
+Newer messages:
+{messages}"""
+
+MERGE_PROMPT = """The following are summaries of consecutive time periods of the same chat, oldest first.
+Merge them into one concise summary highlighting key points. Return ONLY the merged summary.
+
+{summaries}"""
+
+
+def utcnow():
+    """Returns the current UTC time as a naive datetime, the way PyMongo returns stored dates."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def bucket_start(date, minutes=SUMMARY_BUCKET_MINUTES):
+    """Returns the start of the bucket a (naive UTC) datetime falls into."""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    epoch_minutes = int(date.replace(tzinfo=timezone.utc).timestamp() // 60)
+    return datetime(1970, 1, 1) + timedelta(minutes=epoch_minutes - epoch_minutes % minutes)
+
+
+class SummaryEngine:
+    """
+    Maintains per-chat bucket summaries and merges them into briefings.
+
+    Args:
+        repo (MessageRepository): Storage for messages and bucket summaries.
+        generate (callable): Coroutine function taking a prompt and returning the model's text.
+        background_generate (callable, optional): Same, used for refreshes nobody is waiting
+            for. Defaults to `generate`.
+        bucket_minutes (int): Size of a bucket.
+        fanout (int): Maximum number of summaries combined by one merge call.
+    """
+
+    def __init__(self, repo, generate, background_generate=None, bucket_minutes=SUMMARY_BUCKET_MINUTES,
+                 refresh_interval=SUMMARY_REFRESH_INTERVAL, fanout=SUMMARY_MERGE_FANOUT):
+        if (24 * 60) % bucket_minutes:
+            raise ValueError("bucket_minutes must divide a day evenly")
+
+        self.repo = repo
+        self.generate = generate
+        self.background_generate = background_generate or generate
+        self.bucket_minutes = bucket_minutes
+        self.refresh_interval = refresh_interval
+        self.fanout = max(2, fanout)
+
+        self._dirty = set()  # (chat_id, bucket_start) that received messages since the last refresh
+        self._locks = {}
+        self._refresher = None
+
+    async def start(self):
+        """Starts refreshing dirty buckets in the background."""
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_periodically(), name="summary-refresh")
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+    def note_message(self, chat_id, date):
+        """Marks the bucket of a newly received message for a background refresh."""
+        self._dirty.add((chat_id, bucket_start(date, self.bucket_minutes)))
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            dirty, self._dirty = self._dirty, set()
+            for chat_id, start in sorted(dirty, key=lambda key: key[1]):
+                try:
+                    await self.refresh_window(chat_id, start, start + timedelta(minutes=self.bucket_minutes),
+                                              background=True)
+                except Exception as e:
+                    logger.warning("Could not refresh summary of %s at %s: %s", chat_id, start, e)
+
+    async def refresh_window(self, chat_id, since, until=None, background=False):
+        """
+        Brings every bucket summary of a chat in [since, until) up to date.
+
+        Buckets whose stored summary already covers all of their messages are left alone,
+        buckets with new messages are updated incrementally, and changed buckets are redone.
+        Background refreshes use `background_generate`.
+
+        Returns:
+            list[dict]: The stored bucket summaries in the window, oldest first.
+        """
+        activity = await self.repo.bucket_activity(chat_id, since, until, self.bucket_minutes)
+        stored = await self.repo.bucket_summaries(chat_id, since, until)
+
+        stale = [bucket for bucket in activity
+                 if bucket["start"] not in stored
+                 or stored[bucket["start"]]["message_count"] != bucket["count"]
+                 or stored[bucket["start"]]["last_message_date"] != bucket["last"]]
+        generate = self.background_generate if background else self.generate
+        updated = await asyncio.gather(*(self._refresh_bucket(chat_id, bucket, generate) for bucket in stale))
+        for doc in updated:
+            if doc is not None:
+                stored[doc["bucket_start"]] = doc
+
+        return [stored[start] for start in sorted(stored)]
+
+    async def _refresh_bucket(self, chat_id, bucket, generate):
+        # One refresh per bucket at a time; concurrent briefings wait and reuse its result
+        key = (chat_id, bucket["start"])
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self._summarize_bucket(chat_id, bucket, generate)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _summarize_bucket(self, chat_id, bucket, generate):
+        start = bucket["start"]
+        end = start + timedelta(minutes=self.bucket_minutes)
+        previous = (await self.repo.bucket_summaries(chat_id, start, end)).get(start)
+
+        if previous is not None and previous["message_count"] == bucket["count"] \
+                and previous["last_message_date"] == bucket["last"]:
+            return previous  # refreshed by someone else while we waited for the lock
+
+        if previous is not None and bucket["last"] > previous["last_message_date"] \
+                and bucket["count"] > previous["message_count"]:
+            # Only messages after the stored summary need to go to the model
+            summary = previous["summary"]
+            cursor = self.repo.stream_time_window(chat_id, previous["last_message_date"], end,
+                                                  inclusive=False, oldest_first=True)
+        else:
+            summary = None
+            cursor = self.repo.stream_time_window(chat_id, start, end, oldest_first=True)
+
+        # Busy buckets are folded in token-budgeted chunks, oldest first
+        async for chunk in iter_chunks(cursor):
+            messages = "\n".join(chunk)
+            if summary is None:
+                prompt = BUCKET_PROMPT.format(messages=messages)
+            else:
+                prompt = UPDATE_PROMPT.format(summary=summary, messages=messages)
+            summary = (await generate(prompt)).strip() or summary
+
+        if not summary:
+            return None
+        return await self.repo.save_bucket_summary(chat_id, start, summary, bucket["count"], bucket["last"])
+
+    async def merge(self, summaries, background=False):
+        """Merges summaries (oldest first) hierarchically, `fanout` at a time, into one."""
+        generate = self.background_generate if background else self.generate
+        if not summaries:
+            return ""
+        if len(summaries) == 1:
+            return summaries[0]
+        while True:
+            groups = [summaries[i:i + self.fanout] for i in range(0, len(summaries), self.fanout)]
+            summaries = await asyncio.gather(*(
+                generate(MERGE_PROMPT.format(summaries="\n\n".join(
+                    f"Period {i + 1}:\n{summary}" for i, summary in enumerate(group)
+                )))
+                for group in groups
+            ))
+            summaries = [summary.strip() for summary in summaries]
+            if len(summaries) == 1:
+                return summaries[0]
+
+    async def briefing(self, chat_id, hours=24, background=False):
+        """
+        Summarizes the last `hours` of a chat from its bucket summaries.
+
+        The window is widened to the start of its first bucket, so it may include up to one
+        extra bucket of older messages. Background briefings, e.g. digests prepared ahead of
+        time, use `background_generate`.
+
+        Returns:
+            str: The merged summary, or "" if there were no messages.
+        """
+        since = bucket_start(utcnow() - timedelta(hours=hours), self.bucket_minutes)
+        return await self.summarize_window(chat_id, since, background=background)
+
+    async def summarize_window(self, chat_id, since, until=None, background=False):
+        """
+        Summarizes a chat's messages in [since, until) from its bucket summaries, refreshing
+        the stale ones first. `since` should be a bucket start.
+
+        Returns:
+            str: The merged summary, or "" if there were no messages.
+        """
+        buckets = await self.refresh_window(chat_id, since, until, background=background)
+        return await self.merge([bucket["summary"] for bucket in buckets], background=background)
@@ -0,0 +1,172 @@
+"""
+Content-hash tag cache.
+
+Forwarded announcements and repeated bot posts arrive many times across groups. The
+cache maps a hash of the normalized text to the tag it already received, so copies
+are tagged instantly instead of going back to Gemini.
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+TAG_CACHE_SIZE = int(os.getenv("TAG_CACHE_SIZE", "10000"))
+TAG_CACHE_TTL = float(os.getenv("TAG_CACHE_TTL", str(7 * 24 * 3600)))
+# Near-duplicate mode: texts whose SimHash fingerprints differ in at most this many bits
+# share a tag. 0 disables it and only exact (normalized) copies hit.
+TAG_CACHE_SIMHASH_DISTANCE = int(os.getenv("TAG_CACHE_SIMHASH_DISTANCE", "0"))
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4  # must be larger than the maximum distance for band lookups to find every match
+
+
+def normalize_text(text):
+    """Lowercases and collapses whitespace so trivially different copies hash the same."""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_hash(text):
+    """Returns the hex SHA-1 of the normalized text."""
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def simhash(text):
+    """Returns the 64-bit SimHash fingerprint of the text's word 3-shingles."""
+    words = normalize_text(text).split()
+    shingles = [" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+class TagCache:
+    """
+    Bounded LRU + TTL cache from text hash to tag.
+
+    Args:
+        maxsize (int): Maximum number of cached texts.
+        ttl (float): Seconds an entry stays valid.
+        simhash_distance (int): Maximum Hamming distance for near-duplicate hits, 0 to disable.
+        backing (callable, optional): Coroutine function taking a list of text hashes and
+            returning a dict of the stored tags by hash, used by `lookup_stored` (e.g. one query
+            on the Messages collection).
+    """
+
+    def __init__(self, maxsize=TAG_CACHE_SIZE, ttl=TAG_CACHE_TTL,
+                 simhash_distance=TAG_CACHE_SIMHASH_DISTANCE, backing=None):
+        if simhash_distance >= SIMHASH_BANDS:
+            raise ValueError(f"simhash_distance must be smaller than {SIMHASH_BANDS}")
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.simhash_distance = simhash_distance
+        self.backing = backing
+
+        self._entries = OrderedDict()  # hash -> (tag, expires_at, fingerprint)
+        self._bands = [{} for _ in range(SIMHASH_BANDS)]  # band value -> set of hashes
+        self._counters = {"hits": 0, "near_hits": 0, "backing_hits": 0, "misses": 0, "evictions": 0}
+
+    def _band_keys(self, fingerprint):
+        width = SIMHASH_BITS // SIMHASH_BANDS
+        return [(fingerprint >> (i * width)) & ((1 << width) - 1) for i in range(SIMHASH_BANDS)]
+
+    def _remove(self, key):
+        _, _, fingerprint = self._entries.pop(key)
+        if fingerprint is not None:
+            for band, value in zip(self._bands, self._band_keys(fingerprint)):
+                keys = band.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del band[value]
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _get_near(self, fingerprint):
+        candidates = set()
+        for band, value in zip(self._bands, self._band_keys(fingerprint)):
+            candidates |= band.get(value, set())
+        for key in candidates:
+            other = self._entries.get(key)
+            if other is not None and bin(other[2] ^ fingerprint).count("1") <= self.simhash_distance:
+                return self._get_fresh(key)
+        return None
+
+    def get(self, text):
+        """Returns the cached tag for the text (or a near-duplicate of it), or None. Memory only."""
+        tag = self._get_fresh(text_hash(text))
+        if tag is None and self.simhash_distance:
+            tag = self._get_near(simhash(text))
+            if tag is not None:
+                self._counters["near_hits"] += 1
+        return tag
+
+    def lookup(self, text):
+        """Returns the cached tag for the text, or None, counting hits and misses. Memory only."""
+        tag = self.get(text)
+        self._counters["hits" if tag is not None else "misses"] += 1
+        return tag
+
+    async def lookup_stored(self, texts):
+        """
+        Looks several texts up in the persistent backing with a single call.
+
+        Meant for the tagging workers, so ingestion never waits on a database round trip.
+
+        Returns:
+            list[str | None]: One stored tag per text, None where no copy was tagged.
+        """
+        if self.backing is None or not texts:
+            return [None] * len(texts)
+        hashes = [text_hash(text) for text in texts]
+        try:
+            stored = await self.backing(list(dict.fromkeys(hashes)))
+        except Exception as e:
+            logger.warning("Tag cache backing lookup of %d texts failed: %s", len(texts), e)
+            return [None] * len(texts)
+
+        tags = [stored.get(key) for key in hashes]
+        for text, tag in zip(texts, tags):
+            if tag is not None:
+                self._counters["backing_hits"] += 1
+                self.put(text, tag)
+        return tags
+
+    def put(self, text, tag):
+        """Caches the tag for the text, evicting the least recently used entries when full."""
+        key = text_hash(text)
+        if key in self._entries:
+            self._remove(key)
+
+        fingerprint = simhash(text) if self.simhash_distance else None
+        self._entries[key] = (tag, time.monotonic() + self.ttl, fingerprint)
+        if fingerprint is not None:
+            for band, value in zip(self._bands, self._band_keys(fingerprint)):
+                band.setdefault(value, set()).add(key)
+
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def stats(self):
+        """Returns size and hit/miss counters as a dict."""
+        return {"size": len(self._entries), "maxsize": self.maxsize, **self._counters}
@@ -0,0 +1,150 @@
+"""
+Local tag vocabulary index.
+
+Keeps every known tag together with its normalized embedding in a NumPy matrix, so
+deciding whether a fresh tag is "similar to" an existing one is a single matrix
+product instead of another Gemini prompt listing every tag we have ever seen.
+"""
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# spaCy pipeline with static word vectors, e.g. installed with `python -m spacy download en_core_web_md`
+TAG_EMBEDDING_MODEL = os.getenv("TAG_EMBEDDING_MODEL", "en_core_web_md")
+TAG_SIMILARITY_THRESHOLD = float(os.getenv("TAG_SIMILARITY_THRESHOLD", "0.8"))
+
+
+def normalize_tag(tag):
+    """Strips quotes, hashes and extra whitespace that Gemini sometimes wraps tags in."""
+    tag = re.sub(r"\s+", " ", tag or "").strip().strip("\"'`#*.").strip()
+    return tag
+
+
+class SpacyEmbedder:
+    """
+    Embeds short strings with the static vectors of a spaCy pipeline, loaded on first use.
+
+    When the pipeline is not installed every text gets an empty vector, so tags are only
+    merged when they are equal ignoring case and search falls back to keywords.
+    """
+
+    def __init__(self, model_name=TAG_EMBEDDING_MODEL):
+        self.model_name = model_name
+        self._nlp = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    @property
+    def nlp(self):
+        """The loaded pipeline, or None if it could not be loaded."""
+        if self._nlp is None and not self._failed:
+            with self._lock:
+                if self._nlp is None and not self._failed:
+                    try:
+                        import spacy
+
+                        self._nlp = spacy.load(self.model_name, exclude=["parser", "ner", "lemmatizer", "textcat"])
+                        logger.info("Loaded spaCy model %s for tag embeddings", self.model_name)
+                    except (ImportError, OSError) as e:
+                        self._failed = True
+                        logger.error("Could not load spaCy model %s, tags are merged only when equal and search "
+                                     "uses keywords only. Install it with `python -m spacy download %s`: %s",
+                                     self.model_name, self.model_name, e)
+        return self._nlp
+
+    @property
+    def available(self):
+        return self.nlp is not None
+
+    def __call__(self, texts):
+        """Returns a float32 matrix with one row per text, with no columns if the pipeline is missing."""
+        if self.nlp is None:
+            return np.zeros((len(texts), 0), dtype=np.float32)
+        docs = list(self.nlp.pipe(texts))
+        return np.array([doc.vector for doc in docs], dtype=np.float32).reshape(len(docs), -1)
+
+
+class TagIndex:
+    """
+    Thread-safe vocabulary of known tags with vectorized cosine-similarity merging.
+
+    Args:
+        embed (callable): Takes a list of strings and returns a (n, dim) float matrix.
+        threshold (float): Minimum cosine similarity for a new tag to be merged into a known one.
+    """
+
+    def __init__(self, embed=None, threshold=TAG_SIMILARITY_THRESHOLD):
+        self.embed = embed or SpacyEmbedder()
+        self.threshold = threshold
+        self._tags = []
+        self._keys = {}
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    @property
+    def tags(self):
+        """Returns a snapshot of the known tags."""
+        return list(self._tags)
+
+    def __len__(self):
+        return len(self._tags)
+
+    def _normalized_embeddings(self, tags):
+        vectors = np.asarray(self.embed(tags), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        # Tags without any known word get a zero vector and can only ever match exactly.
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def _append(self, tag, vector):
+        self._keys[tag.lower()] = len(self._tags)
+        self._tags.append(tag)
+        row = vector[np.newaxis, :]
+        self._matrix = row if self._matrix is None else np.vstack([self._matrix, row])
+
+    def add_many(self, tags):
+        """Adds tags to the vocabulary as they are, e.g. the distinct tags already in MongoDB."""
+        tags = [tag for tag in dict.fromkeys(normalize_tag(tag) for tag in tags if tag) if tag]
+        with self._lock:
+            tags = [tag for tag in tags if tag.lower() not in self._keys]
+            if not tags:
+                return
+            for tag, vector in zip(tags, self._normalized_embeddings(tags)):
+                self._append(tag, vector)
+
+    def reconcile(self, tag):
+        """Returns the known tag most similar to `tag`, or adds `tag` to the vocabulary and returns it."""
+        return self.reconcile_many([tag])[0]
+
+    def reconcile_many(self, tags):
+        """
+        Reconciles several fresh tags at once, embedding them in a single call.
+
+        Args:
+            tags (list[str]): Candidate tags, e.g. straight from Gemini.
+
+        Returns:
+            list[str]: The canonical tag for each candidate.
+        """
+        candidates = [normalize_tag(tag) for tag in tags]
+        with self._lock:
+            unseen = [tag for tag in dict.fromkeys(candidates) if tag and tag.lower() not in self._keys]
+            if unseen:
+                vectors = dict(zip(unseen, self._normalized_embeddings(unseen)))
+                for tag in unseen:
+                    if tag.lower() in self._keys:
+                        continue
+                    vector = vectors[tag]
+                    if self._matrix is not None and vector.any():
+                        similarities = self._matrix @ vector
+                        best = int(np.argmax(similarities))
+                        if similarities[best] >= self.threshold:
+                            self._keys[tag.lower()] = best
+                            continue
+                    self._append(tag, vector)
+
+            return [self._tags[self._keys[tag.lower()]] if tag else None for tag in candidates]
@@ -0,0 +1,160 @@
+"""
+Materialized per-chat tag statistics.
+
+Instead of running distinct("tag") over every stored message, each tagged message bumps a
+(chat_id, tag, day) counter in the TagStats collection, both when its tag is known at
+ingestion and when the background tagger fills it in later. /tags then ranks tags from
+at most chats x tags x TAG_STATS_DAYS counters, however many messages are stored.
+Increments are batched in memory and upserted every TAG_STATS_FLUSH_DELAY seconds.
+"""
+import asyncio
+import logging
+import os
+from datetime import timedelta, timezone
+
+from pymongo.errors import PyMongoError
+
+from summaries import utcnow
+
+logger = logging.getLogger(__name__)
+
+# /tags ranks tags by their message count over this many days
+TAG_STATS_DAYS = int(os.getenv("TAG_STATS_DAYS", "30"))
+TAG_STATS_FLUSH_DELAY = float(os.getenv("TAG_STATS_FLUSH_DELAY", "5"))
+# Most buttons /tags shows
+TAG_LIST_LIMIT = int(os.getenv("TAG_LIST_LIMIT", "50"))
+
+
+def stats_day(date):
+    """Returns the UTC day a message date falls on, as a naive datetime at midnight."""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class TagStats:
+    """
+    Write-behind counters of tagged messages per chat, tag and day.
+
+    Args:
+        repo (MessageRepository): Storage for the TagStats collection.
+        days (int): Window /tags ranks tags over.
+        flush_delay (float): Seconds between batched upserts.
+    """
+
+    def __init__(self, repo, days=TAG_STATS_DAYS, flush_delay=TAG_STATS_FLUSH_DELAY):
+        self.repo = repo
+        self.days = days
+        self.flush_delay = flush_delay
+
+        self._pending = {}  # (chat_id, tag, day) -> [count, last_seen]
+        self._untagged = {}  # doc_id -> (chat_id, date) of messages waiting for the tagger
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._counters = {"recorded": 0, "flushes": 0, "failed_flushes": 0}
+
+    async def start(self):
+        """Starts the periodic flusher. Must be called from the running event loop."""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically(), name="tag-stats")
+
+    async def stop(self):
+        """Stops the periodic flusher and writes the pending counts."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    def record(self, chat_id, tag, date):
+        """Counts a tagged message. Only touches memory."""
+        if date.tzinfo is not None:
+            date = date.astimezone(timezone.utc).replace(tzinfo=None)
+        key = (chat_id, tag, stats_day(date))
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [1, date]
+        else:
+            entry[0] += 1
+            entry[1] = max(entry[1], date)
+        self._counters["recorded"] += 1
+
+    def expect(self, doc_id, chat_id, date):
+        """Remembers where a message queued for tagging came from, until `tagged` is called."""
+        self._untagged[doc_id] = (chat_id, date)
+
+    def tagged(self, doc_id, tag):
+        """Counts a message the background tagger has just tagged."""
+        origin = self._untagged.pop(doc_id, None)
+        if origin is not None:
+            self.record(origin[0], tag, origin[1])
+
+    async def top(self, chat_ids, limit=TAG_LIST_LIMIT):
+        """
+        Ranks the tags of some chats by their message count over the last `days` days.
+
+        Args:
+            chat_ids (list[int]): IDs of the groups and channels.
+            limit (int): Maximum number of tags.
+
+        Returns:
+            list[tuple[str, int]]: (tag, count) pairs, most used first, including counts not
+                flushed yet.
+        """
+        chat_ids = set(chat_ids)
+        since = stats_day(utcnow()) - timedelta(days=self.days - 1)
+
+        unflushed = {}
+        for (chat_id, tag, day), (count, last_seen) in self._pending.items():
+            if chat_id in chat_ids and day >= since:
+                total, latest = unflushed.get(tag, (0, last_seen))
+                unflushed[tag] = (total + count, max(latest, last_seen))
+
+        # Ask for enough stored tags that unflushed counts cannot push a missing one into the top
+        stored = await self.repo.top_tags(list(chat_ids), since, limit + len(unflushed))
+        ranking = {tag: (count, last_seen) for tag, count, last_seen in stored}
+        for tag, (count, last_seen) in unflushed.items():
+            total, latest = ranking.get(tag, (0, last_seen))
+            ranking[tag] = (total + count, max(latest, last_seen))
+
+        ranked = sorted(ranking.items(), key=lambda item: (item[1][0], item[1][1]), reverse=True)
+        return [(tag, count) for tag, (count, _) in ranked[:limit]]
+
+    async def flush(self):
+        """Upserts the pending counts in one bulk write. Failed counts are kept for the next flush."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            self._counters["flushes"] += 1
+            try:
+                await self.repo.add_tag_stats(
+                    [(chat_id, tag, day, count, last_seen)
+                     for (chat_id, tag, day), (count, last_seen) in pending.items()]
+                )
+            except asyncio.CancelledError:
+                # E.g. stop() during the write: keep the counts for the final flush
+                self._restore(pending)
+                raise
+            except PyMongoError as e:
+                self._counters["failed_flushes"] += 1
+                logger.warning("Could not write %d tag counters, keeping them for the next flush: %s", len(pending), e)
+                self._restore(pending)
+
+    def _restore(self, pending):
+        for key, (count, last_seen) in pending.items():
+            entry = self._pending.setdefault(key, [0, last_seen])
+            entry[0] += count
+            entry[1] = max(entry[1], last_seen)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_delay)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Periodic tag stats flush failed")
+
+    def stats(self):
+        """Returns the number of pending counters and counters as a dict."""
+        return {"pending": len(self._pending), "awaiting_tag": len(self._untagged), **self._counters}
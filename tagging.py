@@ -0,0 +1,243 @@
+"""
+Background tagging pipeline.
+
+Messages are stored as soon as they arrive and their tag is filled in later by
+a pool of workers, so a slow Gemini round trip never blocks the update handlers.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+TAG_QUEUE_SIZE = int(os.getenv("TAG_QUEUE_SIZE", "1000"))
+TAG_WORKERS = int(os.getenv("TAG_WORKERS", "4"))
+# "block": wait up to TAG_ENQUEUE_TIMEOUT seconds for room, then drop.
+# "drop": never wait, drop straight away when the queue is full.
+TAG_QUEUE_POLICY = os.getenv("TAG_QUEUE_POLICY", "block")
+TAG_ENQUEUE_TIMEOUT = float(os.getenv("TAG_ENQUEUE_TIMEOUT", "2"))
+# Batch mode: collect up to TAG_BATCH_SIZE messages, waiting at most TAG_BATCH_WINDOW seconds
+# after the first one, and tag them with a single call. A size of 1 disables batching.
+TAG_BATCH_SIZE = int(os.getenv("TAG_BATCH_SIZE", "10"))
+TAG_BATCH_WINDOW = float(os.getenv("TAG_BATCH_WINDOW", "1.0"))
+
+FALLBACK_TAG = "unknown"
+
+
+class TaggingQueue:
+    """
+    Bounded queue of (doc_id, text) jobs processed by a worker pool.
+
+    Args:
+        tag_fn (callable): Takes the message text and returns a tag. Plain functions run
+            in a thread pool, coroutine functions are awaited directly.
+        on_tagged (callable): Coroutine function called with (doc_id, text, tag) once a tag is known.
+        maxsize (int): Maximum number of pending jobs.
+        workers (int): Number of concurrent workers.
+        policy (str): Backpressure policy when the queue is full, "block" or "drop".
+        batch_fn (callable, optional): Takes a list of texts and returns a list of tags of the
+            same length, with None for messages it could not tag. Those fall back to `tag_fn`.
+        batch_size (int): Maximum number of messages per batch.
+        batch_window (float): Seconds to wait for a batch to fill up after its first message.
+        local_fn (callable, optional): Coroutine function taking a list of texts and returning a
+            (tag, confidence) pair per text, with tag None when it is not confident enough. Runs
+            before the remote taggers, which only see the messages it could not tag.
+        cached_fn (callable, optional): Coroutine function taking a list of texts and returning
+            the tag of an already tagged copy, or None, per text. Runs first, once per batch.
+    """
+
+    def __init__(self, tag_fn, on_tagged, maxsize=TAG_QUEUE_SIZE, workers=TAG_WORKERS,
+                 policy=TAG_QUEUE_POLICY, enqueue_timeout=TAG_ENQUEUE_TIMEOUT,
+                 batch_fn=None, batch_size=TAG_BATCH_SIZE, batch_window=TAG_BATCH_WINDOW, local_fn=None,
+                 cached_fn=None):
+        if policy not in ("block", "drop"):
+            raise ValueError(f"Unknown tagging queue policy: {policy}")
+
+        self.tag_fn = tag_fn
+        self.on_tagged = on_tagged
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self.enqueue_timeout = enqueue_timeout
+        self.batch_fn = batch_fn if batch_size > 1 else None
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.local_fn = local_fn
+        self.cached_fn = cached_fn
+
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks = []
+        self._executor = None
+        self._counters = {"enqueued": 0, "processed": 0, "failed": 0, "dropped": 0, "blocked": 0,
+                          "batches": 0, "batch_fallbacks": 0, "cached": 0, "local": 0, "escalated": 0}
+
+    async def start(self):
+        """Starts the worker tasks. Must be called from the running event loop."""
+        if self._tasks:
+            return
+        if not all(asyncio.iscoroutinefunction(fn) for fn in (self.tag_fn, self.batch_fn) if fn):
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tagger")
+        self._tasks = [asyncio.create_task(self._worker(), name=f"tagger-{i}") for i in range(self.workers)]
+        logger.info("Started %d tagging workers (queue size %d, policy %s)", self.workers, self.maxsize, self.policy)
+
+    async def stop(self, timeout=10):
+        """Waits up to `timeout` seconds for pending jobs, then stops the workers."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping tagging workers with %d messages still queued", self._queue.qsize())
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def submit(self, doc_id, text):
+        """
+        Queues a stored message for tagging.
+
+        Returns:
+            bool: True if the job was queued, False if it was dropped because of backpressure.
+                Dropped messages are tagged with FALLBACK_TAG straight away.
+        """
+        try:
+            self._queue.put_nowait((doc_id, text))
+        except asyncio.QueueFull:
+            if self.policy == "drop" or not await self._put_with_timeout((doc_id, text)):
+                self._counters["dropped"] += 1
+                logger.warning("Tagging queue full (%d), dropping message %s", self.maxsize, doc_id)
+                await self.on_tagged(doc_id, text, FALLBACK_TAG)
+                return False
+
+        self._counters["enqueued"] += 1
+        return True
+
+    async def _put_with_timeout(self, job):
+        self._counters["blocked"] += 1
+        try:
+            await asyncio.wait_for(self._queue.put(job), self.enqueue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _call(self, fn, *args):
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _tag(self, text):
+        try:
+            return await self._call(self.tag_fn, text)
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.warning("Tagging failed: %s", e)
+            return FALLBACK_TAG
+
+    async def _tag_cached(self, texts):
+        """Reuses the tags of copies tagged before, leaving None for the rest."""
+        if self.cached_fn is None:
+            return [None] * len(texts)
+        try:
+            tags = await self.cached_fn(texts)
+        except Exception as e:
+            logger.warning("Tag lookup of %d messages failed: %s", len(texts), e)
+            return [None] * len(texts)
+        self._counters["cached"] += sum(1 for tag in tags if tag)
+        return tags
+
+    async def _tag_local(self, texts):
+        """Tags what the local classifier is confident about, leaving None for the rest."""
+        if self.local_fn is None:
+            return [None] * len(texts)
+        try:
+            tags = [tag for tag, _ in await self.local_fn(texts)]
+        except Exception as e:
+            logger.warning("Local classifier failed, escalating %d messages: %s", len(texts), e)
+            return [None] * len(texts)
+
+        local = sum(1 for tag in tags if tag)
+        self._counters["local"] += local
+        self._counters["escalated"] += len(texts) - local
+        return tags
+
+    async def _tag_remote(self, texts):
+        """Tags a batch in one call, falling back to per-message tagging for any gaps."""
+        tags = [None] * len(texts)
+        if self.batch_fn is not None and len(texts) > 1:
+            self._counters["batches"] += 1
+            try:
+                result = await self._call(self.batch_fn, texts)
+                if len(result) == len(texts):
+                    tags = list(result)
+                else:
+                    logger.warning("Batch tagger returned %d tags for %d messages", len(result), len(texts))
+            except Exception as e:
+                logger.warning("Batch tagging failed, tagging %d messages one by one: %s", len(texts), e)
+
+        missing = [i for i, tag in enumerate(tags) if not tag]
+        if len(texts) > 1:
+            self._counters["batch_fallbacks"] += len(missing)
+        fallback = await asyncio.gather(*(self._tag(texts[i]) for i in missing))
+        for i, tag in zip(missing, fallback):
+            tags[i] = tag
+        return tags
+
+    async def _tag_batch(self, texts):
+        tags = await self._tag_cached(texts)
+        pending = [i for i, tag in enumerate(tags) if not tag]
+        if pending:
+            local = await self._tag_local([texts[i] for i in pending])
+            for i, tag in zip(pending, local):
+                tags[i] = tag
+        escalated = [i for i, tag in enumerate(tags) if not tag]
+        if escalated:
+            remote = await self._tag_remote([texts[i] for i in escalated])
+            for i, tag in zip(escalated, remote):
+                tags[i] = tag
+        return tags
+
+    async def _next_batch(self):
+        """Waits for one job, then keeps collecting until the batch is full or the window closes."""
+        batch = [await self._queue.get()]
+        if self.batch_fn is None and self.local_fn is None and self.cached_fn is None:
+            return batch
+
+        deadline = asyncio.get_running_loop().time() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                tags = await self._tag_batch([text for _, text in batch])
+                for (doc_id, text), tag in zip(batch, tags):
+                    try:
+                        await self.on_tagged(doc_id, text, tag or FALLBACK_TAG)
+                        self._counters["processed"] += 1
+                    except Exception:
+                        logger.exception("Could not save tag for message %s", doc_id)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def depth(self):
+        """Returns the number of messages waiting to be tagged."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Returns queue depth and counters as a dict."""
+        return {"depth": self.depth(), "maxsize": self.maxsize, "workers": self.workers, **self._counters}
@@ -0,0 +1,65 @@
+"""
+Concurrent update processing with per-chat ordering.
+
+Updates from different chats, callback queries and other interactive updates are handled
+in parallel, while messages from a single chat are still processed one at a time in the
+order they arrived, so ingestion for that chat stays ordered.
+
+The concurrency limit is enforced here rather than by python-telegram-bot, whose slot is
+taken before `do_process_update` runs: updates queued behind their chat's lock would each
+hold one, and a burst from a single chat could starve every other chat and command.
+"""
+import asyncio
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Handed to python-telegram-bot so its own semaphore never limits anything
+UNLIMITED = 2 ** 31 - 1
+
+
+def ordering_key(update):
+    """Returns the chat whose updates must stay ordered, or None if the update can run freely."""
+    if not isinstance(update, Update):
+        return None
+    if update.message or update.channel_post or update.edited_message or update.edited_channel_post:
+        return update.effective_chat.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs up to `max_concurrent_updates` updates at once, serializing messages per chat."""
+
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        super().__init__(UNLIMITED)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}  # chat id -> [lock, number of updates using it]
+
+    async def do_process_update(self, update, coroutine):
+        key = ordering_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        # asyncio.Lock wakes waiters in FIFO order, which keeps the chat's updates in order.
+        # A slot is only taken once it is this update's turn in its chat.
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
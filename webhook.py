@@ -0,0 +1,137 @@
+"""
+Webhook deployment mode.
+
+Runs a small HTTP server that accepts Telegram's webhook POSTs and feeds them to the
+application, which processes them concurrently. Leave WEBHOOK_URL empty to test
+locally: the webhook is then not registered with Telegram and recorded updates can be
+replayed against the server with
+
+    python webhook.py recorded_updates.jsonl
+
+Updates are only accepted with the WEBHOOK_SECRET header, which is required once the
+webhook is registered. Without a secret the server only listens on localhost.
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+import time
+from collections import Counter
+
+from dotenv import load_dotenv
+from telegram import Update
+
+from http_server import HTTPServer
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Without a secret anyone reaching the port could post updates, so only local clients may
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0" if WEBHOOK_SECRET else "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").lstrip("/")
+# Public base URL Telegram should call, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def serve_webhook(application, allowed_updates=None):
+    """
+    Initializes and starts the application, then serves webhook updates until SIGINT/SIGTERM.
+
+    Raises:
+        ValueError: If WEBHOOK_URL is set without a WEBHOOK_SECRET.
+    """
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_SECRET must be set to register a webhook, otherwise anyone could post updates")
+    if not WEBHOOK_SECRET and WEBHOOK_LISTEN not in ("127.0.0.1", "::1", "localhost"):
+        logger.warning("Accepting updates without a secret on %s, set WEBHOOK_SECRET", WEBHOOK_LISTEN)
+
+    async def receive(headers, body):
+        if WEBHOOK_SECRET and not hmac.compare_digest(headers.get(SECRET_HEADER.lower(), ""), WEBHOOK_SECRET):
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except ValueError:
+            return 400, "text/plain", b"invalid update"
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+
+    server = HTTPServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    server.route("POST", WEBHOOK_PATH, receive)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates,
+            )
+            logger.info("Registered webhook %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+        else:
+            logger.info("WEBHOOK_URL is not set, not registering the webhook with Telegram")
+
+        try:
+            await stop.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+def read_updates(path):
+    """Reads recorded updates from a JSON array or a file with one JSON update per line."""
+    with open(path) as f:
+        content = f.read().strip()
+    if content.startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+async def replay(updates, url, secret, concurrency):
+    """POSTs recorded updates to a running webhook server and reports the response codes."""
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {SECRET_HEADER: secret} if secret else {}
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(update):
+            async with semaphore:
+                response = await client.post(url, json=update, headers=headers)
+                return response.status_code
+
+        started = time.perf_counter()
+        statuses = await asyncio.gather(*(post(update) for update in updates))
+        elapsed = time.perf_counter() - started
+
+    codes = ", ".join(f"{code}: {count}" for code, count in sorted(Counter(statuses).items()))
+    print(f"Replayed {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.1f}/s) - {codes}")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the local webhook server.")
+    parser.add_argument("updates", help="JSON array or JSON-lines file of Update objects")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8443')}"
+                                         f"/{os.getenv('WEBHOOK_PATH', 'telegram').lstrip('/')}")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    asyncio.run(replay(read_updates(args.updates), args.url, args.secret, args.concurrency))
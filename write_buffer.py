@@ -0,0 +1,169 @@
+"""
+Write-behind buffer for incoming messages.
+
+Instead of one insert_one round trip per message, documents are collected and written
+with a single unordered insert_many once WRITE_BUFFER_SIZE documents are pending or
+WRITE_BUFFER_DELAY seconds have passed.
+"""
+import asyncio
+import logging
+import os
+import random
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+WRITE_BUFFER_SIZE = int(os.getenv("WRITE_BUFFER_SIZE", "100"))
+WRITE_BUFFER_DELAY = float(os.getenv("WRITE_BUFFER_DELAY", "2"))
+WRITE_BUFFER_RETRIES = int(os.getenv("WRITE_BUFFER_RETRIES", "5"))
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class WriteBuffer:
+    """
+    Collects documents and flushes them in batches.
+
+    Args:
+        insert_many (callable): Coroutine function taking (documents, ordered=False), e.g.
+            `MessageRepository.insert_many`.
+        max_docs (int): Flush as soon as this many documents are pending.
+        max_delay (float): Flush at least this often while documents are pending.
+        max_retries (int): Attempts per batch before giving up on it.
+    """
+
+    def __init__(self, insert_many, max_docs=WRITE_BUFFER_SIZE, max_delay=WRITE_BUFFER_DELAY,
+                 max_retries=WRITE_BUFFER_RETRIES):
+        self.insert_many = insert_many
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+
+        self._pending = {}  # _id -> document, in insertion order
+        self._inflight = {}  # _id -> future resolved once the batch holding it is written
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._size_flush = None  # the flush started by `add` when the buffer filled up
+        self._counters = {"buffered": 0, "flushes": 0, "written": 0, "retries": 0, "failed": 0}
+
+    async def start(self):
+        """Starts the periodic flusher. Must be called from the running event loop."""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically(), name="write-buffer")
+
+    async def stop(self):
+        """Stops the periodic flusher and writes everything still pending."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if self._size_flush is not None:
+            await asyncio.gather(self._size_flush, return_exceptions=True)
+            self._size_flush = None
+        await self.flush()
+
+    async def add(self, doc):
+        """
+        Buffers a document for insertion.
+
+        Returns:
+            ObjectId: The document's _id, assigned here so it can be referenced before the flush.
+        """
+        doc.setdefault("_id", ObjectId())
+        self._pending[doc["_id"]] = doc
+        self._counters["buffered"] += 1
+
+        # One flush at a time: while it waits or retries, further documents simply queue up
+        if len(self._pending) >= self.max_docs and (self._size_flush is None or self._size_flush.done()):
+            self._size_flush = asyncio.create_task(self._flush_logged(), name="write-buffer-full")
+        return doc["_id"]
+
+    async def patch(self, doc_id, fields):
+        """
+        Applies `fields` to a document that has not been written yet.
+
+        Returns:
+            bool: True if the buffered document was updated. False if it is already in the
+                database (waiting first if it was being flushed), so the caller must update it there.
+        """
+        while True:
+            doc = self._pending.get(doc_id)
+            if doc is not None:
+                doc.update(fields)
+                return True
+
+            written = self._inflight.get(doc_id)
+            if written is None:
+                return False
+            # A cancelled flush puts its documents back, so look again once it is over
+            await asyncio.shield(written)
+
+    async def flush(self):
+        """Writes all pending documents with unordered insert_many, retrying failed batches."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            docs = list(self._pending.values())
+            self._pending = {}
+
+            done = asyncio.get_running_loop().create_future()
+            for doc in docs:
+                self._inflight[doc["_id"]] = done
+            try:
+                await self._write(docs)
+            except asyncio.CancelledError:
+                # E.g. stop() during a write or a retry delay: keep the batch for the final flush.
+                # Documents the attempt did write are reported as duplicates and skipped then.
+                self._pending = {**{doc["_id"]: doc for doc in docs}, **self._pending}
+                raise
+            finally:
+                for doc in docs:
+                    self._inflight.pop(doc["_id"], None)
+                done.set_result(None)
+
+    async def _write(self, docs):
+        self._counters["flushes"] += 1
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                await self.insert_many(docs, ordered=False)
+                self._counters["written"] += len(docs)
+                logger.info("Flushed %d messages to MongoDB", len(docs))
+                return
+            except BulkWriteError as e:
+                # Unordered inserts keep going past failures, so only the failed documents are
+                # retried. Duplicate keys mean an earlier attempt already wrote them.
+                failed = {error["index"] for error in e.details.get("writeErrors", [])
+                          if error.get("code") != DUPLICATE_KEY_ERROR}
+                self._counters["written"] += len(docs) - len(failed)
+                docs = [doc for i, doc in enumerate(docs) if i in failed]
+                if not docs:
+                    return
+                error = e
+            except PyMongoError as e:
+                error = e
+
+            if attempt < self.max_retries:
+                self._counters["retries"] += 1
+                delay = min(30, 2 ** attempt) * random.uniform(0.5, 1)
+                logger.warning("Writing %d messages failed (%s), retrying in %.1fs", len(docs), error, delay)
+                await asyncio.sleep(delay)
+
+        self._counters["failed"] += len(docs)
+        logger.error("Giving up on %d messages after %d attempts: %s", len(docs), self.max_retries, error)
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Flush failed")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.max_delay)
+            await self._flush_logged()
+
+    def stats(self):
+        """Returns the number of pending documents and counters as a dict."""
+        return {"pending": len(self._pending), "maxsize": self.max_docs, **self._counters}